@@ -0,0 +1,319 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from optparse import OptionParser
+
+import os
+import sys
+import imp
+import json
+import time
+import random
+import socket
+import subprocess
+from datetime import datetime, timedelta
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_PATH + '/../tornado')
+sys.path.insert(0, SCRIPT_PATH + '/../lib')
+from SingleFileLogAccessor import SingleFileLogAccessor
+from LogAccessor import LogAccessor
+from TimeBuckets import TimeBuckets
+
+from loggen import LogGenerator, FORMATS
+
+RESULTS_VERSION = 1
+
+# Generated logs start here. Syslog lines have no year, and are read as of
+# this one: stay clear of the 29th of February
+LOGS_START = datetime(2013, 1, 1)
+
+def err(line):
+    sys.stderr.write(line + "\n")
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=SCRIPT_PATH,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def make_logs(options):
+    """the logs to benchmark with, generated once per set of parameters and
+       kept in the workdir"""
+    params = {'size-mb': options.size_mb,
+              'num-files': options.num_files,
+              'variety': options.variety,
+              'stack-trace-rate': options.stack_trace_rate,
+              'seed': options.seed,
+              'loggen': os.stat(SCRIPT_PATH + '/loggen.py').st_mtime}
+    params_path = os.path.join(options.workdir, 'params.json')
+
+    logs = {'big': {},
+            'many': os.path.join(options.workdir, 'many', 'app.log*')}
+    for log_format in FORMATS:
+        logs['big'][log_format] = os.path.join(options.workdir,
+                                               '%s.log' % log_format)
+
+    try:
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return logs
+    except (IOError, ValueError):
+        pass
+
+    if not os.path.isdir(os.path.join(options.workdir, 'many')):
+        os.makedirs(os.path.join(options.workdir, 'many'))
+
+    size_bytes = int(options.size_mb * 1024 * 1024)
+    for log_format in FORMATS:
+        err("generating %.0fMB of %s logs" % (options.size_mb, log_format))
+        generator = LogGenerator(log_format, variety=options.variety,
+                                 stack_trace_rate=options.stack_trace_rate,
+                                 seed=options.seed)
+        generator.write(logs['big'][log_format], size_bytes, LOGS_START)
+
+    err("generating %d rotated log4j files" % options.num_files)
+    many_bytes = 64 * 1024
+    generator = LogGenerator('log4j', variety=options.variety,
+                             stack_trace_rate=options.stack_trace_rate,
+                             seed=options.seed)
+    generator.write(os.path.join(options.workdir, 'many', 'app.log'),
+                    many_bytes * options.num_files, LOGS_START, many_bytes)
+
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return logs
+
+def time_read(path, repeat):
+    """SingleFileLogAccessor, start to end of a file"""
+    runs = []
+    for _ in range(repeat):
+        t0 = time.time()
+        c0 = time.clock()
+        accessor = SingleFileLogAccessor(path, max_klines=1000000)
+        lines = 0
+        for _ in accessor:
+            lines += 1
+        runs.append({'secs': time.time() - t0, 'cpu-secs': time.clock() - c0,
+                     'lines': lines, 'bytes': accessor.get_bytes_read()})
+
+    best = min(runs, key=lambda run: run['secs'])
+    return {'lines': best['lines'],
+            'lines-per-sec': best['lines'] / best['secs'],
+            'mb-per-sec': best['bytes'] / best['secs'] / 1024 / 1024,
+            'cpu-secs': best['cpu-secs'],
+            'secs': [run['secs'] for run in runs]}
+
+def time_squeeze(path, repeat, max_lines):
+    """squeeze(), on its own, of the texts of the first max_lines lines"""
+    accessor = SingleFileLogAccessor(path, max_klines=1000000)
+    texts = []
+    for rec in accessor:
+        texts.append(rec['text'])
+        if len(texts) >= max_lines:
+            break
+
+    runs = []
+    for _ in range(repeat):
+        t0 = time.time()
+        for text in texts:
+            accessor.squeeze(text)
+        runs.append(time.time() - t0)
+
+    return {'lines': len(texts),
+            'lines-per-sec': len(texts) / min(runs),
+            'secs': runs}
+
+def time_seek(path, num_seeks):
+    """seek_time(), to random times within the file"""
+    accessor = SingleFileLogAccessor(path, max_klines=1000000)
+    first = datetime.strptime(accessor.look_one_rec_ahead()['ts'][:19],
+                              "%Y-%m-%d %H:%M:%S")
+    accessor.seek_offset(max(0, accessor.get_file_size() - 65536))
+    last_ts = None
+    for rec in accessor:
+        last_ts = rec['ts']
+    last = datetime.strptime(last_ts[:19], "%Y-%m-%d %H:%M:%S")
+
+    span = (last - first).total_seconds()
+    latencies = []
+    for _ in range(num_seeks):
+        ts = str(first + timedelta(seconds=random.uniform(0, span)))
+        t0 = time.time()
+        accessor.seek_time(ts)
+        latencies.append((time.time() - t0) * 1000)
+
+    return {'seeks': num_seeks,
+            'p50-ms': percentile(latencies, 50),
+            'p90-ms': percentile(latencies, 90),
+            'p99-ms': percentile(latencies, 99),
+            'max-ms': max(latencies)}
+
+def time_setup(logs_glob, repeat):
+    """LogAccessor(), which opens every file and sorts them by first line"""
+    runs = []
+    for _ in range(repeat):
+        t0 = time.time()
+        accessor = LogAccessor(logs_glob, max_klines=1000000)
+        runs.append(time.time() - t0)
+        num_files = len(accessor.open_logfiles)
+        accessor.close_all_files()
+
+    return {'files': num_files,
+            'median-ms': median(runs) * 1000,
+            'min-ms': min(runs) * 1000}
+
+def time_summarize(hblogd, path, repeat, max_lines):
+    """hblogd's summarize(), of lines already read, with and without the
+       time buckets of --histogram"""
+    records = []
+    for rec in SingleFileLogAccessor(path, max_klines=1000000):
+        records.append(rec)
+        if len(records) >= max_lines:
+            break
+
+    results = {'lines': len(records)}
+    for name, width in [('plain', None), ('histogram', 60)]:
+        runs = []
+        for _ in range(repeat):
+            time_buckets = width and TimeBuckets(width)
+            t0 = time.time()
+            summary = hblogd.summarize(records, time_buckets)
+            runs.append(time.time() - t0)
+        results[name] = {'lines-per-sec': len(records) / min(runs),
+                         'fingerprints': len(summary['fp']),
+                         'secs': runs}
+    return results
+
+def run(options):
+    logs = make_logs(options)
+    hblogd = imp.load_source('hblogd', SCRIPT_PATH + '/../sbin/hblogd.py')
+    random.seed(options.seed)
+
+    results = {}
+    for log_format in FORMATS:
+        path = logs['big'][log_format]
+        err("timing %s" % log_format)
+        results['read.%s' % log_format] = time_read(path, options.repeat)
+        results['squeeze.%s' % log_format] = time_squeeze(path, options.repeat,
+                                                          options.max_lines)
+        results['seek.%s' % log_format] = time_seek(path, options.num_seeks)
+
+    err("timing setup and summarize")
+    results['setup.many'] = time_setup(logs['many'], options.repeat)
+    results['summarize.log4j'] = time_summarize(hblogd, logs['big']['log4j'],
+                                                options.repeat,
+                                                options.max_lines)
+
+    return {'version': RESULTS_VERSION,
+            'time': str(datetime.now()),
+            'git-commit': get_git_commit(),
+            'python': sys.version.split()[0],
+            'host': socket.gethostname(),
+            'params': {'size-mb': options.size_mb,
+                       'num-files': options.num_files,
+                       'variety': options.variety,
+                       'stack-trace-rate': options.stack_trace_rate,
+                       'repeat': options.repeat,
+                       'num-seeks': options.num_seeks,
+                       'max-lines': options.max_lines,
+                       'seed': options.seed},
+            'results': results}
+
+def flatten(results, prefix=""):
+    """{'read.log4j.lines-per-sec': 123.4, ...}, numbers only"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(old, new):
+    """the metrics of both runs, side by side; ratios over 1 are faster for
+       per-sec metrics and slower for the rest"""
+    old_flat = flatten(old['results'])
+    new_flat = flatten(new['results'])
+    lines = ["%-44s %14s %14s %7s" % ("metric", old.get('git-commit', '')[:12],
+                                      new.get('git-commit', '')[:12],
+                                      "new/old")]
+    for key in sorted(set(old_flat) & set(new_flat)):
+        ratio = ""
+        if old_flat[key]:
+            ratio = "%.2f" % (float(new_flat[key]) / old_flat[key])
+        lines.append("%-44s %14.2f %14.2f %7s" % (key, old_flat[key],
+                                                   new_flat[key], ratio))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.description = "benchmarks how fast hblogd reads, fingerprints, " \
+        "seeks in and summarizes logs, on synthetic ones from loggen.py, " \
+        "and writes the results as json"
+    parser.add_option("--workdir", default="/tmp/hblog-bench",
+        help="where the generated logs are kept (default: %default)")
+    parser.add_option("--size-mb", type="float", default=20.0,
+        help="size of the log of each format (default: %default)")
+    parser.add_option("--num-files", type="int", default=200,
+        help="number of rotated files to set up a LogAccessor over "
+            "(default: %default)")
+    parser.add_option("--variety", type="int", default=200,
+        help="about this many different fingerprints (default: %default)")
+    parser.add_option("--stack-trace-rate", type="float", default=0.05,
+        help="the fraction of log4j WARN and worse lines that a stack trace "
+            "follows (default: %default)")
+    parser.add_option("--repeat", type="int", default=3,
+        help="run each timing this many times, keep the best "
+            "(default: %default)")
+    parser.add_option("--num-seeks", type="int", default=200,
+        help="seek_time() this many times per format (default: %default)")
+    parser.add_option("--max-lines", type="int", default=100000,
+        help="squeeze and summarize at most this many lines "
+            "(default: %default)")
+    parser.add_option("--seed", type="int", default=0,
+        help="for the same logs and seeks every time (default: %default)")
+    parser.add_option("-o", "--output", default=None,
+        help="write the results to this file (default: stdout)")
+    parser.add_option("--compare", default=None,
+        help="results of an earlier run, to print side by side with these "
+            "(default: %default)")
+
+    options, args = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments: %s" % " ".join(args))
+
+    new = run(options)
+    text = json.dumps(new, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+    if options.compare:
+        with open(options.compare) as f:
+            err(compare(json.load(f), new))
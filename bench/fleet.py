@@ -0,0 +1,593 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from optparse import OptionParser
+
+import os
+import re
+import sys
+import imp
+import json
+import time
+import random
+import select
+import shlex
+import signal
+import socket
+import urllib
+import urlparse
+import resource
+import functools
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+from loggen import LogGenerator
+from benchmark import get_git_commit, median, percentile, compare
+
+import tornado.ioloop
+import tornado.httpserver
+
+RESULTS_VERSION = 1
+
+HBLOG_PATH = SCRIPT_PATH + '/../bin/hblog.py'
+HBLOGD_PATH = SCRIPT_PATH + '/../sbin/hblogd.py'
+
+# What each log set has, as the globs of hblog --local name them
+LOGS = [('log4j', 'var/log/example-hadoop-hadoop-avatarnode.log'),
+        ('gc', 'var/log/example-hadoop-hadoop-avatarnode-gc.log'),
+        ('syslog', 'var/log/example-syslog-messages.log')]
+FOLLOWED_LOG = 'var/log/example-hadoop-hadoop-avatarnode.log'
+
+FAILURES = ['error', 'hang', 'refuse']
+
+WORKLOADS = ['summary', 'details', 'follow']
+
+# A --details or --follow line: "ts fp level host text"
+DETAILS_LINE_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d+)?) '
+                             r'\S+ \S+ +(\S+) ')
+
+def err(line):
+    sys.stderr.write(line + "\n")
+
+class StandIn():
+    """ One host of the fleet: hblogd's handlers, with their own scan limits
+        and summary cache, reading the log set of the host. Answers after
+        latency_secs, or fails:
+
+          error   with a 500
+          hang    not at all, until hblog gives up on it
+          refuse  by not listening in the first place
+
+        hblog --local asks for ./var/log/...; those globs are made the log
+        set's. So are those a relay passes on, which are another's."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, application, sets_dir, log_set, latency_secs=0.0,
+                 failure=None):
+        self.application = application
+        self.log_dir = os.path.join(sets_dir, str(log_set))
+        self.glob_re = re.compile(r'^(\./|%s/\d+/)' % re.escape(sets_dir))
+        self.latency_secs = latency_secs
+        self.failure = failure
+
+    def __call__(self, request):
+        if self.failure == 'hang':
+            return
+        if self.failure == 'error':
+            request.write("HTTP/1.1 500 Internal Server Error\r\n"
+                          "Content-Length: 0\r\n\r\n")
+            request.finish()
+            return
+
+        request.query = self.rewrite_query(request.query)
+        if self.latency_secs:
+            tornado.ioloop.IOLoop.instance().add_timeout(
+                              time.time() + self.latency_secs,
+                              functools.partial(self.application, request))
+        else:
+            self.application(request)
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def rewrite_query(self, query):
+        args = []
+        for key, val in urlparse.parse_qsl(query, keep_blank_values=True):
+            if key == 'glob':
+                val = ",".join([self.glob_re.sub(self.log_dir + '/', g)
+                                                   for g in val.split(',')])
+            args.append((key, val))
+        return urllib.urlencode(args)
+
+def plan_fleet(options):
+    """[{'host', 'address', 'port', 'log-set', 'latency-secs', 'failure'}],
+       the same for the same --seed"""
+    rand = random.Random(options.seed)
+    failures = [f for f in options.failures.split(',') if f]
+    fleet = []
+    for i in range(options.hosts):
+        if options.loopback:
+            # 127.0.0.1 is left to a real hblogd
+            address = "127.1.%d.%d" % (i / 250, i % 250 + 1)
+            port = 6957
+            host = address
+        else:
+            address = "127.0.0.1"
+            port = options.base_port + i
+            host = "%s:%d" % (address, port)
+
+        latency_secs = options.latency_ms / 1000.0
+        if rand.random() < options.slow_rate:
+            latency_secs += options.slow_ms / 1000.0
+
+        failure = None
+        if failures and rand.random() < options.fail_rate:
+            failure = rand.choice(failures)
+
+        fleet.append({'host': host,
+                      'address': address,
+                      'port': port,
+                      'log-set': i % options.log_sets,
+                      'latency-secs': latency_secs,
+                      'failure': failure})
+    return fleet
+
+def make_log_sets(options, sets_dir):
+    """options.log_sets sets of logs, of every format, the last
+       options.log_minutes up to now"""
+    now = datetime.now()
+    span_secs = options.log_minutes * 60
+    size_bytes = int(options.log_mb * 1024 * 1024)
+    for log_set in range(options.log_sets):
+        for log_format, name in LOGS:
+            path = os.path.join(sets_dir, str(log_set), name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            # as many lines per sec as it takes for the logs to span the
+            # minutes, judging by the size of some of them
+            sample = LogGenerator(log_format, variety=options.variety,
+                                  seed=log_set)
+            sample_bytes = sum([len("".join([l + "\n" for l in
+                                             sample.event(now, now)]))
+                                for _ in range(200)])
+            lines_per_sec = size_bytes / (sample_bytes / 200.0) / span_secs
+
+            start = now - timedelta(seconds=span_secs)
+            for _ in range(2):
+                generator = LogGenerator(log_format, variety=options.variety,
+                                         lines_per_sec=lines_per_sec,
+                                         seed=log_set,
+                                         hostname="host%03d" % log_set)
+                written = generator.write(path, size_bytes, start,
+                                          int(options.rotate_mb * 1024 * 1024))
+                # the same seed writes the same lines: moved back by as much
+                # as they went past now, the last one is now
+                overshoot = datetime.strptime(written['end'][:19],
+                                              "%Y-%m-%d %H:%M:%S") - now
+                if overshoot <= timedelta(0):
+                    break
+                start -= overshoot + timedelta(seconds=1)
+
+def serve(fleet, sets_dir, hblogd_args, log_path, ready):
+    """runs in a process of its own: the stand-ins of fleet, until killed"""
+    log = open(log_path, 'a')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    try:
+        hblogd = imp.load_source('hblogd', HBLOGD_PATH)
+        options, _ = hblogd.get_option_parser().parse_args(hblogd_args)
+        options = vars(options)
+        if options['debug']:
+            options['verbose'] = True
+        options['worker'] = 0
+
+        for stand_in in fleet:
+            if stand_in['failure'] == 'refuse':
+                continue
+            application = hblogd.make_application(dict(options))
+            server = tornado.httpserver.HTTPServer(
+                       StandIn(application, sets_dir, stand_in['log-set'],
+                               stand_in['latency-secs'], stand_in['failure']))
+            server.listen(stand_in['port'], stand_in['address'])
+    except Exception as e:
+        ready.put(('error', "%s: %s" % (e.__class__.__name__, e)))
+        raise
+
+    ready.put(('ok', len(fleet)))
+    tornado.ioloop.IOLoop.instance().start()
+
+def start_fleet(fleet, options, sets_dir):
+    """the processes serving the fleet, once all of them listen"""
+    hblogd_args = shlex.split(options.hblogd_args)
+    ready = multiprocessing.Queue()
+    processes = []
+    for i in range(options.processes):
+        process = multiprocessing.Process(target=serve,
+                    args=(fleet[i::options.processes], sets_dir, hblogd_args,
+                          os.path.join(options.workdir, 'stand-ins-%d.log' % i),
+                          ready))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    for _ in processes:
+        status, what = ready.get(timeout=300)
+        if status != 'ok':
+            stop_fleet(processes)
+            raise Exception("Could not start the stand-ins: %s" % what)
+    return processes
+
+def stop_fleet(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join()
+
+def get_cpu_secs(pids):
+    """user and system time of the processes so far, from /proc"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.0
+    for pid in pids:
+        try:
+            with open("/proc/%d/stat" % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / float(ticks)
+    return total
+
+class Appender(threading.Thread):
+    """ Keeps the followed log of every log set growing, lines_per_sec each,
+        with lines of the time they are written"""
+
+    def __init__(self, sets_dir, log_sets, lines_per_sec, variety):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.paths = [os.path.join(sets_dir, str(log_set), FOLLOWED_LOG)
+                                              for log_set in range(log_sets)]
+        self.generators = [LogGenerator('log4j', variety=variety,
+                                        seed=1000 + log_set)
+                                              for log_set in range(log_sets)]
+        self.lines_per_sec = lines_per_sec
+        self.stopped = threading.Event()
+
+    def run(self):
+        start = datetime.now()
+        while not self.stopped.is_set():
+            for path, generator in zip(self.paths, self.generators):
+                with open(path, 'a') as f:
+                    for line in generator.event(datetime.now(), start):
+                        f.write(line + "\n")
+            self.stopped.wait(1.0 / self.lines_per_sec)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def run_client(client_args, env, stand_in_pids, follow_secs=None):
+    """runs hblog once: what it cost and how long it took, as the client and
+       the stand-ins saw it; with follow_secs, interrupted after them"""
+    stderr_path = env['HOME'] + '/hblog.stderr'
+    timings_path = env['HOME'] + '/host-timings.json'
+    if os.path.exists(timings_path):
+        os.remove(timings_path)
+
+    cmd = [sys.executable, HBLOG_PATH, '--host-timings-file',
+           timings_path] + client_args
+
+    stand_ins_cpu = get_cpu_secs(stand_in_pids)
+    started = time.time()
+    with open(stderr_path, 'w') as stderr:
+        pid, stdout_fd = spawn(cmd, env, stderr)
+
+    run = {'output-lines': 0, 'first-output-secs': None}
+    lags = {}  # host -> secs from logging a line to hblog printing it
+    buffered = ""
+    interrupted = False
+    while True:
+        timeout = None
+        if follow_secs is not None and not interrupted:
+            timeout = max(0.0, started + follow_secs - time.time())
+        readable, _, _ = select.select([stdout_fd], [], [], timeout)
+        if not readable:
+            os.kill(pid, signal.SIGINT)
+            interrupted = True
+            continue
+
+        data = os.read(stdout_fd, 65536)
+        if not data:
+            break
+        now = time.time()
+        if run['first-output-secs'] is None:
+            run['first-output-secs'] = now - started
+
+        lines = (buffered + data).split("\n")
+        buffered = lines.pop()
+        run['output-lines'] += len(lines)
+        if follow_secs is not None:
+            add_lags(lags, lines, started, now)
+
+    os.close(stdout_fd)
+    _, status, rusage = os.wait4(pid, 0)
+    run['wall-secs'] = time.time() - started
+    run['user-secs'] = rusage.ru_utime
+    run['sys-secs'] = rusage.ru_stime
+    run['cpu-secs'] = rusage.ru_utime + rusage.ru_stime
+    run['max-rss-mb'] = rusage.ru_maxrss / 1024.0  # KB on linux
+    run['exit-status'] = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                                                else -os.WTERMSIG(status)
+    run['stand-ins-cpu-secs'] = get_cpu_secs(stand_in_pids) - stand_ins_cpu
+
+    if follow_secs is None:
+        run['hosts'] = read_host_timings(timings_path)
+    else:
+        run['hosts'] = summarize_lags(lags)
+
+    if run['exit-status'] != 0 and not interrupted:
+        with open(stderr_path) as f:
+            run['stderr-tail'] = f.read()[-2000:]
+    return run
+
+def spawn(cmd, env, stderr):
+    """pid and the fd of the stdout of cmd, read as it comes"""
+    stdout_fd, child_stdout = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.dup2(child_stdout, 1)
+        os.dup2(stderr.fileno(), 2)
+        os.close(stdout_fd)
+        os.close(child_stdout)
+        try:
+            os.execve(cmd[0], cmd, env)
+        finally:
+            os._exit(127)
+    os.close(child_stdout)
+    return pid, stdout_fd
+
+def add_lags(lags, lines, started, now):
+    for line in lines:
+        m = DETAILS_LINE_RE.match(line)
+        if not m:
+            continue
+        logged = time.mktime(time.strptime(m.group(1)[:19],
+                                           "%Y-%m-%d %H:%M:%S")) + \
+                 float(m.group(2) or 0)
+        if logged >= started:  # lines logged before hblog was asked are old
+            lags.setdefault(m.group(3), []).append(now - logged)
+
+def percentiles(values):
+    if not values:
+        return None
+    return {'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values)}
+
+def read_host_timings(path):
+    """the spread of the timings of hblog --host-timings-file over the hosts,
+       and the slowest of them"""
+    try:
+        with open(path) as f:
+            hosts = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    by_total = sorted(hosts.items(), key=lambda i: i[1]['total'],
+                      reverse=True)
+    report = {'hosts': len(hosts),
+              'slowest': [[host, round(timing['total'], 3)]
+                                           for host, timing in by_total[:10]]}
+    for key in ['total', 'queued', 'first-byte', 'fetch', 'decode']:
+        report[key] = percentiles([timing[key] for timing in hosts.values()])
+    return report
+
+def summarize_lags(lags):
+    """the spread of the lags of all lines, of the p90 of each host, and the
+       hosts of the highest"""
+    p90s = dict((host, percentile(values, 90))
+                                            for host, values in lags.items())
+    return {'hosts': len(lags),
+            'lag': percentiles(sum(lags.values(), [])),
+            'host-p90-lag': percentiles(p90s.values()),
+            'slowest': [[host, round(lag, 3)] for host, lag in
+                        sorted(p90s.items(), key=lambda i: i[1],
+                               reverse=True)[:10]]}
+
+def summarize_runs(runs):
+    """medians over the runs, of what can be compared from run to run"""
+    summary = {}
+    for key in ['wall-secs', 'first-output-secs', 'cpu-secs', 'max-rss-mb',
+                'stand-ins-cpu-secs', 'output-lines']:
+        values = [run[key] for run in runs if run.get(key) is not None]
+        if values:
+            summary[key] = median(values)
+
+    for key in ['total', 'first-byte', 'lag', 'host-p90-lag']:
+        values = [run['hosts'][key] for run in runs
+                              if run.get('hosts') and run['hosts'].get(key)]
+        if values:
+            summary['hosts-' + key] = dict(
+                    (p, median([value[p] for value in values]))
+                                          for p in ['p50', 'p90', 'p99', 'max'])
+    return summary
+
+def run_workloads(options, client_args, fleet, processes, sets_dir):
+    home = os.path.join(options.workdir, 'home')  # no ~/.hblogrc, no caches
+    if not os.path.isdir(home):
+        os.makedirs(home)
+    env = dict(os.environ)
+    env['HOME'] = home
+
+    hosts_path = os.path.join(options.workdir, 'hosts')
+    with open(hosts_path, 'w') as f:
+        for stand_in in fleet:
+            f.write(stand_in['host'] + "\n")
+
+    pids = [process.pid for process in processes]
+    results = {}
+    for workload in options.workloads.split(','):
+        args = ['--local', '--hosts-file', hosts_path,
+                '--result-cache-mb', '0', '--tier-cache-secs', '0',
+                '--%s' % workload] + client_args + [options.tier]
+
+        appender = None
+        follow_secs = None
+        if workload == 'follow':
+            follow_secs = options.follow_secs
+            appender = Appender(sets_dir, options.log_sets,
+                                options.follow_lines_per_sec, options.variety)
+            appender.start()
+
+        runs = []
+        try:
+            for i in range(options.runs):
+                err("%s run %d of %d" % (workload, i + 1, options.runs))
+                runs.append(run_client(args, env, pids, follow_secs))
+                if 'stderr-tail' in runs[-1]:
+                    err("WARNING: hblog exited with %d:\n%s" %
+                        (runs[-1]['exit-status'], runs[-1]['stderr-tail']))
+        finally:
+            if appender:
+                appender.stop()
+
+        results[workload] = summarize_runs(runs)
+        results[workload]['runs'] = runs
+    return results
+
+def raise_open_files_limit():
+    """every stand-in listens, and hblog connects to many of them"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [-- hblog options]")
+    parser.description = "runs hblog against a fleet of local hblogd " \
+        "stand-ins with generated logs, some slow or failing, and writes " \
+        "how long it took and what it cost, per workload, as json"
+    parser.add_option("--hosts", type="int", default=500,
+        help="number of stand-ins (default: %default)")
+    parser.add_option("--loopback", action="store_true", default=False,
+        help="put the stand-ins on addresses of their own, 127.1.x.y, on "
+            "hblogd's port, rather than on ports of their own on 127.0.0.1")
+    parser.add_option("--base-port", type="int", default=17000,
+        help="the port of the first stand-in (default: %default)")
+    parser.add_option("--processes", type="int", default=0,
+        help="processes the stand-ins are spread over, 0 for one per CPU "
+            "core (default: %default)")
+    parser.add_option("--hblogd-args", default="--summary-cache-mb 4",
+        help="hblogd options for every stand-in (default: %default)")
+    parser.add_option("--log-sets", type="int", default=4,
+        help="different sets of logs, the stand-ins take turns with them "
+            "(default: %default)")
+    parser.add_option("--log-mb", type="float", default=1.0,
+        help="size of each log of a set (default: %default)")
+    parser.add_option("--log-minutes", type="int", default=60,
+        help="the logs span the last this many minutes (default: %default)")
+    parser.add_option("--rotate-mb", type="float", default=0.0,
+        help="rotate the logs every this many MB (default: %default, never)")
+    parser.add_option("--variety", type="int", default=200,
+        help="about this many different fingerprints (default: %default)")
+    parser.add_option("--latency-ms", type="float", default=0.0,
+        help="every stand-in answers this much later (default: %default)")
+    parser.add_option("--slow-rate", type="float", default=0.0,
+        help="the fraction of stand-ins that are slow (default: %default)")
+    parser.add_option("--slow-ms", type="float", default=5000.0,
+        help="how much later slow stand-ins answer (default: %default)")
+    parser.add_option("--fail-rate", type="float", default=0.0,
+        help="the fraction of stand-ins that fail (default: %default)")
+    parser.add_option("--failures", default=",".join(FAILURES),
+        help="how they fail, any of %s: with a 500, by never answering, or "
+            "by refusing connections (default: %%default)" %
+            ", ".join(FAILURES))
+    parser.add_option("--workloads", default=",".join(WORKLOADS),
+        help="any of %s (default: %%default)" % ", ".join(WORKLOADS))
+    parser.add_option("--tier", default="nn",
+        help="the tier hblog asks for, one of hblog --local's "
+            "(default: %default)")
+    parser.add_option("--runs", type="int", default=3,
+        help="runs of hblog per workload (default: %default)")
+    parser.add_option("--follow-secs", type="float", default=10.0,
+        help="how long each --follow run lasts (default: %default)")
+    parser.add_option("--follow-lines-per-sec", type="float", default=2.0,
+        help="lines added to each log set while following "
+            "(default: %default)")
+    parser.add_option("--seed", type="int", default=0,
+        help="for the same fleet every time (default: %default)")
+    parser.add_option("--workdir", default="/tmp/hblog-fleet",
+        help="where the logs, the hosts file and the stand-ins' logs go "
+            "(default: %default)")
+    parser.add_option("-o", "--output", default=None,
+        help="write the results to this file (default: stdout)")
+    parser.add_option("--compare", default=None,
+        help="results of an earlier run, to print side by side with these "
+            "(default: %default)")
+
+    options, client_args = parser.parse_args()
+    for workload in options.workloads.split(','):
+        if workload not in WORKLOADS:
+            parser.error("Unknown workload: %s" % workload)
+    for failure in options.failures.split(','):
+        if failure and failure not in FAILURES:
+            parser.error("Unknown failure: %s" % failure)
+    if options.processes == 0:
+        options.processes = multiprocessing.cpu_count()
+    options.processes = min(options.processes, options.hosts)
+
+    raise_open_files_limit()
+
+    sets_dir = os.path.join(options.workdir, 'sets')
+    err("generating %d log sets" % options.log_sets)
+    make_log_sets(options, sets_dir)
+
+    fleet = plan_fleet(options)
+    err("starting %d stand-ins in %d processes" % (options.hosts,
+                                                   options.processes))
+    processes = start_fleet(fleet, options, sets_dir)
+    try:
+        results = run_workloads(options, client_args, fleet, processes,
+                                sets_dir)
+    finally:
+        stop_fleet(processes)
+
+    params = dict(vars(options))
+    params['hblog-args'] = client_args
+    params['failing-hosts'] = len([s for s in fleet if s['failure']])
+    new = {'version': RESULTS_VERSION,
+           'time': str(datetime.now()),
+           'git-commit': get_git_commit(),
+           'python': sys.version.split()[0],
+           'host': socket.gethostname(),
+           'params': params,
+           'results': results}
+
+    text = json.dumps(new, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+    if options.compare:
+        with open(options.compare) as f:
+            err(compare(json.load(f), new))
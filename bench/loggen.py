@@ -0,0 +1,278 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from optparse import OptionParser
+
+import os
+import sys
+import json
+import random
+from datetime import datetime, timedelta
+
+FORMATS = ['log4j', 'syslog', 'gc']
+
+# INFO most of the time, FATAL hardly ever
+LEVEL_WEIGHTS = [('INFO', 70), ('DEBUG', 15), ('WARN', 10), ('ERROR', 4.5),
+                 ('FATAL', 0.5)]
+
+CLASSES = ['org.apache.hadoop.hdfs.server.namenode.FSNamesystem',
+           'org.apache.hadoop.hdfs.server.namenode.NameNode',
+           'org.apache.hadoop.hdfs.server.datanode.DataNode',
+           'org.apache.hadoop.hdfs.StateChange',
+           'org.apache.hadoop.ipc.Server',
+           'org.apache.hadoop.ipc.Client',
+           'org.apache.hadoop.hbase.regionserver.HRegionServer',
+           'org.apache.hadoop.hbase.regionserver.Store',
+           'org.apache.hadoop.hbase.master.HMaster',
+           'org.apache.hadoop.mapred.TaskTracker',
+           'org.apache.hadoop.mapred.JobTracker',
+           'org.apache.zookeeper.ClientCnxn']
+
+WORDS = ['block', 'replica', 'lease', 'region', 'split', 'compaction',
+         'flush', 'edit', 'log', 'checkpoint', 'heartbeat', 'session',
+         'connection', 'request', 'response', 'queue', 'handler', 'task',
+         'attempt', 'job', 'snapshot', 'store', 'file', 'memstore', 'table',
+         'scanner', 'lock', 'timeout', 'retry', 'channel']
+
+VERBS = ['Starting', 'Finished', 'Removing', 'Adding', 'Closing', 'Opening',
+         'Received', 'Sending', 'Failed to open', 'Could not find',
+         'Recovering', 'Rolling', 'Expired', 'Scheduling', 'Skipping']
+
+# Filled in with a new value for every line, like the variable parts of
+# real log lines; squeeze() takes them out again
+FIELDS = {
+    'num': lambda: str(random.randint(0, 100000)),
+    'ms': lambda: "%.3f" % random.expovariate(0.05),
+    'ip': lambda: "10.%d.%d.%d" % (random.randint(0, 255),
+                                   random.randint(0, 255),
+                                   random.randint(1, 254)),
+    'host': lambda: "host%03d.example.com" % random.randint(0, 999),
+    'hex': lambda: "%016x" % random.getrandbits(64),
+    'block': lambda: "blk_%d_%d" % (random.getrandbits(62),
+                                    random.randint(1000, 9999)),
+    'path': lambda: "/user/hadoop/%s/part-%05d" % (random.choice(WORDS),
+                                                    random.randint(0, 99999)),
+}
+
+SYSLOG_PROGRAMS = ['ntpd', 'kernel', 'sshd', 'crond', 'snmpd', 'dhclient',
+                   'puppet-agent', 'smartd']
+
+class LogGenerator():
+    """ Writes logs in one of FORMATS, as a cluster's daemons would: log4j,
+        with java stack traces after some of the WARN and worse lines,
+        syslog, or the multi-line java gc log. About variety fingerprints
+        show up in them. Lines come lines_per_sec on average, from start on.
+
+        With rotate_bytes, the logs are rotated like log4j does: the newest
+        in the file itself, older ones in file.1, file.2 ..."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, log_format, variety=200, stack_trace_rate=0.05,
+                 stack_depth=20, lines_per_sec=50.0, seed=0,
+                 hostname="host000"):
+        if log_format not in FORMATS:
+            raise ValueError("log_format is one of %s" % FORMATS)
+
+        self.log_format = log_format
+        self.stack_trace_rate = stack_trace_rate
+        self.stack_depth = stack_depth
+        self.lines_per_sec = lines_per_sec
+        self.hostname = hostname
+
+        random.seed(seed)
+        self.templates = [self.new_template() for _ in range(variety)]
+        self.frames = ["%s.%s" % (random.choice(CLASSES),
+                                  random.choice(['run', 'call', 'process',
+                                                 'doWork', 'handle', 'invoke',
+                                                 'read', 'write', 'open']))
+                       for _ in range(max(stack_depth * 4, 10))]
+
+    def write(self, path, size_bytes, start, rotate_bytes=0):
+        """logs of about size_bytes in all, from start on. Returns what was
+           written: {'files', 'lines', 'bytes', 'start', 'end'}"""
+        chunks = []  # oldest first
+        ts = start
+        num_lines = 0
+        num_bytes = 0
+
+        f = None
+        chunk_bytes = 0
+        while num_bytes < size_bytes:
+            if f is None or (rotate_bytes and chunk_bytes >= rotate_bytes):
+                if f:
+                    f.close()
+                chunks.append("%s.tmp-%d" % (path, len(chunks)))
+                f = open(chunks[-1], "w")
+                chunk_bytes = 0
+
+            ts += timedelta(seconds=random.expovariate(self.lines_per_sec))
+            lines = self.event(ts, start)
+            data = "".join([line + "\n" for line in lines])
+            f.write(data)
+
+            num_lines += len(lines)
+            num_bytes += len(data)
+            chunk_bytes += len(data)
+        f.close()
+
+        files = []
+        for age, chunk in enumerate(reversed(chunks)):
+            if age == 0:
+                name = path
+            else:
+                name = "%s.%d" % (path, age)
+            os.rename(chunk, name)
+            files.append(name)
+
+        return {'files': files,
+                'lines': num_lines,
+                'bytes': num_bytes,
+                'start': str(start),
+                'end': str(ts)}
+
+    def event(self, ts, start):
+        """the lines of one thing that happened at ts"""
+        if self.log_format == 'log4j':
+            return self.log4j_event(ts)
+        elif self.log_format == 'syslog':
+            return self.syslog_event(ts)
+        else:
+            return self.gc_event(ts, start)
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def new_template(self):
+        words = [random.choice(VERBS), random.choice(WORDS)]
+        for _ in range(random.randint(1, 4)):
+            words.append(random.choice(WORDS + ["%%(%s)s" % field
+                                                for field in FIELDS]))
+        return {'class': random.choice(CLASSES),
+                'level': pick_weighted(LEVEL_WEIGHTS),
+                'text': " ".join(words),
+                'program': random.choice(SYSLOG_PROGRAMS)}
+
+    def fill(self, template):
+        values = dict((field, value()) for field, value in FIELDS.items())
+        return template['text'] % values
+
+    def log4j_event(self, ts):
+        template = random.choice(self.templates)
+        lines = ["%s,%03d %s %s: %s" % (ts.strftime("%Y-%m-%d %H:%M:%S"),
+                                        ts.microsecond / 1000,
+                                        template['level'], template['class'],
+                                        self.fill(template))]
+
+        if template['level'] in ['WARN', 'ERROR', 'FATAL'] and \
+                                    random.random() < self.stack_trace_rate:
+            lines.append("java.io.IOException: %s" % self.fill(template))
+            depth = random.randint(self.stack_depth / 2 + 1, self.stack_depth)
+            for frame in random.sample(self.frames, depth):
+                lines.append("\tat %s(%s.java:%d)" %
+                             (frame, frame.split('.')[-2],
+                              random.randint(10, 3000)))
+        return lines
+
+    def syslog_event(self, ts):
+        template = random.choice(self.templates)
+        return ["%s %2d %s %s %s[%d]: %s" % (ts.strftime("%b"), ts.day,
+                                             ts.strftime("%H:%M:%S"),
+                                             self.hostname,
+                                             template['program'],
+                                             random.randint(100, 32000),
+                                             self.fill(template))]
+
+    def gc_event(self, ts, start):
+        stamp = "%s.%03d-0700: %.3f:" % (ts.strftime("%Y-%m-%dT%H:%M:%S"),
+                                          ts.microsecond / 1000,
+                                          (ts - start).total_seconds() + 2)
+        before = random.randint(100000, 950000)
+        after = random.randint(1000, before)
+        secs = random.expovariate(20)
+
+        if random.random() < 0.02:
+            return ["%s [Full GC %s [CMS: %dK->%dK(3145728K), %.7f secs] "
+                    "%dK->%dK(4089472K), [CMS Perm : 21247K->21247K(35356K)], "
+                    "%.7f secs] [Times: user=%.2f sys=0.00, real=%.2f secs] " %
+                    (stamp, stamp.split(' ')[1], before, after, secs * 20,
+                     before, after, secs * 20, secs * 20, secs * 20)]
+
+        age = random.randint(10000, 100000000)
+        return ["%s [GC %s [ParNew" % (stamp, stamp.split(' ')[1]),
+                "Desired survivor size 53673984 bytes, new threshold %d "
+                "(max 6)" % random.randint(1, 6),
+                "- age   1: %10d bytes, %10d total" % (age, age),
+                ": %dK->%dK(943744K), %.7f secs] %dK->%dK(4089472K), %.7f "
+                "secs] [Times: user=%.2f sys=0.01, real=%.2f secs] " %
+                (before, after, secs, before, after, secs, secs * 4, secs)]
+
+def pick_weighted(weights):
+    r = random.uniform(0, sum([weight for _, weight in weights]))
+    for value, weight in weights:
+        r -= weight
+        if r <= 0:
+            return value
+    return weights[-1][0]
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] FILE")
+    parser.description = "writes synthetic logs, to benchmark and test hblog"
+    parser.add_option("--format", choices=FORMATS, default="log4j",
+        help="one of %s (default: %%default)" % ", ".join(FORMATS))
+    parser.add_option("--size-mb", type="float", default=10.0,
+        help="about this many MB of logs in all (default: %default)")
+    parser.add_option("--rotate-mb", type="float", default=0.0,
+        help="rotate the logs every this many MB, into FILE.1, FILE.2 ... "
+            "(default: %default, never)")
+    parser.add_option("--variety", type="int", default=200,
+        help="about this many different fingerprints (default: %default)")
+    parser.add_option("--stack-trace-rate", type="float", default=0.05,
+        help="the fraction of log4j WARN and worse lines that a stack trace "
+            "follows (default: %default)")
+    parser.add_option("--stack-depth", type="int", default=20,
+        help="at most this many frames in a stack trace (default: %default)")
+    parser.add_option("--lines-per-sec", type="float", default=50.0,
+        help="how often things get logged (default: %default)")
+    parser.add_option("--start", default=None,
+        help="time of the first line, as \"YYYY-MM-DD HH:MM:SS\" (default: "
+            "as long ago as it takes for the last line to be about now)")
+    parser.add_option("--seed", type="int", default=0,
+        help="for the same logs every time (default: %default)")
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Please give the FILE to write")
+
+    generator = LogGenerator(options.format,
+                             variety=options.variety,
+                             stack_trace_rate=options.stack_trace_rate,
+                             stack_depth=options.stack_depth,
+                             lines_per_sec=options.lines_per_sec,
+                             seed=options.seed)
+
+    size_bytes = int(options.size_mb * 1024 * 1024)
+    if options.start:
+        start = datetime.strptime(options.start, "%Y-%m-%d %H:%M:%S")
+    else:
+        # roughly: events take about 120 bytes on average
+        start = datetime.now() - timedelta(
+                     seconds=size_bytes / 120.0 / options.lines_per_sec)
+
+    written = generator.write(args[0], size_bytes, start,
+                              int(options.rotate_mb * 1024 * 1024))
+    sys.stdout.write("%s\n" % json.dumps(written, indent=2, sort_keys=True))
@@ -21,20 +21,47 @@ import sys
 import getopt
 import subprocess
 import time
-import copy
 import os
+import fcntl
+import termios
+import struct
+import math
+import random
 import json
 import pprint
 import urllib
+import functools
+import copy
 from datetime import datetime, timedelta
 from collections import defaultdict
 
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# What hblog does before it asks the first host, shown with --verbose
+STARTUP_PHASES = [('start', time.time())]
+
 sys.path.insert(0, SCRIPT_PATH + '/../tornado')
 import tornado.httpclient
 import tornado.ioloop
 
+try:
+    import pycurl  # keeps connections to hblogd's alive between requests
+    HTTP_CLIENT = "tornado.curl_httpclient.CurlAsyncHTTPClient"
+except ImportError:
+    HTTP_CLIENT = None  # tornado's own, which connects for every request
+
+sys.path.insert(0, SCRIPT_PATH + '/../lib')
+import WireFormat
+import SpaceSaving
+import ResultCache
+from HostTimings import HostTimings
+from StreamMerger import StreamMerger
+from PrefixIndex import PrefixIndex
+from CircuitBreaker import CircuitBreaker
+from TimeBuckets import TimeBuckets, nice_width, merge_histograms, \
+    MAX_TIME_BUCKETS
+from TierCache import TierCache
+
 def err(line):
     if not isinstance(line, basestring):
         line = pprint.pformat(line)
@@ -49,11 +76,23 @@ class HBLogEvents:
         self.options = options
         self.initial_hosts_list = list(self.options['hosts-list'])
 
-        self.http_clients_started = []
-        self.http_clients_finished = []
-        self.results_per_host = {}
+        self.host_requests = []
+        self.completed = False
+        self.missing_hosts = []
+        self.partial_hosts = set()
         self.summaries_per_host = {}
+        self.fp_summary = {}
         self.exit_state_per_host = {}
+        self.details_merger = None
+        self.num_readers = 0
+        self.follow_offsets = {}
+        self.no_batch_hosts = set()
+        self.result_cache = None
+        self.num_cached = 0
+        self.host_timings = HostTimings()
+        self.circuit_breaker = CircuitBreaker(CIRCUIT_MAX_FAILURES,
+                                              CIRCUIT_COOLDOWN_SECS,
+                                              CIRCUIT_MAX_COOLDOWN_SECS)
 
         self.io_loop = tornado.ioloop.IOLoop.instance()
 
@@ -82,7 +121,13 @@ class HBLogEvents:
         if len(self.options['fp']) > 0:
             self.http_options['fingerprints'] = ",".join(self.options['fp'])
 
-        dont_pass_to_http = ['hosts-list', 'log-tiers-hosts', 'log-tiers-globs']
+        dont_pass_to_http = ['hosts-list', 'log-tiers-hosts', 'log-tiers-globs',
+                             'histogram', 'bucket', 'bucket-secs',
+                             'max-clients', 'connect-timeout',
+                             'request-timeout', 'tier-timeouts', 'retries',
+                             'quorum', 'max-wait', 'hedge', 'relay-fanout',
+                             'tier-cache-secs', 'result-cache-mb',
+                             'hosts-file', 'host-timings-file']
         for key, val in self.options.items():
             if not key in dont_pass_to_http:
                 if hasattr(val, "__iter__") and not isinstance(val, basestring):
@@ -90,95 +135,602 @@ class HBLogEvents:
                 else:
                     self.http_options[key] = val
 
+        if self.options['mode'] == 'follow':
+            # Every host goes at its own pace; the lines of all of them are
+            # put in order for as long as they are held back, which is not
+            # for long, not to wait on an idle host
+            self.details_merger = StreamMerger(MAX_BUFFERED_LINES,
+                                               FOLLOW_REORDER_SECS)
+            tornado.ioloop.PeriodicCallback(self.print_ready_details,
+                                        FOLLOW_REORDER_SECS * 1000 / 4).start()
+        else:
+            self.details_merger = StreamMerger(MAX_BUFFERED_LINES)
+
         if self.options['mode'] == 'summary':
             self.http_options['data_type'] = "summary"
             self.http_options['tail'] = "1:00"  # last 1 min
+            self.http_options['bucket'] = self.options['bucket-secs']
 
         elif self.options['mode'] == 'details':
             self.http_options['data_type'] = "stream"
             self.http_options['tail'] = "1:00"  # last 1 min
 
-        elif self.options['mode'] == 'follow':
+        elif self.options['mode'] == 'follow' and self.options['poll']:
             self.http_options['data_type'] = "stream"
 
+        elif self.options['mode'] == 'follow':
+            self.http_options['data_type'] = "subscribe"
+            self.io_loop.add_callback(self.start_subscriptions_event)
+            return
+
+        if self.use_result_cache():
+            self.result_cache = ResultCache.ResultCache(
+                               self.options['result-cache-mb'] * 1024 * 1024,
+                               os.path.expanduser(RESULT_CACHE_DIR))
+
+        self.configure_http_client(self.options['max-clients'])
         self.io_loop.add_callback(self.start_http_clients_event)
 
+    def configure_http_client(self, max_clients):
+        """tornado queues fetches beyond max_clients"""
+        tornado.httpclient.AsyncHTTPClient.configure(HTTP_CLIENT,
+                                                     max_clients=max_clients)
+
+    def get_timeouts(self, tiers):
+        """(connect, request) timeouts, the longest of those of the tiers,
+           which ~/.hblogrc can set per tier"""
+        connect_timeout = self.options['connect-timeout']
+        request_timeout = self.options['request-timeout']
+        for tier in tiers:
+            timeouts = self.options['tier-timeouts'].get(tier.split(':')[0],
+                                                         {})
+            connect_timeout = max(connect_timeout,
+                                  timeouts.get('connect-timeout', 0))
+            request_timeout = max(request_timeout,
+                                  timeouts.get('request-timeout', 0))
+        return connect_timeout, request_timeout
+
     @exit_on_exception
     def start_http_clients_event(self):
-        self.http_clients_started = []
-        self.http_clients_finished = []
-        self.results_per_host = {}
+        self.report_startup()
+        self.host_requests = []
+        self.summaries_per_host = {}
+        self.fp_summary = {}
 
+        # The tiers of each host, to ask for all of them in one batch
+        tiers_per_host = {}
         for tier in self.options['log-tiers']:
-            for host in self.options['log-tiers-hosts'][tier]:
-                if host in self.options['hosts-list']:
-
-                    self.http_clients_started.append(host)
+            hosts = [host for host in self.options['log-tiers-hosts'][tier]
+                                     if host in self.options['hosts-list']]
+            if self.use_relays():
+                self.start_relayed_http_clients(tier, hosts)
+                continue
+            for host in hosts:
+                tiers_per_host.setdefault(host, []).append(tier)
+
+        for host, tiers in tiers_per_host.items():
+            if self.use_batch(host, tiers):
+                self.start_http_client(self.new_host_request(host, tiers), 0)
+            else:
+                for tier in tiers:
+                    self.start_http_client(
+                                   self.new_host_request(host, [tier]), 0)
 
-                    host_specific_http_options = {}
-                    for key, val in self.http_options.items():
-                        if val:
-                            host_specific_http_options[key] = val
+        if self.options['max-wait'] and self.options['mode'] != 'follow':
+            self.io_loop.add_timeout(time.time() + self.options['max-wait'],
+                                     self.complete_event)
 
-                    if 'offsets_per_host' in self.http_options:
-                        host_specific_http_options['offsets_per_host'] = None
-                        if host in self.http_options['offsets_per_host']:
-                            host_specific_http_options["universal-offset"] = \
-                                self.http_options['offsets_per_host'][host]
+        if self.options['verbose']:
+            err("Start %d / %d" % \
+                (len(self.host_requests),
+                 len(self.options['hosts-list'])))
 
-                    host_specific_http_options['glob'] = \
-                        self.options['log-tiers-globs'][tier]
+    def start_relayed_http_clients(self, tier, hosts):
+        """Every --relay-fanout hosts of the tier are asked through the
+           hblogd of the first of them, which merges their answers"""
+        fanout = self.options['relay-fanout']
+        for i in range(0, len(hosts), fanout):
+            group = hosts[i:i + fanout]
+            if len(group) == 1:
+                self.start_http_client(self.new_host_request(group[0], [tier]),
+                                       0)
+            else:
+                self.start_http_client(self.new_host_request(group[0], [tier],
+                                                             group), 0)
+
+    def new_host_request(self, host, tiers, relay_hosts=None, pushed=None):
+        """what is asked of a host, however many times it takes: retries
+           and a hedged request are the same host request. With relay_hosts
+           the host asks them, and its answer is that of all of them. pushed
+           is what the lines of --details got to, when the request takes
+           over from one that failed partway: see skip_pushed()."""
+        if relay_hosts:
+            label = "%s+%d" % (host, len(relay_hosts) - 1)
+        else:
+            label = host
+        request = {'host': host,
+                   'label': label,  # what the results are shown under
+                   'tiers': tiers,
+                   'relay-hosts': relay_hosts,
+                   'state': 'pending',  # done, failed or split per tier
+                   'in-flight': 0,
+                   'busy-retries': 0,  # apart from the retries of errors
+                   'pushed': pushed or {},  # per glob, see skip_pushed()
+                   'timing': None}  # of HostTimings, shared with a hedge
+        self.host_requests.append(request)
+        return request
+
+    def use_relays(self):
+        """--follow asks every host itself, its offsets are per host"""
+        return self.options['relay-fanout'] > 1 and \
+               self.options['mode'] != 'follow'
+
+    def use_batch(self, host, tiers):
+        """Several tiers of a host go in one request to /log/batch, except
+           for --follow, whose offsets are per glob, and for hosts whose
+           hblogd is too old to have it"""
+        return len(tiers) > 1 and self.options['mode'] != 'follow' and \
+               host not in self.no_batch_hosts
+
+    def start_http_client(self, request, attempt, hedged=False):
+        host = request['host']
+        tiers = request['tiers']
+        host_specific_http_options = self.get_host_specific_http_options()
+
+        offset = self.follow_offsets.get((host, ",".join(tiers)))
+        if offset:
+            host_specific_http_options["universal-offset"] = offset
+
+        globs = []
+        for tier in tiers:
+            if self.options['log-tiers-globs'][tier] not in globs:
+                globs.append(self.options['log-tiers-globs'][tier])
+        host_specific_http_options['glob'] = ",".join(globs)
+
+        connect_timeout, request_timeout = self.get_timeouts(tiers)
+        host_specific_http_options['deadline-secs'] = max(
+                                      request_timeout - DEADLINE_MARGIN_SECS,
+                                      request_timeout / 2)
+
+        if request['relay-hosts']:
+            endpoint = "relay"
+            host_specific_http_options['relay-hosts'] = \
+                                             ",".join(request['relay-hosts'])
+            host_specific_http_options['relay-endpoint'] = \
+                                             self.http_options['data_type']
+            host_specific_http_options['relay-connect-timeout'] = \
+                                             connect_timeout
+        elif len(tiers) > 1:
+            endpoint = "batch"
+        else:
+            endpoint = self.http_options['data_type']
 
-                    url = "http://%s:6957/log/%s?%s" % \
-                                  (host,
-                                   self.http_options['data_type'],
-                                   urllib.urlencode(host_specific_http_options))
+        url = "http://%s/log/%s?%s" % \
+                      (WireFormat.host_port(host),
+                       endpoint,
+                       urllib.urlencode(host_specific_http_options))
 
-                    if self.options['verbose']:
-                        err("URL: %s" % url)
+        if self.options['verbose']:
+            err("URL: %s" % url)
 
-                    http_client = tornado.httpclient.AsyncHTTPClient()
-                    http_client.fetch(url, self.finish_http_client_event,
-                                         connect_timeout=2.0,
-                                         request_timeout=20.0)
+        # Decompress and decode ourselves rather than let tornado do it, as
+        # the bytes come off the wire, so that only the merged results and
+        # not the bodies of all hosts are held on to
+        tiers_per_glob = {}
+        for tier in tiers:
+            tiers_per_glob.setdefault(self.options['log-tiers-globs'][tier],
+                                      []).append(tier)
 
+        # The streams of --follow go on from one poll to the next
+        if self.options['mode'] == 'follow':
+            stream_id = host
+        else:
+            self.num_readers += 1
+            stream_id = self.num_readers
+
+        reader = {'content-decoder': WireFormat.ContentDecoder(),
+                  'package-reader': WireFormat.PackageReader(),
+                  'frame-decoder': WireFormat.FrameDecoder(),
+                  'host': host,
+                  'tiers-per-glob': tiers_per_glob,
+                  'tier': ",".join(tiers),
+                  'stream': (stream_id, globs[0]),
+                  'summary': None,
+                  'exit-states': [],
+                  'num-records': 0,
+                  'decode-secs': 0.0,
+                  'cache-key': None,
+                  'cache-body': None,  # what to keep in the result cache
+                  'cache-bytes': 0,
+                  'filter': None,      # to narrow a cached result down by
+                  'timing': None,
+                  'pushed': request['pushed'],
+                  'skip': copy.deepcopy(request['pushed'])}
+
+        # Each glob is a stream of its own, in order of time
+        if self.http_options['data_type'] != "summary":
+            for glob in globs:
+                if not self.details_merger.is_open((stream_id, glob)):
+                    self.details_merger.open((stream_id, glob))
+
+        if self.result_cache:
+            reader['cache-key'] = self.get_result_cache_key(request, globs)
+            cached = self.result_cache.get(reader['cache-key'],
+                                           self.http_options['data_type'],
+                                           self.get_filter())
+            if cached:
+                self.replay_cached_result(request, attempt, reader, cached,
+                                          url)
+                return
+            reader['cache-body'] = []
+
+        request['in-flight'] += 1
+        if not hedged:
+            request['timing'] = self.host_timings.start(host)
+
+            if self.options['hedge'] and \
+                                 self.http_options['data_type'] == "summary":
+                self.io_loop.add_timeout(time.time() + self.options['hedge'],
+                        functools.partial(self.hedge_event, request))
+
+        reader['timing'] = request['timing']
+
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        http_client.fetch(url,
+             functools.partial(self.finish_http_client_event,
+                               request, attempt, reader),
+             connect_timeout=connect_timeout,
+             request_timeout=request_timeout,
+             use_gzip=False,
+             headers=self.get_compression_headers(),
+             header_callback=functools.partial(self.header_line_event,
+                                               request['timing'],
+                                               reader['content-decoder']),
+             streaming_callback=functools.partial(self.http_data_event,
+                                                  reader))
+
+    def use_result_cache(self):
+        """Only a window that is over gets the same answer when asked
+           again, and a sampled one never does"""
+        settled = datetime.now() - timedelta(seconds=RESULT_CACHE_SETTLE_SECS)
+        return self.options['result-cache-mb'] > 0 and \
+               self.options['mode'] != 'follow' and \
+               self.options['sample'] >= 1 and \
+               self.options['end'] < settled
+
+    def get_result_cache_key(self, request, globs):
+        """what the answer of the host is about, less the filters"""
+        return ('result',
+                request['host'],
+                tuple(request['relay-hosts'] or []),
+                tuple(request['tiers']),
+                tuple(globs),
+                self.http_options['data_type'],
+                str(self.options['start']),
+                str(self.options['end']),
+                self.options['bucket-secs'],
+                self.options['limit'],
+                self.options['wire-format'])
+
+    def get_filter(self):
+        return dict((key, self.options[key])
+                                        for key in ResultCache.FILTER_KEYS)
+
+    def replay_cached_result(self, request, attempt, reader, cached, url):
+        """answers the request from the result cache, as the host did"""
+        if cached['filter'] != self.get_filter():
+            reader['filter'] = self.get_filter()
+        self.num_cached += 1
         if self.options['verbose']:
-            err("Start %d / %d" % \
-                (len(self.http_clients_started),
-                 len(self.options['hosts-list'])))
+            err("CACHE: answering %s from the result cache" % url)
+
+        request['in-flight'] += 1
+        request['timing'] = self.host_timings.start(request['host'])
+        reader['timing'] = request['timing']
+        self.http_data_event(reader, cached['body'].encode('utf-8'))
 
-    def finish_http_client_event(self, response):
-        host = response.request.url.replace('http://', '').split(':')[0]
+        # once all the requests are started, as for an answer off the wire
+        response = tornado.httpclient.HTTPResponse(
+                              tornado.httpclient.HTTPRequest(url), 200,
+                              request_time=0.0)
+        self.io_loop.add_callback(functools.partial(
+                              self.finish_http_client_event,
+                              request, attempt, reader, response))
+
+    @exit_on_exception
+    def hedge_event(self, request):
+        """the host is slow to answer: ask it again, and take whichever
+           answer comes first. Only summaries are hedged, the lines of
+           --details are printed as they come."""
+        if self.completed or request['state'] != 'pending' or \
+                                                    request['in-flight'] != 1:
+            return
 
         if self.options['verbose']:
-            err("Processing: %s" % host)
+            err("HEDGE: asking %s again" % request['host'])
+        self.start_http_client(request, 0, hedged=True)
 
-        if response.error:
-            err("WARN: HTTP error from %s, blacklisting host. Error was %s." % \
-                                                         (host, response.error))
+    def get_retry_delay(self, host, attempt):
+        """exponential backoff, with jitter so that hosts that failed
+           together are not all asked again together, and no sooner than
+           the circuit breaker lets the host be asked"""
+        backoff = min(RETRY_BACKOFF_SECS * 2 ** attempt,
+                      MAX_RETRY_BACKOFF_SECS) * random.uniform(0.5, 1.0)
+        return max(backoff, self.circuit_breaker.get_wait(host))
 
-            if host in self.options['hosts-list']:
-                self.options['hosts-list'].remove(host)
+    def header_line_event(self, request_timing, content_decoder, line):
+        self.host_timings.first_byte(request_timing)
+        content_decoder.header_line(line)
 
-            if host in self.http_clients_started:
-                self.http_clients_started.remove(host)  # As if it never started
-                                                        # to halp check for the
-                                                        # last http_client reach
-        else:
-            if host not in self.results_per_host.keys():
-                self.results_per_host[host] = []
+    @exit_on_exception
+    def http_data_event(self, reader, chunk):
+        data = reader['content-decoder'].decompress(chunk)
+        t0 = time.clock()
+
+        if reader['cache-body'] is not None:
+            reader['cache-body'].append(data)
+            reader['cache-bytes'] += len(data)
+            if reader['cache-bytes'] > self.result_cache.max_bytes:
+                reader['cache-body'] = None  # too big to keep
+
+        # Results are tagged by tier; those of a batch come per glob
+        for line_pkg in reader['package-reader'].feed(data):
+            if line_pkg['pkg-cls'] == 'batch-glob':
+                glob = line_pkg['pkg-obj']['glob']
+                reader['tier'] = ",".join(reader['tiers-per-glob'][glob])
+                if reader['stream'][1] != glob:
+                    self.details_merger.close(reader['stream'])
+                    reader['stream'] = (reader['stream'][0], glob)
+            elif line_pkg['pkg-cls'] == 'log-accessor-line':
+                if self.http_options['data_type'] == "summary":
+                    if reader['summary'] is None:
+                        reader['summary'] = {'fp': {},
+                                             'level': defaultdict(int)}
+                    self.merge_host_summary(reader['summary'],
+                                            line_pkg['pkg-obj'])
+                else:
+                    self.push_details(reader, [line_pkg['pkg-obj']])
+                reader['num-records'] += 1
+            elif line_pkg['pkg-cls'] == 'log-accessor-frame':
+                recs = reader['frame-decoder'].decode(line_pkg['pkg-obj'])
+                self.push_details(reader, recs)
+                reader['num-records'] += len(recs)
+            elif line_pkg['pkg-cls'] == 'exit-status':
+                reader['exit-states'].append((reader['tier'],
+                                              line_pkg['pkg-obj']))
+
+        reader['decode-secs'] += time.clock() - t0
+
+        if self.http_options['data_type'] != "summary":
+            self.print_ready_details()
+
+    def push_details(self, reader, records):
+        if reader['filter']:
+            records = [rec for rec in records
+                              if ResultCache.take_line(rec, reader['filter'])]
+        for rec in records:
+            rec.setdefault('host', reader['host'])  # relays send it
+            rec['tier'] = reader['tier']
+        if self.options['mode'] == 'details':
+            records = self.skip_pushed(reader, records)
+        self.details_merger.push(reader['stream'], records)
+
+    def skip_pushed(self, reader, records):
+        """--details prints the lines as they come: a host asked again
+           after it failed partway sends the lines it sent before again, and
+           those are left out. Per glob, as the lines of each glob of a
+           batch are in order of time of their own."""
+        glob = reader['stream'][1]
+        skip = reader['skip'].get(glob)
+        pushed = reader['pushed'].setdefault(glob, {'ts': None, 'at-ts': {}})
+
+        fresh = []
+        for rec in records:
+            key = (rec['host'], rec['text'])
+            if skip and rec['ts'] <= skip['ts']:
+                if rec['ts'] < skip['ts'] or skip['at-ts'].get(key):
+                    if rec['ts'] == skip['ts']:
+                        skip['at-ts'][key] -= 1
+                    continue
+
+            fresh.append(rec)
+            if rec['ts'] != pushed['ts']:
+                pushed['ts'] = rec['ts']
+                pushed['at-ts'] = {}
+            pushed['at-ts'][key] = pushed['at-ts'].get(key, 0) + 1
+        return fresh
+
+    def close_details(self, reader):
+        """the streams of a request are done, be it that it finished,
+           failed or is to be retried, or for --follow, that its host
+           failed"""
+        if self.http_options['data_type'] != "summary":
+            for glob in reader['tiers-per-glob']:
+                self.details_merger.close((reader['stream'][0], glob))
+
+    def merge_host_summary(self, summary_merged, s):
+        """merges summary s, of one glob of a host, into summary_merged"""
+        for fp_key, value in s['fp'].iteritems():
+            merged = summary_merged['fp'].get(fp_key)
+            if merged is not None:
+                merged['count'] += value['count']
+                merge_histograms(merged.setdefault('histogram', {}),
+                                 value.get('histogram', {}))
+            else:
+                summary_merged['fp'][fp_key] = value
+
+        for level_key, count in s['level'].iteritems():
+            summary_merged['level'][level_key] += count
+
+        if 'sketch' in s:  # a bounded summary
+            summary_merged['sketch'] = s['sketch']
+
+    def merge_fp_summary(self, summary):
+        """merges the fingerprints of a host's summary into those of all
+           hosts, as it comes in"""
+        for fp, value in summary['fp'].iteritems():
+            merged = self.fp_summary.get(fp)
+            if merged is None:
+                # the host's own entries get merged into, so not shared
+                merged = dict(value)
+                if 'histogram' in value:
+                    merged['histogram'] = dict(value['histogram'])
+                self.fp_summary[fp] = merged
+            else:
+                merged['count'] += value['count']
+                if 'histogram' in value:
+                    merge_histograms(merged.setdefault('histogram', {}),
+                                     value['histogram'])
+
+    def get_host_specific_http_options(self):
+        host_specific_http_options = {}
+        for key, val in self.http_options.items():
+            if val:
+                host_specific_http_options[key] = val
+        return host_specific_http_options
+
+    def get_compression_headers(self):
+        headers = {}
+        if self.options['compress'] != 'none':
+            headers['Accept-Encoding'] = self.options['compress']
+        return headers
+
+    def report_startup(self):
+        """what it took to get to asking the first host"""
+        startup_phase('event loop')
+        if not self.options['verbose']:
+            return
+
+        phases = ["%s %.0fms" % (name, 1000 * (t - t_before)) for
+                            (_, t_before), (name, t) in zip(STARTUP_PHASES,
+                                                            STARTUP_PHASES[1:])]
+        err("STARTUP: first request %.0fms after start: %s" %
+            (1000 * (STARTUP_PHASES[-1][1] - STARTUP_PHASES[0][1]),
+             ", ".join(phases)))
+
+    @exit_on_exception
+    def start_subscriptions_event(self):
+        self.report_startup()
+        subscriptions = []
+        for tier in self.options['log-tiers']:
+            for host in self.options['log-tiers-hosts'][tier]:
+                if host in self.options['hosts-list']:
+                    subscriptions.append((tier, host))
+
+        # Subscriptions hold on to their connection
+        self.configure_http_client(max(self.options['max-clients'],
+                                       len(subscriptions)))
+
+        for tier, host in subscriptions:
+            self.subscribe(tier, host, None)
 
-            for line in response.body.split("\n"):
-                if len(line) > 0:
-                    line_pkg = self.import_from_json(line)
-                    if line_pkg['pkg-cls'] == 'log-accessor-line':
-                        self.results_per_host[host].append(line_pkg['pkg-obj'])
-                    elif line_pkg['pkg-cls'] == 'exit-status':
-                        self.exit_state_per_host[host] = line_pkg['pkg-obj']
-                        if self.options['verbose']:
-                            err("STATUS: %s %s" % (host, line_pkg['pkg-obj']))
+        if self.options['verbose']:
+            err("Subscribed %d / %d" % \
+                (len(subscriptions), len(self.options['hosts-list'])))
+
+    def subscribe(self, tier, host, universal_offset, last_ts=None,
+                  attempt=0):
+        host_specific_http_options = self.get_host_specific_http_options()
+        glob = self.options['log-tiers-globs'][tier]
+        host_specific_http_options['glob'] = glob
+        if universal_offset:
+            host_specific_http_options["universal-offset"] = \
+                        WireFormat.universal_offset_to_token(universal_offset)
+        if last_ts:
+            # where hblogd goes, should it not find the universal offset
+            host_specific_http_options["start"] = last_ts
+
+        url = "http://%s/log/subscribe?%s" % \
+                          (WireFormat.host_port(host),
+                           urllib.urlencode(host_specific_http_options))
+
+        if self.options['verbose']:
+            err("URL: %s" % url)
+
+        if not self.details_merger.is_open((host, glob)):
+            self.details_merger.open((host, glob))
+
+        subscription = {'content-decoder': WireFormat.ContentDecoder(),
+                        'package-reader': WireFormat.PackageReader(),
+                        'frame-decoder': WireFormat.FrameDecoder(),
+                        'universal-offset': universal_offset,
+                        'last-ts': last_ts,
+                        'attempt': attempt}
+
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        http_client.fetch(url,
+             functools.partial(self.finish_subscription_event,
+                               tier, host, subscription),
+             connect_timeout=self.get_timeouts([tier])[0],
+             request_timeout=SUBSCRIPTION_TIMEOUT,
+             use_gzip=False,
+             headers=self.get_compression_headers(),
+             header_callback=subscription['content-decoder'].header_line,
+             streaming_callback=functools.partial(
+                       self.subscription_data_event, tier, host, subscription))
+
+    @exit_on_exception
+    def subscription_data_event(self, tier, host, subscription, chunk):
+        data = subscription['content-decoder'].decompress(chunk)
+
+        records = []
+        for line_pkg in subscription['package-reader'].feed(data):
+            if line_pkg['pkg-cls'] == 'log-accessor-line':
+                records.append(line_pkg['pkg-obj'])
+            elif line_pkg['pkg-cls'] == 'log-accessor-frame':
+                records.extend(
+                    subscription['frame-decoder'].decode(line_pkg['pkg-obj']))
+            elif line_pkg['pkg-cls'] in ['cursor', 'heartbeat']:
+                subscription['universal-offset'] = \
+                                           line_pkg['pkg-obj']['universal-offset']
+
+        if records:
+            records.sort(key=lambda x: x['ts'])
+            for l in records:
+                l['host'] = host
+            subscription['last-ts'] = records[-1]['ts']
+            self.details_merger.push(
+                   (host, self.options['log-tiers-globs'][tier]), records)
 
-            self.http_clients_finished.append(response)
+        self.print_ready_details()
+
+    @exit_on_exception
+    def finish_subscription_event(self, tier, host, subscription, response):
+        if response.code == 404:
+            self.blacklist_host(host, "hblogd does not support subscriptions, "
+                                      "try --follow with --poll")
+            self.details_merger.close(
+                                (host, self.options['log-tiers-globs'][tier]))
+        elif response.error:
+            # --follow keeps at it, however long the host is down
+            attempt = subscription['attempt']
+            if self.circuit_breaker.failure(host):
+                err("WARN: %s keeps failing, leaving it alone for %.0fs" %
+                    (host, self.circuit_breaker.get_wait(host)))
+            delay = self.get_retry_delay(host, attempt)
+            err("WARN: HTTP error from %s, resubscribing in %.1fs. Error was "
+                "%s." % (host, delay, response.error))
+            self.io_loop.add_timeout(time.time() + delay,
+                        functools.partial(self.subscribe, tier, host,
+                                          subscription['universal-offset'],
+                                          subscription['last-ts'],
+                                          attempt + 1))
+        else:
+            # hblogd ended the subscription, e.g. its logs went away
+            self.circuit_breaker.success(host)
+            if self.options['verbose']:
+                err("Resubscribing: %s" % host)
+            self.io_loop.add_timeout(time.time() + 1.0,
+                        functools.partial(self.subscribe, tier, host,
+                                          subscription['universal-offset'],
+                                          subscription['last-ts']))
+
+    def blacklist_host(self, host, error):
+        err("WARN: HTTP error from %s, blacklisting host. Error was %s." % \
+                                                                  (host, error))
+
+        if host in self.options['hosts-list']:
+            self.options['hosts-list'].remove(host)
 
         if len(self.options['hosts-list']) == 0:
             msg = "All %d hosts got blacklisted" % len(self.initial_hosts_list)
@@ -189,49 +741,200 @@ class HBLogEvents:
             err("ERROR: %s" % msg)
             tornado.ioloop.IOLoop.instance().stop()
 
-        #
-        # Did we reach the last http_client ?
-        #
-        if len(self.http_clients_finished) >= len(self.http_clients_started):
-            if self.options['mode'] == 'details' or \
-                                               self.options['mode'] == 'follow':
-                self.io_loop.add_callback(self.print_details_event)
+    def finish_http_client_event(self, request, attempt, reader, response):
+        host = request['host']
+        label = request['label']
+        tiers = request['tiers']
+        request['in-flight'] -= 1
 
-            else:
-                assert self.http_options['data_type'] == "summary", \
-                       "Wrong HTTP datatype %s, expected 'summary'" % \
-                       (self.http_options['data_type'])
+        if self.options['mode'] != 'follow':
+            self.close_details(reader)
 
-                for host, summary in self.results_per_host.items():
-                    if self.options['verbose']:
-                        err("Host:")
-                        err(host)
+        if self.completed or request['state'] != 'pending':
+            # too late, or the other one of a hedged pair answered first
+            return
 
-                        err("Results:")
-                        err(pprint.pformat(summary))
+        if response.error and request['in-flight'] > 0:
+            # the other one of a hedged pair may still answer
+            return
 
-                    if len(summary) == 0:
-                        err("ERROR: Got an empty list for the host summary")
-                        tornado.ioloop.IOLoop.instance().stop()
+        if self.options['verbose']:
+            err("Processing: %s" % host)
+
+        if response.error:
+            self.host_timings.finish(reader['timing'],
+                                     response.request_time, 0.0, 0)
+
+        if response.code == 404 and len(tiers) > 1:
+            # an older hblogd, without /log/batch: one request per tier
+            self.no_batch_hosts.add(host)
+            request['state'] = 'split'
+            for tier in tiers:
+                self.start_http_client(self.new_host_request(host, [tier]), 0)
+            return
+
+        if response.error and request['relay-hosts']:
+            # e.g. an older hblogd without /log/relay, or the relay is down:
+            # the hosts are asked directly, each retried on its own
+            if response.code != 404:
+                err("WARN: relay %s failed, asking its hosts directly. "
+                    "Error was %s." % (host, response.error))
+            request['state'] = 'split'
+            for relay_host in request['relay-hosts']:
+                self.start_http_client(self.new_host_request(relay_host, tiers,
+                                   pushed=copy.deepcopy(request['pushed'])), 0)
+            return
+
+        if response.code == 503 and request['busy-retries'] < MAX_BUSY_RETRIES:
+            # hblogd is over its budgets, it is not down
+            try:
+                retry_after = min(int(response.headers.get("Retry-After", 1)),
+                                  MAX_RETRY_AFTER_SECS)
+            except ValueError:
+                retry_after = 1
+            err("WARN: %s is busy, retrying in %ds" % (host, retry_after))
+            request['busy-retries'] += 1
+            self.io_loop.add_timeout(time.time() + retry_after,
+                 functools.partial(self.start_http_client, request, attempt))
+            return
+
+        if response.error:
+            if self.retry_host_request(request, attempt, response.error):
+                return
+            self.close_details(reader)
+        else:
+            request['state'] = 'done'
+            self.circuit_breaker.success(host)
+            content_decoder = reader['content-decoder']
+
+            # Old hblogd's don't send the header, and only speak json
+            wire_format = response.headers.get("X-Hblog-Wire-Format", "json")
+
+            for tier, exit_state in reader['exit-states']:
+                self.exit_state_per_host[label] = exit_state
+                if self.options['mode'] == 'follow':
+                    self.follow_offsets[(host, tier)] = \
+                        WireFormat.universal_offset_to_token(
+                                              exit_state['universal-offset'])
+                if self.options['verbose']:
+                    err("STATUS: %s %s %s" % (label, tier, exit_state))
+                if exit_state['status'] == 'truncated':
+                    self.partial_hosts.add(label)
+                    err("WARN: %s %s only returned part of the lines, "
+                        "it stopped scanning: %s" %
+                        (label, tier, exit_state['reason']))
+                    if 'scanned-until' in exit_state:
+                        err("WARN: %s %s lines after %s are missing" %
+                            (label, tier, exit_state['scanned-until']))
+
+            if self.http_options['data_type'] == "summary":
+                if reader['summary'] is None:
+                    err("ERROR: Got an empty list for the host summary")
+                    tornado.ioloop.IOLoop.instance().stop()
+                    return
+
+                if not self.options['limit']:
+                    self.merge_fp_summary(reader['summary'])
+
+                if label in self.summaries_per_host:
+                    # more than one request to this host, e.g. per tier
+                    self.merge_host_summary(self.summaries_per_host[label],
+                                            reader['summary'])
+                else:
+                    self.summaries_per_host[label] = reader['summary']
 
-                    #  Merge summaries of a single host
-                    summary_merged = {'fp': {}, 'level': defaultdict(int)}
-                    for s in summary:
-                        for fp_key in s['fp'].keys():
-                            if fp_key in summary_merged['fp'].keys():
-                                summary_merged['fp'][fp_key]['count'] += \
-                                                        s['fp'][fp_key]['count']
-                            else:
-                                summary_merged['fp'][fp_key] = s['fp'][fp_key]
+            if reader['cache-body'] is not None and reader['exit-states'] \
+                    and all([exit_state['status'] == 'success'
+                             for _, exit_state in reader['exit-states']]):
+                self.result_cache.put(reader['cache-key'], self.get_filter(),
+                                      "".join(reader['cache-body']))
 
-                        for level_key in s['level'].keys():
-                            summary_merged['level'][level_key] += \
-                                                           s['level'][level_key]
+            self.host_timings.finish(reader['timing'], response.request_time,
+                                     reader['decode-secs'],
+                                     content_decoder.bytes_in)
 
-                    # Summaries are one-line per result
-                    self.summaries_per_host[host] = summary_merged
+            if self.options['verbose']:
+                err("WIRE: %s %s %s" % (host, wire_format,
+                    WireFormat.get_stats(reader['num-records'],
+                                         content_decoder.bytes_out,
+                                         reader['decode-secs'])))
+                err("COMPRESSION: %s %s" % (host, content_decoder.get_stats()))
 
-                self.io_loop.add_callback(self.print_summary_event)
+        if self.options['mode'] == 'follow':
+            # Each host polls again at its own pace, not that of the slowest
+            if host in self.options['hosts-list']:
+                request['state'] = 'pending'
+                self.io_loop.add_timeout(time.time() + POLL_INTERVAL_SECS,
+                     functools.partial(self.start_http_client, request, 0))
+            return
+
+        #
+        # Did we hear from enough hosts ?
+        #
+        requests = [r for r in self.host_requests if r['state'] != 'split']
+        num_done = len([r for r in requests if r['state'] == 'done'])
+        num_pending = len([r for r in requests if r['state'] == 'pending'])
+        quorum = math.ceil(len(requests) * self.options['quorum'] / 100.0)
+        if num_pending == 0 or num_done >= quorum:
+            self.complete_event()
+
+    def retry_host_request(self, request, attempt, error):
+        """True if the host gets asked again after the error, False if it
+           gets blacklisted instead"""
+        host = request['host']
+        if self.circuit_breaker.failure(host):
+            err("WARN: %s keeps failing, leaving it alone for %.0fs" %
+                (host, self.circuit_breaker.get_wait(host)))
+
+        if self.options['mode'] != 'follow' and \
+                (attempt >= self.options['retries'] or
+                 self.circuit_breaker.is_open(host)):
+            request['state'] = 'failed'
+            self.blacklist_host(host, error)
+            return False
+
+        # --follow keeps at it, however long the host is down
+        delay = self.get_retry_delay(host, attempt)
+        err("WARN: HTTP error from %s, retrying in %.1fs. Error was %s." %
+            (host, delay, error))
+        self.io_loop.add_timeout(time.time() + delay,
+                 functools.partial(self.start_http_client, request,
+                                   attempt + 1))
+        return True
+
+    @exit_on_exception
+    def complete_event(self):
+        """shows the results, of all hosts, or of those that answered in
+           time with --quorum or --max-wait"""
+        if self.completed:
+            return
+        self.completed = True
+
+        self.missing_hosts = sorted(set([r['label'] for r in self.host_requests
+                                         if r['state'] == 'pending']))
+
+        if self.num_cached:
+            err("NOTICE: %d requests answered from the result cache in %s, "
+                "as the hosts answered them before" %
+                (self.num_cached, RESULT_CACHE_DIR))
+
+        if self.options['mode'] == 'details':
+            self.details_merger.close_all()
+            self.io_loop.add_callback(self.print_details_event)
+        else:
+            assert self.http_options['data_type'] == "summary", \
+                   "Wrong HTTP datatype %s, expected 'summary'" % \
+                   (self.http_options['data_type'])
+
+            if self.options['verbose']:
+                for host, summary in self.summaries_per_host.items():
+                    err("Host:")
+                    err(host)
+
+                    err("Results:")
+                    err(pprint.pformat(summary))
+
+            self.io_loop.add_callback(self.print_summary_event)
 
     @exit_on_return
     @exit_on_exception
@@ -239,15 +942,18 @@ class HBLogEvents:
         EXCEPTIONS = {}
 
         print_fingerprints = []
-        fp_summary = {}
 
-        for host, summary in self.summaries_per_host.items():
-            for fp in summary['fp'].keys():
-                value = summary['fp'][fp]
-                if fp not in fp_summary:
-                    fp_summary[fp] = copy.deepcopy(value)
-                else:
-                    fp_summary[fp]['count'] += value['count']
+        if self.options['limit']:
+            # Bounded no matter how many fingerprints the hosts have
+            space_saving = SpaceSaving.SpaceSaving(self.options['limit'])
+            for host, summary in self.summaries_per_host.items():
+                space_saving.merge(SpaceSaving.from_summary(summary,
+                                                        self.options['limit']))
+            fp_summary = space_saving.get_entries()
+        else:
+            # merged as the hosts came in
+            space_saving = None
+            fp_summary = self.fp_summary
 
         print("---------------------------------------------------------------")
         print("Fingerprint summary:")
@@ -258,8 +964,27 @@ class HBLogEvents:
         else:
             print "No matching lines found"
 
-        summary_width = TERMINAL_WIDTH - 34
-        for l in sorted(fp_summary.values(), reverse=True):
+        if space_saving and space_saving.dropped_fps:
+            print "Top %d fingerprints only, %d lines of less frequent " \
+                  "ones left out. Counts may be low by up to %d." % \
+                  (len(fp_summary), space_saving.dropped_count,
+                   space_saving.min_count)
+            print
+
+        if self.options['bucket-secs'] and fp_summary:
+            time_buckets = TimeBuckets(self.options['bucket-secs'])
+            buckets = time_buckets.get_range(str(self.options['start']),
+                                             str(self.options['end']))
+            print "Histograms of %d buckets of %ds from %s, each scaled " \
+                  "to its busiest bucket" % \
+                  (len(buckets), self.options['bucket-secs'], buckets[0])
+            print
+        else:
+            buckets = None
+
+        summary_width = get_terminal_width() - 34
+        by_count = lambda l: (l['count'], l.get('error', 0), l['fp'])
+        for l in sorted(fp_summary.values(), key=by_count, reverse=True):
             l['norm_text'] = l['norm_text'].replace('\t', '\\t')  # show tabs
 
             # Truncate fingerprints
@@ -275,12 +1000,19 @@ class HBLogEvents:
                 print l['norm_text'][i: i + summary_width]
                 i += summary_width
 
+            if buckets:
+                spark = sparkline([l.get('histogram', {}).get(bucket, 0)
+                                                        for bucket in buckets])
+                for i in range(0, len(spark), summary_width):
+                    print "%29s" % "",
+                    print spark[i: i + summary_width].encode('utf-8')
+
         print("---------------------------------------------------------------")
         print "Host sumary: "
         if self.options['fp']:
             print_fingerprints = self.options['fp']
         else:
-            how_many_fps_will_fit = (TERMINAL_WIDTH - 19) / 11
+            how_many_fps_will_fit = (get_terminal_width() - 19) / 11
             print_fingerprints = print_fingerprints[:how_many_fps_will_fit]
 
         if len(print_fingerprints) > 0:
@@ -292,14 +1024,23 @@ class HBLogEvents:
             print
             print
 
+            # The fingerprints each column may stand for, of any host
+            all_fps = set()
+            for summaries in self.summaries_per_host.values():
+                all_fps.update(summaries['fp'])
+            fp_index = PrefixIndex(all_fps)
+            columns = [(fp, fp_index.find(fp)) for fp in print_fingerprints]
+
             for host, summaries in sorted(self.summaries_per_host.items()):
                 fp_summary = summaries['fp']
 
-                if len(fp_summary.keys()) > 0:
-                    print "%16.16s" % host,
-                    for fp in print_fingerprints:
-                        fp_matches = [i for i in fp_summary.keys() if
-                                                             i.startswith(fp)]
+                if len(fp_summary) > 0:
+                    if host in self.partial_hosts:
+                        print "%15.15s*" % host,
+                    else:
+                        print "%16.16s" % host,
+                    for fp, column_fps in columns:
+                        fp_matches = [i for i in column_fps if i in fp_summary]
                         if len(fp_matches) == 1:
                             print "%10d" % fp_summary[fp_matches[0]]['count'],
                         elif len(fp_matches) > 1:
@@ -309,49 +1050,53 @@ class HBLogEvents:
                             print "%10.10s" % "",
                     print
 
+            for host in self.missing_hosts:
+                print "%16.16s %10s" % (host, "(missing)")
+
         print("---------------------------------------------------------------")
         print
         for host, exc in sorted(EXCEPTIONS.items()):
             print "%-30.30s    %s" % (host, exc)
 
         self.report_blacklisted_hosts()
+        self.report_incomplete_hosts()
+        self.report_host_timings()
 
     @exit_on_exception
     def print_details_event(self):
-        all = []
-        for host, results in self.results_per_host.items():
-            for l in results:
-                l['host'] = host
-                all.append(l)
+        # All hosts are done, nothing is held back anymore
+        self.print_ready_details()
 
-        for l in sorted(all, key=lambda x: x['ts']):
-            l['text'] = l['text'].replace('\t', '\\t')  # show tabs
+        if self.options['verbose'] and self.details_merger.num_forced:
+            err("WARN: %d lines were printed ahead of slower hosts, and may be "
+                "out of order" % self.details_merger.num_forced)
 
-            # Truncate fingerprints
-            l['fp'] = l['fp'][0:7]
+        self.report_blacklisted_hosts()
+        self.report_incomplete_hosts()
+        sys.stdout.flush()
 
-            line = " ".join([l['ts'], l['fp'], l['level'].ljust(5), l['host'],
-                            l['text']])
-            if self.options['nowrap']:
-                print line[0:TERMINAL_WIDTH]
-            else:
-                print line
+        self.report_host_timings()
+        tornado.ioloop.IOLoop.instance().stop()
 
-        self.report_blacklisted_hosts()
+    def print_ready_details(self):
+        """prints the lines that no host can send earlier ones than
+           anymore"""
+        for l in self.details_merger.pop_ready():
+            self.print_details_line(l)
         sys.stdout.flush()
 
-        if self.options['mode'] == 'follow':
-            # Update offsets
-            self.http_options['offsets_per_host'] = {}
-            for host, exit_state in self.exit_state_per_host.items():
-                uo = exit_state['universal-offset']
-                self.http_options['offsets_per_host'][host] = \
-                    "%s:%s" % (uo['filename'], uo['byte_offset'])
-
-            time.sleep(0.5)
-            self.io_loop.add_callback(self.start_http_clients_event)
+    def print_details_line(self, l):
+        l['text'] = l['text'].replace('\t', '\\t')  # show tabs
+
+        # Truncate fingerprints
+        l['fp'] = l['fp'][0:7]
+
+        line = " ".join([l['ts'], l['fp'], l['level'].ljust(5), l['host'],
+                        l['text']])
+        if self.options['nowrap']:
+            print line[0:get_terminal_width()]
         else:
-            tornado.ioloop.IOLoop.instance().stop()
+            print line
 
     def report_blacklisted_hosts(self):
         blacklisted_hosts = \
@@ -369,30 +1114,131 @@ class HBLogEvents:
                           ])
 
             if self.options['nowrap']:
-                print line[0:TERMINAL_WIDTH]
+                print line[0:get_terminal_width()]
             else:
                 print line
 
-    def convert_keys_to_no_unicode(self, input_struct):
-        if isinstance(input_struct, dict):
-            return dict([(key.encode('utf-8'), value) for key, value in \
-                                                      input_struct.iteritems()])
-        elif isinstance(input_struct, list):
-            return [self.convert_keys_to_no_unicode(element) for element in \
-                                                                   input_struct]
+    def report_incomplete_hosts(self):
+        """hosts whose lines are not all in the results: those that did not
+           answer before --quorum or --max-wait, and those that stopped
+           scanning early"""
+        lines = []
+        if self.missing_hosts:
+            lines.append(['MISSING01', 'Missing %d hosts (of %d in this '
+                          'session): %s - they had not answered yet, their '
+                          'lines are left out' %
+                          (len(self.missing_hosts),
+                           len(self.initial_hosts_list),
+                           self.missing_hosts)])
+        if self.partial_hosts:
+            lines.append(['PARTIAL01', 'Partial results from %d hosts '
+                          '(marked * in the host summary): %s - they stopped '
+                          'scanning early, some of their lines are left out' %
+                          (len(self.partial_hosts),
+                           sorted(self.partial_hosts))])
+
+        for code, msg in lines:
+            line = " ".join([str(tail_time_from_str('0:00')),
+                             code, 'WARN ', '-', msg])
+            if self.options['nowrap']:
+                print line[0:get_terminal_width()]
+            else:
+                print line
 
+    def report_host_timings(self):
+        if self.options['verbose']:
+            slowest = len(self.host_timings.hosts)
         else:
-            return input_struct
+            slowest = 5
 
-    def import_from_json(self, json_str):
-        return self.convert_keys_to_no_unicode(json.loads(json_str))
+        for line in self.host_timings.get_report(slowest):
+            err(line)
 
+        if self.options['host-timings-file']:
+            with open(self.options['host-timings-file'], 'w') as f:
+                json.dump(self.host_timings.hosts, f, indent=2,
+                          sort_keys=True)
 
-try:
-    tcols = os.popen('tput cols', 'r').read()
-    TERMINAL_WIDTH = int(tcols)
-except:
-    TERMINAL_WIDTH = 100
+
+# hblogd stops scanning this long before the client gives up on it, to
+# still send what it has
+DEADLINE_MARGIN_SECS = 3.0
+
+# --details holds back the lines of faster hosts until slower ones catch
+# up, up to this many
+MAX_BUFFERED_LINES = 200000
+
+# With --follow --poll, each host is asked for new lines this long after it
+# answered
+POLL_INTERVAL_SECS = 0.5
+
+# --follow holds lines back this long at most, to put those of all hosts in
+# order
+FOLLOW_REORDER_SECS = 1.0
+
+# A busy hblogd answers 503 with a Retry-After
+MAX_BUSY_RETRIES = 5
+MAX_RETRY_AFTER_SECS = 10
+
+# A host that fails is asked again after this long, twice as long after
+# each failure in a row
+RETRY_BACKOFF_SECS = 0.5
+MAX_RETRY_BACKOFF_SECS = 30.0
+
+# A host that fails this many times in a row is left alone for a while
+CIRCUIT_MAX_FAILURES = 3
+CIRCUIT_COOLDOWN_SECS = 10.0
+CIRCUIT_MAX_COOLDOWN_SECS = 300.0
+
+# Subscriptions stay open for as long as hblog runs
+SUBSCRIPTION_TIMEOUT = 7 * 24 * 3600.0
+
+# Where the hosts of each tier are remembered between runs
+TIER_CACHE_PATH = "~/.cache/hblog/tier-hosts.json"
+
+# Where the answers of hosts for windows that are over are kept. A window
+# is taken to be over once it ended this long ago: lines get written late.
+RESULT_CACHE_DIR = "~/.cache/hblog/results"
+RESULT_CACHE_SETTLE_SECS = 60
+
+DEFAULT_TERMINAL_WIDTH = 100
+
+# From no lines at all to the busiest bucket of a histogram
+SPARKS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+def get_terminal_width():
+    """of the terminal hblog prints to, asked for the first time it is
+       needed, without a subprocess"""
+    if not hasattr(get_terminal_width, 'width'):
+        get_terminal_width.width = DEFAULT_TERMINAL_WIDTH
+        for fd in [sys.stdout.fileno(), sys.stderr.fileno()]:
+            try:
+                _, cols = struct.unpack('hh', fcntl.ioctl(fd,
+                                                  termios.TIOCGWINSZ, '1234'))
+            except IOError:
+                continue
+            if cols > 0:
+                get_terminal_width.width = cols
+                break
+        else:
+            # not a terminal: what terminfo says, like tput would
+            try:
+                import curses
+                curses.setupterm(fd=sys.stdout.fileno())
+                if curses.tigetnum('cols') > 0:
+                    get_terminal_width.width = curses.tigetnum('cols')
+            except Exception:
+                pass
+
+    return get_terminal_width.width
+
+def startup_phase(name):
+    STARTUP_PHASES.append((name, time.time()))
+
+def sparkline(counts):
+    top = max(counts + [1])
+    return u''.join([SPARKS[(count * (len(SPARKS) - 1) + top - 1) / top]
+                                                        for count in counts])
 
 def flatten(x):
    result = []
@@ -433,30 +1279,69 @@ def str_to_time(s):
     STRPTIME_FORMAT = '%Y-%m-%d %H:%M:%S,%f'
     return datetime.strptime(s, STRPTIME_FORMAT)
 
-def run_sh(cmd):
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if stdout:
-        stdout = stdout.rstrip()
-    if stderr:
-        stderr = stderr.rstrip()
-
-    return (stdout, stderr, p.returncode)
-
-def list_hosts_of_tier(tier_name):
-    cmd = "list_hosts_of_tier.sh %s" % (tier_name)  # in PATH
-    stdout, stderr, returncode = run_sh(cmd)
+def list_hosts_of_tiers(tier_names, tier_cache=None):
+    """{tier name: hosts}, from the tier_cache if it has them, the others
+       listed by list_hosts_of_tier all at once"""
+    hosts_of_tier = {}
+    processes = {}
+    for tier_name in set(tier_names):
+        hosts = tier_cache and tier_cache.get(tier_cache_key(tier_name))
+        if hosts is not None:
+            hosts_of_tier[tier_name] = hosts
+            continue
+
+        try:
+            processes[tier_name] = subprocess.Popen(  # in PATH
+                                   ["list_hosts_of_tier.sh", tier_name],
+                                   stdout=subprocess.PIPE)
+        except OSError as e:
+            raise HBLogEventsException("Could not run list_hosts_of_tier.sh: "
+                                       "%s" % e)
+
+    for tier_name, p in processes.items():
+        stdout, stderr = p.communicate()
+        if stdout:
+            stdout = stdout.rstrip()
+
+        if p.returncode == 0:
+            hosts_of_tier[tier_name] = list(set(stdout.split("\n")))  # dedup
+            if tier_cache:
+                tier_cache.put(tier_cache_key(tier_name),
+                               hosts_of_tier[tier_name])
+        elif p.returncode == 2:
+            raise HBLogEventsException("Tier '%s' is not recognized by "
+                                       "list_hosts_of_tier" % tier_name)
+        else:
+            raise HBLogEventsException(
+                "list_hosts_of_tier returned non-zero exit status %d; "
+                "Stdout: %s;" % (p.returncode, stdout))
+
+    cached_tiers = sorted(set(hosts_of_tier) - set(processes))
+    if cached_tiers:
+        err("NOTICE: Using the hosts of %s listed up to %ds ago, from the "
+            "tier cache in %s" % (", ".join(cached_tiers),
+                                  tier_cache.ttl_secs, TIER_CACHE_PATH))
+
+    if tier_cache:
+        tier_cache.save()
+    return hosts_of_tier
+
+def read_hosts_file(path):
+    """the hosts of --hosts-file, one per line, as host or host:port"""
+    try:
+        with open(path) as f:
+            hosts = [line.split('#')[0].strip() for line in f]
+    except IOError as e:
+        raise HBLogEventsException("Could not read the hosts file: %s" % e)
 
-    if returncode == 0:
-        return list(set(stdout.split("\n")))  # dedup
-    elif returncode == 2:
-        raise HBLogEventsException("Tier '%s' is not recognized by "
-                                               "list_hosts_of_tier" % tier_name)
+    hosts = [host for host in hosts if host]
+    if not hosts:
+        raise HBLogEventsException("No hosts in %s" % path)
+    return list(set(hosts))  # dedup
 
-    else:
-        raise HBLogEventsException(
-            "Shelling-out returned non-zero exit status %d; "
-            "Stdout: %s; Stderr: %s;" % (returncode, stdout, stderr))
+def tier_cache_key(tier_name):
+    """list_hosts_of_tier answers per $cellname"""
+    return "%s/%s" % (os.getenv('cellname', ''), tier_name)
 
 # Map tier endings to globs
 tier2glob_map_examples_for_localhost = {
@@ -552,6 +1437,37 @@ def get_matched(logtier):
 
     return match_type, matched
 
+def get_usage():
+    tier_arguments = sorted(set(
+                                tier2glob_map['startswith'].keys() +
+                                tier2glob_equivalents['startswith'].keys() +
+                                tier2glob_map['endswith'].keys() +
+                                tier2glob_equivalents['endswith'].keys() +
+                                tier2glob_map['re'].keys() +
+                                tier2glob_equivalents['re'].keys()))
+
+    num_cols = 3
+    step_len = len(tier_arguments) / num_cols
+    col_width = 80 / num_cols
+    if len(tier_arguments) % num_cols != 0:
+        tier_arguments.append(" ")
+    raw_cols = [tier_arguments[step_len * i: step_len * (i + 1)] for
+                                                        i in range(0, num_cols)]
+
+    final_columns = []
+    for line in zip(*raw_cols):
+        final_columns.append(" ".join([i.ljust(col_width, " ") for i in line]))
+
+    return "%prog [OPTIONS]... [TIER...] [TIER:HOST...]\n" + \
+           ("\n  Where TIER is one of:\n\n  %s" % "\n  ".join(final_columns))
+
+class TierUsageOptionParser(OptionParser):
+    """The usage lists the tiers, worked out only when it is shown"""
+
+    def get_usage(self):
+        self.set_usage(get_usage())
+        return OptionParser.get_usage(self)
+
 def print_options_summary(options):
     err("---------------------------------------------------------------")
     err("---------------------------- To make these setting default run:")
@@ -564,7 +1480,10 @@ def print_options_summary(options):
     del serializable_options['start']
     del serializable_options['end']
     del serializable_options['duration']
+    del serializable_options['bucket-secs']
     del serializable_options['local']
+    del serializable_options['hosts-file']
+    del serializable_options['host-timings-file']
     serializable_options['fp'] = ','.join(serializable_options['fp'])
     serializable_options['fp-exclude'] = \
         ','.join(serializable_options['fp-exclude'])
@@ -591,6 +1510,8 @@ def print_options_summary(options):
         err("end:               %s" % round_to_seconds(options['end']))
         duration = round_to_seconds(options['duration'])
         err("duration:          %s hh:mm:ss" % duration)
+        if options['bucket-secs']:
+            err("histogram buckets: %ds" % options['bucket-secs'])
     err("")
     err("level:             %s" % options['level'])
     err("sample:            %s" % options['sample'])
@@ -602,6 +1523,7 @@ def print_options_summary(options):
 
 
 if (__name__ == "__main__"):
+    startup_phase('imports')
 
     ALL_LEVELS = ["INFO", "DEBUG", "WARN", "ERROR", "FATAL"]
 
@@ -618,6 +1540,24 @@ if (__name__ == "__main__"):
         "tail": None,
         "tail-end": None,
         "log-tiers": [],
+        "wire-format": "frames",
+        "compress": "gzip",
+        "poll": False,
+        "limit": 0,
+        "histogram": False,
+        "bucket": 0,
+        "max-clients": 256,
+        "connect-timeout": 2.0,
+        "request-timeout": 20.0,
+        # e.g. {"dfs-slaves": {"connect-timeout": 5, "request-timeout": 60}}
+        "tier-timeouts": {},
+        "retries": 2,
+        "quorum": 100.0,
+        "max-wait": 0.0,
+        "hedge": 0.0,
+        "relay-fanout": 0,
+        "tier-cache-secs": 0,
+        "result-cache-mb": 0,
     }
 
     # Load defaults from ~/.hblogrc
@@ -630,30 +1570,7 @@ if (__name__ == "__main__"):
     for k, v in hblogrc_options.items():
         default_options[k] = v
 
-    tier_arguments = sorted(set(
-                                tier2glob_map['startswith'].keys() +
-                                tier2glob_equivalents['startswith'].keys() +
-                                tier2glob_map['endswith'].keys() +
-                                tier2glob_equivalents['endswith'].keys() +
-                                tier2glob_map['re'].keys() +
-                                tier2glob_equivalents['re'].keys()))
-
-    num_cols = 3
-    step_len = len(tier_arguments) / num_cols
-    col_width = 80 / num_cols
-    if len(tier_arguments) % num_cols != 0:
-        tier_arguments.append(" ")
-    raw_cols = [tier_arguments[step_len * i: step_len * (i + 1)] for
-                                                        i in range(0, num_cols)]
-
-    final_columns = []
-    for line in zip(*raw_cols):
-        final_columns.append(" ".join([i.ljust(col_width, " ") for i in line]))
-
-    parser = OptionParser(
-        usage="%prog [OPTIONS]... [TIER...] [TIER:HOST...]\n" +
-            ("\n  Where TIER is one of:\n\n  %s" %
-                                           "\n  ".join(final_columns)))
+    parser = TierUsageOptionParser()
     parser.description = "hblog - a log paser for clusters"
 
     parser.add_option("--verbose", "-v", action="store_true",
@@ -664,6 +1581,71 @@ if (__name__ == "__main__"):
         default=default_options['nowrap'],
         help="print characters only up to the width of your terminal")
 
+    parser.add_option("--wire-format", type='choice',
+        choices=WireFormat.WIRE_FORMATS, default=default_options['wire-format'],
+        help="how hblogd sends log lines, falls back to json for older "
+            "hblogd's (default: %default)")
+
+    parser.add_option("--max-clients", type="int",
+        default=default_options['max-clients'],
+        help="hosts to ask at the same time (default: %default)")
+
+    parser.add_option("--connect-timeout", type="float",
+        default=default_options['connect-timeout'],
+        help="seconds to wait for a host to connect, \"tier-timeouts\" in "
+            "~/.hblogrc can raise it per tier (default: %default)")
+
+    parser.add_option("--request-timeout", type="float",
+        default=default_options['request-timeout'],
+        help="seconds to wait for a host to answer, \"tier-timeouts\" in "
+            "~/.hblogrc can raise it per tier (default: %default)")
+
+    parser.add_option("--retries", type="int",
+        default=default_options['retries'],
+        help="times to ask a host again after an error, waiting longer "
+            "each time, before leaving it out (default: %default)")
+
+    parser.add_option("--quorum", type="float",
+        default=default_options['quorum'],
+        help="show the results once this percentage of the hosts answered, "
+            "leaving out those that did not yet (default: %default)")
+
+    parser.add_option("--max-wait", type="float",
+        default=default_options['max-wait'],
+        help="show the results after this many seconds, leaving out the "
+            "hosts that did not answer yet (default: %default, no limit)")
+
+    parser.add_option("--hedge", type="float",
+        default=default_options['hedge'],
+        help="with --summary, ask a host that did not answer after this many "
+            "seconds again, and take whichever answer comes first (default: "
+            "%default, never)")
+
+    parser.add_option("--relay-fanout", type="int",
+        default=default_options['relay-fanout'],
+        help="with --summary or --details, ask every this many hosts of a "
+            "tier through the hblogd of one of them, which merges their "
+            "answers (default: %default, ask every host)")
+
+    parser.add_option("--tier-cache-secs", type="int",
+        default=default_options['tier-cache-secs'],
+        help="remember the hosts of a tier in ~/.cache/hblog for this "
+            "long; hosts added to or taken out of the tier meanwhile are "
+            "not seen until then (default: %default, list them on every "
+            "run)")
+
+    parser.add_option("--result-cache-mb", type="int",
+        default=default_options['result-cache-mb'],
+        help="keep what hosts answered for windows that ended over a minute "
+            "ago in ~/.cache/hblog, up to this many MB, and answer the same "
+            "or stricter filters from it; lines written to the window "
+            "later, e.g. by a host that was behind, are not seen "
+            "(default: %default, off)")
+
+    parser.add_option("--compress", type='choice',
+        choices=['none'] + WireFormat.CONTENT_ENCODINGS,
+        default=default_options['compress'],
+        help="ask hblogd to compress responses (default: %default)")
 
     group = OptionGroup(parser, title="Modes", description=
             "Log lines are \"fingerprinted\", usually able to "
@@ -675,6 +1657,22 @@ if (__name__ == "__main__"):
         action="store_const",
         help="host-vs-fingerprint frequency table (Default mode)")
 
+    group.add_option("--limit", type="int",
+        default=default_options['limit'],
+        help="with --summary, have every host send only its top LIMIT "
+            "fingerprints, and show the top LIMIT of all hosts (default: 0, "
+            "all of them)")
+
+    group.add_option("--histogram", action="store_true",
+        default=default_options['histogram'],
+        help="with --summary, show when each fingerprint was logged, as a "
+            "sparkline of its counts per time bucket, all from the same scan")
+
+    group.add_option("--bucket", type="int",
+        default=default_options['bucket'],
+        help="seconds per bucket of --histogram (default: 0, as many buckets "
+            "as fit the width of your terminal)")
+
     group.add_option("--details", "-d", dest="mode", const="details",
         action="store_const",
         help="print all matching log lines embellished with "
@@ -684,6 +1682,11 @@ if (__name__ == "__main__"):
         action="store_const",
         help="like --details but streaming, just like 'tail -f'")
 
+    group.add_option("--poll", action="store_true",
+        default=default_options['poll'],
+        help="with --follow, ask every host for new lines twice a second "
+            "rather than have them pushed (for older hblogd's)")
+
     parser.set_defaults(mode=None)
     parser.add_option_group(group)
 
@@ -736,6 +1739,13 @@ if (__name__ == "__main__"):
     group.add_option("--local", action="store_true", default=False,
         help="To test hblog. Connect to localhost. "
         "Read logs from ./var/log/hadoop-example.log")
+    group.add_option("--hosts-file", default=None,
+        help="To test hblog. Ask the hosts in this file, one per line, as "
+        "host or host:port, instead of those list_hosts_of_tier.sh lists "
+        "for the tiers, e.g. the stand-ins of bench/fleet.py")
+    group.add_option("--host-timings-file", default=None,
+        help="To test hblog. Once all hosts have answered, write where the "
+        "time of the requests to each host went to this file, as json")
 
     parser.add_option_group(group)
 
@@ -746,6 +1756,9 @@ if (__name__ == "__main__"):
     for key,val in vars(cli_options).items():
       options[key.replace('_', '-')] = val
 
+    # Only in ~/.hblogrc
+    options['tier-timeouts'] = default_options['tier-timeouts']
+
     if options['verbose']:
         err("CLI options before processing:")
         err(options)
@@ -764,6 +1777,9 @@ if (__name__ == "__main__"):
     if not options["mode"]:
         options["mode"] = default_options["mode"]
 
+    if not 0 < options['quorum'] <= 100:
+        parser.error("--quorum is a percentage, more than 0 and up to 100")
+
     for i in ['fp', 'fp-exclude']:
         options[i] = options[i].split(',')
         if options[i] == ['']:
@@ -823,16 +1839,48 @@ if (__name__ == "__main__"):
 
     options['duration'] = options['end'] - options['start']
 
+    if options['mode'] != 'summary' or not (options['histogram'] or
+                                            options['bucket']):
+        options['bucket-secs'] = 0
+    elif options['bucket']:
+        if options['bucket'] < 0:
+            parser.error("--bucket is a number of seconds, more than 0")
+        if options['duration'].total_seconds() / options['bucket'] > \
+                                                             MAX_TIME_BUCKETS:
+            parser.error("--bucket is too narrow for this window, it may cut "
+                         "it into at most %d buckets" % MAX_TIME_BUCKETS)
+        options['bucket-secs'] = options['bucket']
+    else:
+        options['bucket-secs'] = nice_width(
+                                options['duration'].total_seconds() /
+                                (get_terminal_width() - 34))
+
     options['log-tiers-globs'] = {}
     options['log-tiers-hosts'] = {}
 
+    startup_phase('options')
+
+    if options['tier-cache-secs'] > 0:
+        tier_cache = TierCache(os.path.expanduser(TIER_CACHE_PATH),
+                               options['tier-cache-secs'])
+    else:
+        tier_cache = None
+
+    listed_tiers = [logtier for logtier in options['log-tiers']
+                                                        if ":" not in logtier]
+    tiers_to_list = ['local'] if options['local'] else listed_tiers
+    if options['hosts-file']:
+        hosts = read_hosts_file(options['hosts-file'])
+        hosts_of_tier = dict((tier_name, hosts) for tier_name in tiers_to_list)
+    else:
+        hosts_of_tier = list_hosts_of_tiers(tiers_to_list, tier_cache)
     for logtier in options['log-tiers']:
         if ":" in logtier:
             options['log-tiers-hosts'][logtier] = \
                                             logtier.split(':')[1].split(',')
         else:
             options['log-tiers-hosts'][logtier] = \
-                    list_hosts_of_tier('local' if options['local'] else logtier)
+                      hosts_of_tier['local' if options['local'] else logtier]
 
     if options['verbose']:
         err('log-tiers is:')
@@ -868,6 +1916,8 @@ if (__name__ == "__main__"):
         err(options['hosts-list'])
         err('')
 
+    startup_phase('tiers')
+
     print_options_summary(options)
 
     if options['verbose']:
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+class AdmissionControl():
+    """ Budgets for the scans hblogd runs on behalf of its clients, so that
+        an incident, when everyone runs hblog at once, doesn't take CPU and
+        disk away from the regionserver or datanode next to it:
+
+          - at most max_concurrent_scans at a time, the others are turned
+            away with a Retry-After
+          - reads are throttled to max_read_bytes_per_sec across all scans,
+            subscriptions and rollups, with a token bucket of one second's
+            worth of reads
+          - a scan stops after max_cpu_secs_per_request
+
+        A budget of 0 means no limit."""
+
+    RETRY_AFTER_SECS = 2
+    BURST_SECS = 1.0
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, max_concurrent_scans, max_read_bytes_per_sec,
+                       max_cpu_secs_per_request):
+        self.max_concurrent_scans = max_concurrent_scans
+        self.max_read_bytes_per_sec = max_read_bytes_per_sec
+        self.max_cpu_secs_per_request = max_cpu_secs_per_request
+
+        self.scans_in_flight = 0
+        self.tokens = max_read_bytes_per_sec * self.BURST_SECS
+        self.last_refill = time.time()
+
+        self.scans_admitted = 0
+        self.scans_rejected = 0
+        self.scans_over_cpu_budget = 0
+        self.throttled_secs = 0.0
+        self.throttled_until = 0.0
+
+    def admit(self):
+        """returns 0 when the scan may start, or else the seconds after
+           which to try again. Call release() once an admitted scan ends."""
+        if self.max_concurrent_scans and \
+                          self.scans_in_flight >= self.max_concurrent_scans:
+            self.scans_rejected += 1
+            return self.RETRY_AFTER_SECS + int(self.get_throttle_delay())
+
+        self.scans_in_flight += 1
+        self.scans_admitted += 1
+        return 0
+
+    def release(self):
+        self.scans_in_flight -= 1
+
+    def charge(self, num_bytes):
+        """takes num_bytes just read out of the bucket, returns the seconds
+           to wait before reading on"""
+        if not self.max_read_bytes_per_sec:
+            return 0.0
+
+        self.refill()  # up to the read, so that the burst caps what it adds
+        self.tokens -= num_bytes
+        delay = self.get_throttle_delay()
+
+        # Reads that wait at the same time wait once, as far as the disk is
+        # concerned: count the time waited, not the sum of the delays
+        now = time.time()
+        if delay and now + delay > self.throttled_until:
+            self.throttled_secs += now + delay - max(now, self.throttled_until)
+            self.throttled_until = now + delay
+        return delay
+
+    def is_over_cpu_budget(self, cpu_secs):
+        if self.max_cpu_secs_per_request and \
+                                   cpu_secs > self.max_cpu_secs_per_request:
+            self.scans_over_cpu_budget += 1
+            return True
+        return False
+
+    def get_stats(self):
+        return {'scans-in-flight': self.scans_in_flight,
+                'scans-admitted': self.scans_admitted,
+                'scans-rejected': self.scans_rejected,
+                'scans-over-cpu-budget': self.scans_over_cpu_budget,
+                'throttled-secs': round(self.throttled_secs, 3)}
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.max_read_bytes_per_sec * self.BURST_SECS,
+                          self.tokens + (now - self.last_refill) *
+                                                   self.max_read_bytes_per_sec)
+        self.last_refill = now
+
+    def get_throttle_delay(self):
+        if not self.max_read_bytes_per_sec:
+            return 0.0
+
+        self.refill()
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.max_read_bytes_per_sec
@@ -0,0 +1,63 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+class CircuitBreaker():
+    """ Whether a host is worth asking, after it failed. The circuit of a
+        host is closed while it answers. After max_failures failures in a
+        row it opens: the host is left alone for cooldown_secs. Then one
+        more request may go to it, and if that one fails as well the
+        circuit opens again, for twice as long, up to max_cooldown_secs.
+        Any answer closes it."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, max_failures, cooldown_secs, max_cooldown_secs):
+        self.max_failures = max_failures
+        self.cooldown_secs = cooldown_secs
+        self.max_cooldown_secs = max_cooldown_secs
+        self.hosts = {}
+
+    def success(self, host):
+        self.hosts.pop(host, None)
+
+    def failure(self, host):
+        """True when this failure opened the circuit"""
+        state = self.hosts.setdefault(host, {'failures': 0,
+                                             'open-until': None,
+                                             'cooldown': self.cooldown_secs})
+        state['failures'] += 1
+        if state['failures'] < self.max_failures:
+            return False
+
+        if state['open-until'] is not None:
+            # the one request after the cooldown failed too
+            state['cooldown'] = min(2 * state['cooldown'],
+                                    self.max_cooldown_secs)
+        state['open-until'] = time.time() + state['cooldown']
+        return True
+
+    def is_open(self, host):
+        return self.get_wait(host) > 0
+
+    def get_wait(self, host):
+        """seconds until the host may be asked again"""
+        state = self.hosts.get(host)
+        if state is None or state['open-until'] is None:
+            return 0.0
+        return max(0.0, state['open-until'] - time.time())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+class HostTimings():
+    """ Where the time of the requests to each host went, as hblog saw it:
+
+          queued      waiting for one of the client's max_clients
+          first-byte  from the request to hblogd's response headers
+          fetch       the request itself, on the wire and in hblogd
+          decode      parsing the response
+          total       from asking for it to having it parsed
+
+        A host asked more than once, e.g. when busy, adds up."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.hosts = {}
+
+    def start(self, host):
+        """a request to host is made. Returns its timing, to pass to
+           first_byte() and finish(), as more than one request to the same
+           host can be under way at once"""
+        timing = self.hosts.setdefault(host, {'requests': 0,
+                                              'queued': 0.0,
+                                              'first-byte': 0.0,
+                                              'fetch': 0.0,
+                                              'decode': 0.0,
+                                              'total': 0.0,
+                                              'bytes': 0})
+        timing['requests'] += 1
+        return {'host': host, 'started': time.time(), 'got-first-byte': False}
+
+    def first_byte(self, request_timing):
+        if not request_timing['got-first-byte']:
+            request_timing['got-first-byte'] = True
+            self.hosts[request_timing['host']]['first-byte'] += \
+                                     time.time() - request_timing['started']
+
+    def finish(self, request_timing, fetch_secs, decode_secs, num_bytes):
+        timing = self.hosts[request_timing['host']]
+        total = time.time() - request_timing['started']
+        timing['queued'] += max(0.0, total - fetch_secs - decode_secs)
+        timing['fetch'] += fetch_secs
+        timing['decode'] += decode_secs
+        timing['total'] += total
+        timing['bytes'] += num_bytes
+
+    def get_report(self, slowest=10):
+        """lines of text: percentiles of the total over all hosts, and the
+           breakdown of the slowest hosts"""
+        if not self.hosts:
+            return []
+
+        by_total = sorted(self.hosts.items(), key=lambda i: i[1]['total'],
+                          reverse=True)
+        totals = sorted([timing['total'] for _, timing in by_total])
+
+        lines = ["Host timings: %d hosts, total p50 %.2fs p90 %.2fs "
+                 "max %.2fs" % (len(totals),
+                                self.get_percentile(totals, 50),
+                                self.get_percentile(totals, 90),
+                                totals[-1])]
+
+        lines.append("%-30.30s %8s %8s %10s %8s %8s %8s %10s" %
+                     ('host', 'requests', 'queued', 'first-byte', 'fetch',
+                      'decode', 'total', 'KB'))
+        for host, timing in by_total[:slowest]:
+            lines.append("%-30.30s %8d %8.2f %10.2f %8.2f %8.2f %8.2f %10d" %
+                         (host, timing['requests'], timing['queued'],
+                          timing['first-byte'], timing['fetch'],
+                          timing['decode'], timing['total'],
+                          timing['bytes'] / 1024))
+        return lines
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def get_percentile(self, values, percentile):
+        return values[min(len(values) - 1, len(values) * percentile / 100)]
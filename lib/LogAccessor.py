@@ -31,6 +31,9 @@ from datetime import datetime, timedelta
 from SingleFileLogAccessor import \
     SingleFileLogAccessor, SingleFileLogAccessorException
 
+# Files this small are skipped, they can't hold a log line yet
+MIN_FILE_SIZE = 10
+
 class LogAccessorException (Exception):
     '''Raised by the LogAccessor routines'''
     pass
@@ -42,7 +45,8 @@ class LogAccessor():
     # --------------------------------------------------------------------------
 
     def __init__(self, log_path_glob, max_klines,
-                       sampling_rate=None, verbose=False, debug=False):
+                       sampling_rate=None, verbose=False, debug=False,
+                       hold_partial_line=False):
 
         # Private instance variables
         self.debug = debug
@@ -51,9 +55,6 @@ class LogAccessor():
         else:
             self.verbose = verbose
 
-        self.bytes_read = 0
-        self.lines_read = 0
-
         self.open_logfiles = []
         self.open_logfiles_map = {}
         self.next_rec = None
@@ -70,14 +71,20 @@ class LogAccessor():
             LogAccessorException(
                 "ERROR: More than 1000 log files matched %s" % log_path_glob)
 
+        self.small_files = []  # may grow into readable ones, see is_stale()
+
         for filename in log_files:
-            if not filename.endswith('.gz') and os.stat(filename).st_size > 10:
+            if not filename.endswith('.gz') and \
+                                  os.stat(filename).st_size <= MIN_FILE_SIZE:
+                self.small_files.append(filename)
+            elif not filename.endswith('.gz'):
                 try:
                     logfile = SingleFileLogAccessor(filename,
-                                             sampling_rate=sampling_rate,
-                                             max_klines=max_klines,
-                                             debug=self.debug,
-                                             verbose=self.verbose)
+                                     sampling_rate=sampling_rate,
+                                     max_klines=max_klines,
+                                     debug=self.debug,
+                                     verbose=self.verbose,
+                                     hold_partial_line=hold_partial_line)
                 except SingleFileLogAccessorException as e:
                     self.err(("DEBUG: When reading %s "
                      "lib/LogAccessor.py caught: %s") % (filename, e))
@@ -97,10 +104,7 @@ class LogAccessor():
                 "ERROR: Could not read first record from "
                 "any of these files %s" % log_path_glob)
 
-        self.universal_offset = {
-            'filename': self.open_logfiles[0].get_filename(),
-            'byte_offset': self.open_logfiles[0].get_byte_offset()
-        }
+        self.universal_offset = self.open_logfiles[0].get_universal_offset()
         self.logline_generator = self.next_def()
 
     def close_all_files(self):
@@ -116,7 +120,7 @@ class LogAccessor():
         return self.logline_generator.next()
 
     def next_def(self):
-        logfile_id = self.logfile_name_to_id(self.universal_offset['filename'])
+        logfile_id = self.universal_offset_to_id(self.universal_offset)
         remaining_open_logfiles = self.open_logfiles[logfile_id:]
 
         if self.debug:
@@ -134,12 +138,7 @@ class LogAccessor():
             try:
                 for rec in logfile:
                     self.next_rec = logfile.look_one_rec_ahead()
-                    self.universal_offset = {
-                        'filename': logfile.get_filename(),
-                        'byte_offset': logfile.get_byte_offset()
-                    }
-                    self.bytes_read += logfile.get_bytes_read()
-                    self.lines_read += logfile.get_lines_read()
+                    self.universal_offset = logfile.get_universal_offset()
 
                     yield rec
 
@@ -153,13 +152,13 @@ class LogAccessor():
             raise StopIteration
 
     def get_bytes_read(self):
-        return self.bytes_read
+        return sum([logfile.get_bytes_read() for logfile in self.open_logfiles])
 
     def get_lines_read(self):
-        return self.lines_read
+        return sum([logfile.get_lines_read() for logfile in self.open_logfiles])
 
     def seek_offset(self, universal_offset):
-        logfile_id = self.logfile_name_to_id(universal_offset['filename'])
+        logfile_id = self.universal_offset_to_id(universal_offset)
         remaining_open_logfiles = self.open_logfiles[logfile_id:]
 
         offset = universal_offset['byte_offset']
@@ -173,9 +172,9 @@ class LogAccessor():
                              "Will start reading next logfile.")
                 offset = 0
             else:
-                self.universal_offset = universal_offset
+                self.universal_offset = logfile.get_universal_offset()
+                self.next_rec = logfile.look_one_rec_ahead()
                 self.logline_generator = self.next_def()  # restart generator
-                self.logline_generator.next()  # go to first record
                 return
 
         if self.verbose:
@@ -201,12 +200,10 @@ class LogAccessor():
 
                 logfile.seek_time(timestamp)
 
-                self.universal_offset = \
-                    {'filename': logfile.get_filename(),
-                     'byte_offset': logfile.get_byte_offset()}
+                self.universal_offset = logfile.get_universal_offset()
 
+                self.next_rec = logfile.look_one_rec_ahead()
                 self.logline_generator = self.next_def()  # restart generator
-                self.logline_generator.next()  # go to first record
 
                 return
 
@@ -216,10 +213,54 @@ class LogAccessor():
     def get_universal_offset(self):
         return self.universal_offset
 
+    def has_new_data(self):
+        """True once the file at the universal offset grew past it, or
+           there are later files. Seek to the universal offset to read on."""
+        logfile_id = self.universal_offset_to_id(self.universal_offset)
+        logfile = self.open_logfiles[logfile_id]
+        return logfile.get_file_size() > self.universal_offset['byte_offset'] \
+                            or logfile_id < len(self.open_logfiles) - 1
+
+    def is_stale(self):
+        """True once the file at the universal offset was renamed, e.g.
+           rotated, or a file too small to read has grown. A new LogAccessor
+           seeked to the universal offset picks up where this one is."""
+        logfile_id = self.universal_offset_to_id(self.universal_offset)
+        if self.open_logfiles[logfile_id].is_renamed():
+            return True
+
+        for filename in self.small_files:
+            try:
+                if os.stat(filename).st_size > MIN_FILE_SIZE:
+                    return True
+            except OSError:
+                pass
+
+        return False
+
     # --------------------------------------------------------------------------
     # Private
     # --------------------------------------------------------------------------
 
+    def universal_offset_to_id(self, universal_offset):
+        """Finds the file by device and inode, so that the offset follows
+           it through renames, then by the checksum of its head, so that it
+           follows copies. Offsets without an inode are by filename."""
+        if universal_offset.get('ino') is None:
+            return self.logfile_name_to_id(universal_offset['filename'])
+
+        for logfile_id in range(len(self.open_logfiles)):
+            if self.open_logfiles[logfile_id].is_same_file(universal_offset):
+                return logfile_id
+
+        for logfile_id in range(len(self.open_logfiles)):
+            if self.open_logfiles[logfile_id].has_head(
+                                                     universal_offset['head']):
+                return logfile_id
+
+        raise LogAccessorException("LogAccessor was not able to find "
+            "the logfile that was %s" % universal_offset['filename'])
+
     def logfile_name_to_id(self, filename):
         if self.open_logfiles_map.has_key(filename):
             return self.open_logfiles_map[filename]
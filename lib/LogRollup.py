@@ -0,0 +1,336 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+import os
+import sys
+import glob
+import json
+import hashlib
+from datetime import datetime, timedelta
+
+from LogAccessor import LogAccessor, LogAccessorException
+from SingleFileLogAccessor import SingleFileLogAccessorException
+
+MINUTE_FORMAT = "%Y-%m-%d %H:%M:00"
+HOUR_FILE_FORMAT = "%Y-%m-%d-%H"
+
+class RollupStore():
+    """ Per-minute fingerprint x level counts of one glob, on disk:
+
+            <rollup_dir>/<md5 of glob>/GLOB           the glob, for humans
+            <rollup_dir>/<md5 of glob>/fingerprints   [fp, norm_text] lines
+            <rollup_dir>/<md5 of glob>/YYYY-MM-DD-HH  one line per minute:
+                ["YYYY-MM-DD hh:mm:00", [[fp index, level, count], ...]]
+
+        Fingerprints are referred to by their line number in 'fingerprints'.
+        Every closed minute is written, empty ones too, so a run of minutes
+        without gaps means nothing was missed. Hour files older than the
+        retention are deleted."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, rollup_dir, log_path_glob, retention_hours):
+        self.log_path_glob = log_path_glob
+        self.retention = timedelta(hours=retention_hours)
+        self.store_dir = os.path.join(rollup_dir,
+                                      hashlib.md5(log_path_glob).hexdigest())
+
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+            with open(os.path.join(self.store_dir, 'GLOB'), 'w') as f:
+                f.write(log_path_glob + "\n")
+
+        self.fingerprints = []
+        self.fp_to_index = {}
+        self.fingerprints_read = 0  # bytes of 'fingerprints' read so far
+        self.load_new_fingerprints()
+
+        self.last_closed_minute = self.read_last_closed_minute()
+
+    def write_minute(self, minute, counts):
+        """counts is {(fp, norm_text, level): count}"""
+        new_fps = []
+        rows = []
+        for (fp, norm_text, level), count in counts.items():
+            if fp not in self.fp_to_index:
+                self.fp_to_index[fp] = len(self.fingerprints)
+                self.fingerprints.append((fp, norm_text))
+                new_fps.append([fp, norm_text])
+            rows.append([self.fp_to_index[fp], level, count])
+
+        if new_fps:
+            with open(os.path.join(self.store_dir, 'fingerprints'), 'a') as f:
+                f.write("".join(["%s\n" % json.dumps(i) for i in new_fps]))
+
+        hour_file = self.hour_file_of(minute)
+        with open(os.path.join(self.store_dir, hour_file), 'a') as f:
+            f.write("%s\n" % json.dumps([minute, rows],
+                                        separators=(',', ':')))
+
+        if self.last_closed_minute and \
+                       self.hour_file_of(self.last_closed_minute) != hour_file:
+            self.expire()
+
+        self.last_closed_minute = minute
+
+    def read_minutes(self, first_minute, end_time):
+        """yields (minute, [(fp, norm_text, level, count), ...]) for the
+           closed minutes from first_minute on that end by end_time, and
+           stops at the first minute that is missing"""
+        expected = first_minute
+        for hour_file in self.list_hour_files():
+            if hour_file < self.hour_file_of(first_minute):
+                continue
+
+            with open(os.path.join(self.store_dir, hour_file)) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        return
+
+                    minute, rows = json.loads(line)
+                    if minute < expected:
+                        continue
+                    if minute != expected or next_minute(minute) > end_time:
+                        return
+
+                    if rows and max(rows)[0] >= len(self.fingerprints):
+                        # written by the hblogd worker that runs the rollup
+                        self.load_new_fingerprints()
+
+                    yield (minute,
+                           [self.fingerprints[fp_index] + (level, count)
+                                           for fp_index, level, count in rows])
+                    expected = next_minute(minute)
+
+    def get_first_minute(self):
+        hour_files = self.list_hour_files()
+        if not hour_files:
+            return None
+        with open(os.path.join(self.store_dir, hour_files[0])) as f:
+            return json.loads(f.readline())[0]
+
+    def get_last_closed_minute(self):
+        return self.last_closed_minute
+
+    def read_last_closed_minute(self):
+        """from disk, for when another process writes the store"""
+        last_closed_minute = None
+        hour_files = self.list_hour_files()
+        if hour_files:
+            with open(os.path.join(self.store_dir, hour_files[-1])) as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        last_closed_minute = json.loads(line)[0]
+        return last_closed_minute
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def list_hour_files(self):
+        return sorted([os.path.basename(i) for i in
+                 glob.glob(os.path.join(self.store_dir, '[0-9]*-*-*-*'))])
+
+    def load_new_fingerprints(self):
+        fingerprints_path = os.path.join(self.store_dir, 'fingerprints')
+        if not os.path.exists(fingerprints_path):
+            return
+
+        with open(fingerprints_path) as f:
+            f.seek(self.fingerprints_read)
+            for line in f:
+                if not line.endswith("\n"):  # a torn last write
+                    break
+                fp, norm_text = json.loads(line)
+                self.fp_to_index[fp] = len(self.fingerprints)
+                self.fingerprints.append((fp, norm_text))
+                self.fingerprints_read += len(line)
+
+    def hour_file_of(self, minute):
+        return datetime.strptime(minute, MINUTE_FORMAT).strftime(
+                                                              HOUR_FILE_FORMAT)
+
+    def expire(self):
+        oldest = (datetime.now() - self.retention).strftime(HOUR_FILE_FORMAT)
+        for hour_file in self.list_hour_files():
+            if hour_file < oldest:
+                os.remove(os.path.join(self.store_dir, hour_file))
+
+class LogRollup():
+    """ Follows a glob with a LogAccessor and rolls up its lines into
+        per-minute fingerprint x level counts in a RollupStore. Call poll()
+        periodically; each call reads what was appended since the last one.
+        It is a generator that yields once per line read, for the caller to
+        run it a slice at a time, as hblogd does its scans.
+
+        A minute is closed, and written out, once the logs move past it, or
+        once the wall clock is close_after past its end. The counts honor
+        re_exclude, so only requests with the same re-exclude (and no re)
+        can be answered from them."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, store, re_exclude, backfill_minutes=60,
+                       max_klines_per_poll=200, close_after_secs=120,
+                       verbose=False, debug=False):
+        self.store = store
+        self.log_path_glob = store.log_path_glob
+        self.re_exclude = re_exclude
+        self.max_lines_per_poll = max_klines_per_poll * 1000
+        self.close_after = timedelta(seconds=close_after_secs)
+        self.verbose = verbose
+        self.debug = debug
+
+        self.universal_offset = None  # where the last poll stopped
+        self.polling = False
+        self.log_accessor = None  # of the poll under way
+        self.bytes_read = 0  # by the polls done
+        self.open_minute = None
+        self.open_counts = {}
+
+        backfill_minute = (datetime.now() -
+                    timedelta(minutes=backfill_minutes)).strftime(MINUTE_FORMAT)
+        if store.get_last_closed_minute():
+            # pick up where the last run left off, within the retention
+            self.resume_minute = max(
+                next_minute(store.get_last_closed_minute()),
+                (datetime.now() - store.retention).strftime(MINUTE_FORMAT))
+        else:
+            self.resume_minute = backfill_minute
+
+    def poll(self):
+        self.polling = True
+        try:
+            for _ in self.read_new_lines():
+                yield
+        finally:
+            self.polling = False
+
+    def is_polling(self):
+        """whether a poll was started and has not run to its end"""
+        return self.polling
+
+    def get_bytes_read(self):
+        """of the logs, by all the polls so far"""
+        if self.log_accessor:
+            return self.bytes_read + self.log_accessor.get_bytes_read()
+        return self.bytes_read
+
+    def can_answer(self, re_include, re_exclude):
+        return re_include == [] and list(re_exclude) == list(self.re_exclude)
+
+    def get_store(self):
+        return self.store
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def read_new_lines(self):
+        try:
+            log_accessor = LogAccessor(self.log_path_glob,
+                                       max_klines=20000,
+                                       verbose=self.debug,
+                                       debug=self.debug)
+        except LogAccessorException as e:
+            if self.verbose:
+                self.err("INFO: rollup of %s: %s" % (self.log_path_glob, e))
+            return
+
+        self.log_accessor = log_accessor
+        lines_read = 0
+        try:
+            self.seek(log_accessor)
+
+            for line in log_accessor:
+                self.add_line(line)
+                lines_read += 1
+                if lines_read >= self.max_lines_per_poll:
+                    break
+                yield
+
+            self.universal_offset = log_accessor.get_universal_offset()
+
+        except (LogAccessorException, SingleFileLogAccessorException) as e:
+            self.err("WARNING: rollup of %s caught: %s" %
+                                                       (self.log_path_glob, e))
+            self.universal_offset = None
+        finally:
+            self.bytes_read += log_accessor.get_bytes_read()
+            self.log_accessor = None
+            log_accessor.close_all_files()
+
+        # Quiet logs: close minutes by the clock
+        quiet_until = (datetime.now() - self.close_after).strftime(
+                                                                 MINUTE_FORMAT)
+        if self.open_minute is None:
+            self.open_minute = self.resume_minute
+        if self.open_minute < quiet_until and lines_read < \
+                                                       self.max_lines_per_poll:
+            self.close_minutes_until(quiet_until)
+
+        if self.verbose:
+            self.err("INFO: rollup of %s read %d lines, last closed minute %s" %
+                 (self.log_path_glob, lines_read,
+                  self.store.get_last_closed_minute()))
+
+    def seek(self, log_accessor):
+        if self.universal_offset:
+            try:
+                log_accessor.seek_offset(self.universal_offset)
+                return
+            except LogAccessorException:
+                # e.g. the file got rotated away, start the open minute over
+                if self.verbose:
+                    self.err("INFO: rollup of %s lost its offset, rereading "
+                             "from %s" % (self.log_path_glob,
+                                          self.open_minute))
+                self.resume_minute = self.open_minute or self.resume_minute
+                self.open_minute = None
+                self.open_counts = {}
+
+        log_accessor.seek_time(self.resume_minute)
+
+    def add_line(self, line):
+        line_minute = line['ts'][:16] + ":00"
+
+        if self.open_minute is None:
+            self.open_minute = self.resume_minute
+        if line_minute > self.open_minute:
+            self.close_minutes_until(line_minute)
+
+        for r in self.re_exclude:
+            if re.search(r, line['text'], re.IGNORECASE):
+                return
+
+        key = (line['fp'], line['norm_text'], line['level'])
+        self.open_counts[key] = self.open_counts.get(key, 0) + 1
+
+    def close_minutes_until(self, minute):
+        """closes the open minute, and empty ones after it, up to minute"""
+        while self.open_minute < minute:
+            self.store.write_minute(self.open_minute, self.open_counts)
+            self.open_counts = {}
+            self.open_minute = next_minute(self.open_minute)
+        self.resume_minute = self.open_minute
+
+    def err(self, line):
+        sys.stderr.write(line + "\n")
+
+def next_minute(minute):
+    return (datetime.strptime(minute, MINUTE_FORMAT) +
+                                  timedelta(minutes=1)).strftime(MINUTE_FORMAT)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+
+from SummaryCache import SharedSummaryCache
+
+# The filters hblogd applies, that a cached response may be narrowed down by
+FILTER_KEYS = ['levels-list', 'fp', 'fp-exclude', 're', 're-exclude']
+
+class ResultCache():
+    """ What hosts answered for time windows that are over, on disk, so that
+        the same question need not be asked again. A response is kept under
+        what it is about (host, globs, window, and what shapes the answer),
+        with the filters it was asked with. A later question with the same
+        filters, or for lines, stricter ones the cached response can be
+        narrowed down by, is answered from it: see covers().
+
+        The store is a SharedSummaryCache: a file per response, bounded by
+        the bytes on disk, least recently used evicted first."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, max_bytes, cache_dir):
+        self.max_bytes = max_bytes
+        self.store = SharedSummaryCache(max_bytes, cache_dir)
+
+    def get(self, key, data_type, wanted):
+        """{'filter', 'body'} if the cached response can answer the wanted
+           filter, or None"""
+        cached = self.store.get(key)
+        if cached is None:
+            return None
+        if not covers(cached['filter'], wanted, data_type):
+            return None
+        return cached
+
+    def put(self, key, asked, body):
+        self.store.put(key, {'filter': asked, 'body': body})
+
+    def get_stats(self):
+        return self.store.get_stats()
+
+def covers(asked, wanted, data_type):
+    """Whether every line that the wanted filter lets through, hblogd also
+       let through for the asked one, so that the lines of a stream can be
+       narrowed down locally by the wanted filter. A summary can't be: it
+       has no text, and a fingerprint's count is under one level however
+       many its lines had. It only answers the same filter."""
+    if data_type == 'summary':
+        return same_filter(asked, wanted)
+
+    # Lines of levels that were not asked for are not in the response
+    if not set(asked['levels-list']) >= set(wanted['levels-list']):
+        return False
+
+    if asked['fp']:
+        # hblogd takes every line of the fingerprints, whatever the rest
+        return bool(wanted['fp']) and \
+               all([starts_with_any(fp, asked['fp']) for fp in wanted['fp']])
+
+    if wanted['fp']:
+        return not (asked['fp-exclude'] or asked['re'] or
+                    asked['re-exclude'])
+
+    if not all([starts_with_any(fp, wanted['fp-exclude'])
+                                             for fp in asked['fp-exclude']]):
+        return False
+
+    # Lines that matched none of the asked re are not in the response,
+    # and the wanted ones may take them
+    return (not asked['re'] or set(asked['re']) == set(wanted['re'])) and \
+           set(asked['re-exclude']) <= set(wanted['re-exclude'])
+
+def same_filter(asked, wanted):
+    return all([set(asked[key]) == set(wanted[key]) for key in FILTER_KEYS])
+
+def take_line(line, wanted):
+    """what hblogd would have done with the line, for the wanted filter"""
+    if line['level'] not in wanted['levels-list']:
+        return False
+
+    if wanted['fp']:
+        return starts_with_any(line['fp'], wanted['fp'])
+
+    if starts_with_any(line['fp'], wanted['fp-exclude']):
+        return False
+
+    take_it = not wanted['re']
+    for r in wanted['re']:
+        if re.search(r, line['text'], re.IGNORECASE):
+            take_it = True
+    for r in wanted['re-exclude']:
+        if re.search(r, line['text'], re.IGNORECASE):
+            take_it = False
+    return take_it
+
+def starts_with_any(fp, prefixes):
+    return any([fp.startswith(prefix) for prefix in prefixes])
@@ -28,6 +28,8 @@ import json
 import random
 from datetime import datetime, timedelta
 
+from Stats import stage_timers
+
 class SingleFileLogAccessorException(Exception):
     '''Raised by the SingleFileLogAccessor routines'''
     pass
@@ -44,7 +46,8 @@ class SingleFileLogAccessor():
     # Public
     # --------------------------------------------------------------------------
     def __init__(self, filename,
-        max_klines=2000, sampling_rate=None, verbose=False, debug=False):
+        max_klines=2000, sampling_rate=None, verbose=False, debug=False,
+        hold_partial_line=False):
 
         self.debug = debug
         if self.debug:
@@ -53,7 +56,11 @@ class SingleFileLogAccessor():
             self.verbose = verbose
 
         self.sampling_rate = sampling_rate
+        # Followers leave a last line without its newline for the next read,
+        # as it is likely still being written; scans take it as it is
+        self.hold_partial_line = hold_partial_line
         self.seeking = False
+        self.timed = False  # whether the stages of this line get timed
 
         def syslog_timestamp_transform(s):
             s = re.sub(' ([0-9]) ', r' 0\1 ', s)  # pad with 0s any single digit
@@ -132,15 +139,24 @@ class SingleFileLogAccessor():
         self.FIRST_REC_MAX_LINES = 100
         self.FIRST_REC_MAX_BYTES = 10 * 1000
 
+        # the file is recognized by its device and inode, and by a checksum
+        # of its first bytes in case it was copied (e.g. copytruncate)
+        self.HEAD_CHECKSUM_BYTES = 1024
+
         self.num_unrecognized_lines = 0
         self.bytes_read = 0
         self.lines_read = 0
+        self.bytes_read_at_seek = 0  # the first record is looked for from
+        self.lines_read_at_seek = 0  # the last seek on
 
         self.python_file_object = None
         self.current_offset = None
         self.filename = None
         self.file_size = None
         self.first_rec = None
+        self.dev = None
+        self.ino = None
+        self.head = None
         self.previous_rec = None
         self.next_rec = None
 
@@ -156,7 +172,11 @@ class SingleFileLogAccessor():
             self.err(("WARNING: When reading %s "
                      "lib/SingleFileLogAccessor.py caught: %s") % (filename, e))
         else:
-            self.file_size = os.fstat(self.python_file_object.fileno()).st_size
+            st = os.fstat(self.python_file_object.fileno())
+            self.file_size = st.st_size
+            self.dev = st.st_dev
+            self.ino = st.st_ino
+            self.head = self.get_head_checksum(self.HEAD_CHECKSUM_BYTES)
 
             # Find the first line
             try:
@@ -182,9 +202,29 @@ class SingleFileLogAccessor():
         next_line = 'BOF'
 
         while next_line:
+            self.timed = stage_timers.tick('read')  # time this line's stages
+            if self.timed:
+                t0 = time.time()
+
             self.current_offset = self.get_python_file_object_byte_offset()
             next_line = self.python_file_object.readline(self.MAX_LINE_LENGTH)
 
+            if self.timed:
+                t1 = time.time()
+                stage_timers.add_sample('read', t1 - t0)
+
+            if next_line and not next_line.endswith("\n") and \
+                                     len(next_line) < self.MAX_LINE_LENGTH:
+                if self.hold_partial_line:
+                    # the last line is still being written, leave it to the
+                    # next read after the file grows
+                    self.python_file_object.seek(self.current_offset)
+                    next_line = ''
+                else:
+                    # a file that ends without a newline: its last line is
+                    # whole, and parsed as such
+                    next_line += "\n"
+
             if self.seeking or not self.sampling_rate or \
                                           random.random() <= self.sampling_rate:
                 self.lines_read += 1
@@ -195,14 +235,16 @@ class SingleFileLogAccessor():
                 # If this is the 1st record ...
                 if not current_rec:
                     # First good line must be close the beginning of file
-                    if self.bytes_read > self.FIRST_REC_MAX_BYTES:
+                    if self.bytes_read - self.bytes_read_at_seek > \
+                                                      self.FIRST_REC_MAX_BYTES:
                         raise SingleFileLogAccessorException(
                                     "ERROR: Refusing to read more than "
                                     "%d bytes to find the first record" %
                                     self.FIRST_REC_MAX_BYTES)
 
                     # First good line must be close the beginning of file
-                    if self.lines_read > self.FIRST_REC_MAX_LINES:
+                    if self.lines_read - self.lines_read_at_seek > \
+                                                      self.FIRST_REC_MAX_LINES:
                         raise SingleFileLogAccessorException(
                                     "ERROR: Refusing to read more than "
                                     "%d lines to find the first record" %
@@ -224,6 +266,9 @@ class SingleFileLogAccessor():
                     if self.debug:
                         self.err('DEBUG: next_line """%s"""' % next_line)
 
+                    if self.timed:
+                        t1 = time.time()
+
                     m = False
                     for logline_re in self.LOGLINE_RE_LIST:
                         m = logline_re['re'].match(next_line)
@@ -231,13 +276,21 @@ class SingleFileLogAccessor():
                             if self.debug:
                                 self.err('DEBUG: MATCHED %s' %
                                                        logline_re['re'].pattern)
-
-                            ts = self.str_to_time(m.group(1),
-                                          time_format=logline_re['time_format'],
-                                      transform=logline_re['timestr_transform'])
                             break
 
+                    if self.timed:
+                        t2 = time.time()
+                        stage_timers.add_sample('header-regex', t2 - t1)
+
                     if m:
+                        ts = self.str_to_time(m.group(1),
+                                      time_format=logline_re['time_format'],
+                                      transform=logline_re['timestr_transform'])
+
+                        if self.timed:
+                            stage_timers.add_sample('timestamp-parse',
+                                                    time.time() - t2)
+
                         r = {'ts': str(ts),
                              'level': m.group(3),
                              'text': m.group(4)}
@@ -302,6 +355,33 @@ class SingleFileLogAccessor():
     def get_byte_offset(self):
         return self.current_offset
 
+    def get_universal_offset(self):
+        return {'filename': self.filename,
+                'byte_offset': self.current_offset,
+                'dev': self.dev,
+                'ino': self.ino,
+                'head': self.head}
+
+    def is_same_file(self, universal_offset):
+        """by device and inode, as long as the head still matches"""
+        return self.dev == universal_offset['dev'] and \
+               self.ino == universal_offset['ino'] and \
+               self.has_head(universal_offset['head'])
+
+    def has_head(self, head):
+        if head == self.head:
+            return True
+        length = int(head.split('-')[1])
+        return self.get_head_checksum(length) == head
+
+    def is_renamed(self):
+        """True once the filename points to another file, or to none"""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return True
+        return (st.st_dev, st.st_ino) != (self.dev, self.ino)
+
     def get_bytes_read(self):
         return self.bytes_read
 
@@ -311,8 +391,16 @@ class SingleFileLogAccessor():
     def look_one_rec_ahead(self):
         return self.next_rec
 
+    def get_file_size(self):
+        """current size, the file may have grown since it was opened"""
+        return os.fstat(self.python_file_object.fileno()).st_size
+
     def seek_offset(self, offset):
         self.python_file_object.seek(offset)
+        self.logline_generator = self.next_def()  # restart, it may have
+                                                  # stopped at the end of file
+        self.bytes_read_at_seek = self.bytes_read
+        self.lines_read_at_seek = self.lines_read
         self.seeking = True  # this will turn off sampling and \
                              # unrecognized lines
         self.next()
@@ -357,7 +445,7 @@ class SingleFileLogAccessor():
                 self.err("DEBUG: binsearch trace - ... scan ...")
             self.next()
 
-        self.seeking = True
+        self.seeking = False
 
     # --------------------------------------------------------------------------
     # Private
@@ -368,11 +456,21 @@ class SingleFileLogAccessor():
         there will probably be a lot of weird loglines that
         defeat this, like hex numbers, but it's fine for most """
 
+        if self.timed:
+            t0 = time.time()
+
         for m, r in self.SQUEEZE_RE:
             s = re.sub(m, r, s)
 
+        if self.timed:
+            t1 = time.time()
+            stage_timers.add_sample('squeeze', t1 - t0)
+
         f = hashlib.md5(s).hexdigest()
 
+        if self.timed:
+            stage_timers.add_sample('md5', time.time() - t1)
+
         return (s, f)
 
     def str_to_time(self, s, time_format, transform):
@@ -383,5 +481,13 @@ class SingleFileLogAccessor():
     def err(self, line):
         sys.stderr.write(str(line) + "\n")
 
+    def get_head_checksum(self, length):
+        """md5 of the first length bytes, as "md5-<bytes read>-<hex>" """
+        offset = self.python_file_object.tell()
+        self.python_file_object.seek(0)
+        data = self.python_file_object.read(length)
+        self.python_file_object.seek(offset)
+        return "md5-%d-%s" % (len(data), hashlib.md5(data).hexdigest())
+
     def get_python_file_object_byte_offset(self):
         return self.python_file_object.tell()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from TimeBuckets import merge_histograms
+
+class SpaceSaving():
+    """ Top-limit fingerprints by count, in the mergeable form of the
+        Space-Saving heavy hitters summary. Entries are the 'fp' entries of
+        hblogd summaries: {'fp', 'count', 'level', 'norm_text'}, plus an
+        'error', and a 'histogram' of counts per time bucket if they have
+        one.
+
+        Each entry's count is what was seen of it, a lower bound. A
+        fingerprint that got pruned from a summary was seen at most
+        min_count times there, so merging summaries adds that to the
+        'error' of the entries the other one lacks: count + error is an
+        upper bound. Any fingerprint not in the summary at all was seen at
+        most min_count times."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = {}
+        self.min_count = 0       # upper bound of the count of a missing fp
+        self.dropped_count = 0   # lines of the pruned fingerprints
+        self.dropped_fps = 0
+
+    def add(self, entry):
+        fp = entry['fp']
+        if fp in self.entries:
+            self.entries[fp]['count'] += entry['count']
+            self.entries[fp]['error'] += entry.get('error', 0)
+            self.merge_histogram(self.entries[fp], entry)
+        else:
+            self.entries[fp] = self.copy_entry(entry)
+            self.entries[fp]['error'] = entry.get('error', 0) + self.min_count
+
+        if len(self.entries) > 2 * self.limit:
+            self.prune()
+
+    def merge(self, other):
+        for fp, entry in self.entries.items():
+            if fp not in other.entries:
+                entry['error'] += other.min_count
+
+        for entry in other.entries.values():
+            fp = entry['fp']
+            if fp in self.entries:
+                self.entries[fp]['count'] += entry['count']
+                self.entries[fp]['error'] += entry['error']
+                self.merge_histogram(self.entries[fp], entry)
+            else:
+                self.entries[fp] = self.copy_entry(entry)
+                self.entries[fp]['error'] += self.min_count
+
+        self.min_count += other.min_count
+        self.dropped_count += other.dropped_count
+        self.dropped_fps += other.dropped_fps
+        self.prune()
+
+    def prune(self):
+        """down to the limit"""
+        if len(self.entries) <= self.limit:
+            return
+
+        by_count = sorted(self.entries.values(), key=lambda e: e['count'],
+                          reverse=True)
+        for entry in by_count[self.limit:]:
+            del self.entries[entry['fp']]
+            self.dropped_count += entry['count']
+            self.dropped_fps += 1
+            self.min_count = max(self.min_count, entry['count'])
+
+    def get_entries(self):
+        self.prune()
+        return self.entries
+
+    def get_sketch(self):
+        """what goes with the entries over the wire"""
+        return {'limit': self.limit,
+                'min-count': self.min_count,
+                'dropped-count': self.dropped_count,
+                'dropped-fps': self.dropped_fps}
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def copy_entry(self, entry):
+        copy = dict(entry)
+        if 'histogram' in entry:
+            copy['histogram'] = dict(entry['histogram'])
+        return copy
+
+    def merge_histogram(self, entry, other):
+        if 'histogram' in other:
+            merge_histograms(entry.setdefault('histogram', {}),
+                             other['histogram'])
+
+def from_summary(summary, limit):
+    """the SpaceSaving of a summary, bounded or not"""
+    space_saving = SpaceSaving(limit)
+    for entry in summary['fp'].values():
+        space_saving.add(entry)
+
+    sketch = summary.get('sketch')
+    if sketch:
+        space_saving.min_count = max(space_saving.min_count,
+                                     sketch['min-count'])
+        space_saving.dropped_count += sketch['dropped-count']
+        space_saving.dropped_fps += sketch['dropped-fps']
+
+    space_saving.prune()
+    return space_saving
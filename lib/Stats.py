@@ -0,0 +1,165 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+# Where a scan spends its time, in the order a log line goes through them
+STAGES = ['read', 'header-regex', 'timestamp-parse', 'squeeze', 'md5',
+          'filter', 'json-encode']
+
+class LatencyHistogram():
+    """ Counts of latencies in power of two buckets of milliseconds: the
+        bucket "4" counts the ones from 2ms up to 4ms."""
+
+    MAX_BUCKET_MS = 2 ** 20
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        bucket = 1
+        while bucket < ms and bucket < self.MAX_BUCKET_MS:
+            bucket *= 2
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+        self.count += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def get_percentile(self, percentile):
+        """the bucket the percentile falls in, i.e. an upper bound"""
+        seen = 0
+        for bucket in sorted(self.buckets.keys()):
+            seen += self.buckets[bucket]
+            if seen >= self.count * percentile / 100.0:
+                return bucket
+        return 0
+
+    def get_stats(self):
+        if self.count:
+            avg_ms = self.sum_ms / self.count
+        else:
+            avg_ms = 0.0
+
+        return {'count': self.count,
+                'avg-ms': round(avg_ms, 3),
+                'max-ms': round(self.max_ms, 3),
+                'p50-ms': self.get_percentile(50),
+                'p99-ms': self.get_percentile(99),
+                'buckets': dict([(str(k), v) for k, v in self.buckets.items()])}
+
+class StageTimers():
+    """ Time spent per stage of the scans. Timing every line would cost
+        about as much as some of the stages, so only one line in
+        sample_every is timed, and the totals are extrapolated from those.
+        Stages timed in bulk elsewhere, like the wire format encoders, add
+        exact totals instead."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, sample_every=64):
+        self.sample_every = sample_every
+        self.ticks = dict([(stage, 0) for stage in STAGES])
+        self.samples = dict([(stage, 0) for stage in STAGES])
+        self.sampled_secs = dict([(stage, 0.0) for stage in STAGES])
+        self.lines = dict([(stage, 0) for stage in STAGES])
+        self.secs = dict([(stage, 0.0) for stage in STAGES])
+
+    def tick(self, stage):
+        """True when this line is to be timed"""
+        self.ticks[stage] += 1
+        if self.ticks[stage] >= self.sample_every:
+            self.ticks[stage] = 0
+            return True
+        return False
+
+    def add_sample(self, stage, secs):
+        self.samples[stage] += 1
+        self.sampled_secs[stage] += secs
+
+    def add_total(self, stage, lines, secs):
+        self.lines[stage] += lines
+        self.secs[stage] += secs
+
+    def get_stats(self):
+        stats = {}
+        for stage in STAGES:
+            lines = self.lines[stage] + self.samples[stage] * self.sample_every
+            secs = self.secs[stage] + \
+                               self.sampled_secs[stage] * self.sample_every
+            if lines:
+                usecs_per_line = 1000000 * secs / lines
+            else:
+                usecs_per_line = 0.0
+
+            stats[stage] = {'lines': lines,
+                            'secs': round(secs, 3),
+                            'usecs-per-line': round(usecs_per_line, 2)}
+        return stats
+
+class Stats():
+    """ Request counts and latencies per endpoint, and what the scans
+        behind them read, for hblogd's /stats"""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.start_time = time.time()
+        self.endpoints = {}
+        self.lines_scanned = 0
+        self.bytes_scanned = 0
+        self.subscriptions = 0
+        self.coalesced = 0  # requests that shared the scan of another
+
+    def add_request(self, endpoint, status, secs):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {'statuses': {},
+                                        'latency': LatencyHistogram()}
+        stats = self.endpoints[endpoint]
+        stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+        stats['latency'].add(1000 * secs)
+
+    def add_scan(self, lines, num_bytes):
+        self.lines_scanned += lines
+        self.bytes_scanned += num_bytes
+
+    def get_stats(self):
+        endpoints = {}
+        for endpoint, stats in self.endpoints.items():
+            endpoints[endpoint] = {
+                'requests': stats['latency'].count,
+                'statuses': dict([(str(k), v) for k, v in
+                                                   stats['statuses'].items()]),
+                'latency': stats['latency'].get_stats()}
+
+        return {'uptime-secs': round(time.time() - self.start_time, 1),
+                'endpoints': endpoints,
+                'lines-scanned': self.lines_scanned,
+                'bytes-scanned': self.bytes_scanned,
+                'subscriptions': self.subscriptions,
+                'coalesced-requests': self.coalesced,
+                'stages': stage_timers.get_stats()}
+
+# One per process, so that the accessors of every request add up into it
+stage_timers = StageTimers()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import heapq
+import time
+from collections import deque
+
+class StreamMergerException(Exception):
+    pass
+
+class StreamMerger():
+    """ Merges streams of records, each already in order of 'ts', into one
+        stream in order of 'ts', while they are still arriving.
+
+        A record can go out once no open stream can still send an earlier
+        one: the low watermark is the last ts of the stream that is furthest
+        behind, and a stream that sent nothing yet holds everything back.
+        So that a stream that is slow to start does not make the others pile
+        up without bound, at most max_buffered records are held on to; past
+        that the earliest ones go out anyway, and whatever the slow stream
+        sends from before them later goes out as soon as it arrives.
+
+        Streams that may never end, like those of --follow, can also have a
+        max_delay: no record is held on to for longer than that many
+        seconds, however far behind an idle stream is."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, max_buffered, max_delay=None):
+        self.max_buffered = max_buffered
+        self.max_delay = max_delay
+
+        self.buffers = {}       # stream -> deque of records
+        self.last_ts = {}       # open stream -> ts of its last record
+        self.open_heap = []     # (last ts, stream), stale entries skipped
+        self.ready_heap = []    # (ts of first buffered record, seq, stream)
+        self.seq = 0            # keeps records of equal ts in arrival order
+        self.num_buffered = 0
+        self.num_forced = 0     # records that went out past max_buffered
+
+        # With max_delay, [arrival time, records left] of each push, of all
+        # streams in order of arrival and of each stream
+        self.arrivals = deque()
+        self.stream_arrivals = {}
+
+    def open(self, stream):
+        if stream in self.buffers:
+            raise StreamMergerException("Stream %s is already open" %
+                                                                (stream,))
+        self.buffers[stream] = deque()
+        self.last_ts[stream] = ''
+        heapq.heappush(self.open_heap, ('', stream))
+
+    def is_open(self, stream):
+        return stream in self.last_ts
+
+    def push(self, stream, records):
+        if stream not in self.last_ts:
+            raise StreamMergerException("Stream %s is not open" % (stream,))
+        if not records:
+            return
+
+        buf = self.buffers[stream]
+        if not buf:
+            self.push_ready(records[0]['ts'], stream)
+        buf.extend(records)
+        self.num_buffered += len(records)
+
+        if self.max_delay is not None:
+            arrival = [time.time(), len(records)]
+            self.arrivals.append(arrival)
+            self.stream_arrivals.setdefault(stream, deque()).append(arrival)
+
+        self.last_ts[stream] = records[-1]['ts']
+        if len(self.open_heap) > 2 * len(self.last_ts) + 64:
+            # mostly stale entries of streams that have gone further
+            self.open_heap = [(ts, s) for s, ts in self.last_ts.items()]
+            heapq.heapify(self.open_heap)
+        else:
+            heapq.heappush(self.open_heap, (self.last_ts[stream], stream))
+
+    def close(self, stream):
+        """no more records will come for stream"""
+        self.last_ts.pop(stream, None)
+        if stream in self.buffers and not self.buffers[stream]:
+            del self.buffers[stream]
+
+    def close_all(self):
+        """no more records will come at all"""
+        for stream in self.last_ts.keys():
+            self.close(stream)
+
+    def pop_ready(self):
+        """the records that can go out, in order"""
+        watermark = self.get_watermark()
+        now = time.time()
+
+        ready = []
+        while self.ready_heap:
+            ts, _, stream = self.ready_heap[0]
+            if watermark is not None and ts > watermark:
+                if self.num_buffered > self.max_buffered:
+                    self.num_forced += 1
+                elif not self.has_expired(now):
+                    break
+
+            heapq.heappop(self.ready_heap)
+            buf = self.buffers[stream]
+            ready.append(buf.popleft())
+            self.num_buffered -= 1
+            if self.max_delay is not None:
+                self.pop_arrival(stream)
+            if buf:
+                self.push_ready(buf[0]['ts'], stream)
+            elif stream not in self.last_ts:
+                del self.buffers[stream]  # closed and drained
+
+        return ready
+
+    def get_waiting_on(self):
+        """the open stream the others are waiting for, if any"""
+        self.get_watermark()
+        if self.open_heap:
+            return self.open_heap[0][1]
+        return None
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def push_ready(self, ts, stream):
+        self.seq += 1
+        heapq.heappush(self.ready_heap, (ts, self.seq, stream))
+
+    def has_expired(self, now):
+        """whether a record has been held on to for max_delay"""
+        if self.max_delay is None:
+            return False
+        while self.arrivals and self.arrivals[0][1] == 0:
+            self.arrivals.popleft()
+        return bool(self.arrivals) and \
+               self.arrivals[0][0] <= now - self.max_delay
+
+    def pop_arrival(self, stream):
+        """a record of stream went out, the oldest of it still held"""
+        arrivals = self.stream_arrivals[stream]
+        arrivals[0][1] -= 1
+        if arrivals[0][1] == 0:
+            arrivals.popleft()
+            if not arrivals:
+                del self.stream_arrivals[stream]
+
+    def get_watermark(self):
+        """the ts up to which all open streams have sent their records, or
+           None once all of them are closed"""
+        while self.open_heap:
+            ts, stream = self.open_heap[0]
+            if self.last_ts.get(stream) == ts:
+                return ts
+            heapq.heappop(self.open_heap)  # closed, or has gone further
+
+        return None
@@ -0,0 +1,215 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import json
+import errno
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+class SummaryCache():
+    """ LRU cache of the summaries of closed (completed) minutes. A closed
+        minute never changes, so its summary can be reused by every later
+        request with the same glob, files and filters. Bounded by an
+        estimate of the memory the cached summaries take."""
+
+    # Rough per-fingerprint cost of a summary entry, on top of its norm_text
+    FP_ENTRY_OVERHEAD = 400
+    SUMMARY_OVERHEAD = 1000
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()  # key -> (summary, size), oldest first
+        self.bytes_used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            summary, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries[key] = (summary, size)  # most recently used goes last
+        self.hits += 1
+        return summary
+
+    def put(self, key, summary):
+        size = self.estimate_size(summary)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.bytes_used -= self.entries.pop(key)[1]
+
+        while self.entries and self.bytes_used + size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes_used -= evicted_size
+            self.evictions += 1
+
+        self.entries[key] = (summary, size)
+        self.bytes_used += size
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit-rate': round(hit_rate, 3),
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes-used': self.bytes_used,
+                'max-bytes': self.max_bytes}
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def estimate_size(self, summary):
+        size = self.SUMMARY_OVERHEAD
+        for fp_summary in summary['fp'].values():
+            size += self.FP_ENTRY_OVERHEAD + len(fp_summary['norm_text'])
+        return size
+
+class SharedSummaryCache():
+    """ The SummaryCache of hblogd's pre-forked workers, shared between them
+        as one file per summary in cache_dir, best on a tmpfs like /dev/shm.
+        A closed minute's summary never changes, so workers need no locking:
+        a summary is written to a temporary file and renamed into place, and
+        whichever worker writes it last wins with the same content.
+
+        Bounded by the bytes of the files. Hits touch their file, and when
+        the cache grows over max_bytes the least recently touched files go,
+        down to EVICT_TO of it."""
+
+    EVICT_TO = 0.75
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, max_bytes, cache_dir):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.bytes_used = self.get_bytes_on_disk()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        path = self.path_of(key)
+        try:
+            with open(path) as f:
+                summary = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return summary
+
+    def put(self, key, summary):
+        data = json.dumps(summary, separators=(',', ':'))
+        if len(data) > self.max_bytes:
+            return
+
+        if self.bytes_used + len(data) > self.max_bytes:
+            self.evict()
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path_of(key))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self.bytes_used += len(data)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit-rate': round(hit_rate, 3),
+                'evictions': self.evictions,
+                'bytes-used': self.bytes_used,
+                'max-bytes': self.max_bytes,
+                'cache-dir': self.cache_dir}
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def path_of(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(repr(key)).hexdigest())
+
+    def list_files(self):
+        """[(mtime, size, path)] of the cached summaries, of all workers"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # evicted by another worker
+            files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def get_bytes_on_disk(self):
+        return sum([size for _, size, _ in self.list_files()])
+
+    def evict(self):
+        files = sorted(self.list_files())
+        self.bytes_used = sum([size for _, size, _ in files])
+
+        for _, size, path in files:
+            if self.bytes_used <= self.max_bytes * self.EVICT_TO:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            self.bytes_used -= size
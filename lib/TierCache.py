@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import errno
+import json
+import time
+import tempfile
+
+class TierCache():
+    """ The hosts of each tier, as list_hosts_of_tier last listed them, kept
+        for ttl_secs in one json file, so that runs of hblog in quick
+        succession don't each list them again. The file is written to a
+        temporary file and renamed into place: runs that overlap see the
+        whole of one or the other, and the last one wins."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, path, ttl_secs):
+        self.path = path
+        self.ttl_secs = ttl_secs
+        self.tiers = self.load()
+        self.changed = False
+
+    def get(self, key):
+        """the hosts, or None if not listed within ttl_secs"""
+        entry = self.tiers.get(key)
+        if entry is None or not self.is_fresh(entry):
+            return None
+        # str, as listed, rather than the unicode json loads them as: they
+        # go into the keys of other caches
+        return [str(host) for host in entry['hosts']]
+
+    def put(self, key, hosts):
+        self.tiers[key] = {'hosts': hosts, 'time': time.time()}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+
+        tiers = dict((key, entry) for key, entry in self.tiers.items()
+                                                  if self.is_fresh(entry))
+        cache_dir = os.path.dirname(self.path)
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tiers, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        self.changed = False
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def load(self):
+        try:
+            with open(self.path) as f:
+                tiers = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if not isinstance(tiers, dict):
+            return {}
+        return tiers
+
+    def is_fresh(self, entry):
+        age = time.time() - entry.get('time', 0)
+        return 0 <= age <= self.ttl_secs
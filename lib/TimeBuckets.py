@@ -0,0 +1,87 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import calendar
+
+# Bucket widths in seconds that line up with the clock
+NICE_WIDTHS = [1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200,
+               10800, 21600, 43200, 86400]
+
+# Per fingerprint, in one histogram: narrower buckets over a longer window
+# are refused
+MAX_TIME_BUCKETS = 10000
+
+class TimeBuckets():
+    """ Buckets of width seconds, aligned to local midnight so that every
+        host and every request agrees on them, and named by the local time
+        they start at, in the format of log line timestamps. Edges are
+        worked out on the clock time of the log lines as is: like the rest
+        of hblog, makes no attempt to understand daylight savings."""
+
+    TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, width):
+        self.width = width
+        self.minute_epochs = {}  # parsing timestamps is slow, minutes repeat
+        self.names = {}
+
+    def bucket_of(self, ts):
+        """ts is a log line timestamp, "YYYY-MM-DD hh:mm:ss[.ffffff]" """
+        minute = ts[:16]
+        epoch = self.minute_epochs.get(minute)
+        if epoch is None:
+            epoch = calendar.timegm(time.strptime(minute, "%Y-%m-%d %H:%M"))
+            self.minute_epochs[minute] = epoch
+
+        seconds = epoch + int(ts[17:19])
+        return self.name_of(seconds - seconds % self.width)
+
+    def get_range(self, first_ts, last_ts):
+        """the names of the buckets from the one of first_ts to the one of
+           last_ts"""
+        first = self.epoch_of(self.bucket_of(first_ts))
+        last = self.epoch_of(self.bucket_of(last_ts))
+        return [self.name_of(i) for i in range(first, last + 1, self.width)]
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def name_of(self, epoch):
+        name = self.names.get(epoch)
+        if name is None:
+            name = time.strftime(self.TS_FORMAT, time.gmtime(epoch))
+            self.names[epoch] = name
+        return name
+
+    def epoch_of(self, name):
+        return calendar.timegm(time.strptime(name, self.TS_FORMAT))
+
+def nice_width(secs):
+    """the smallest nice width that is at least secs"""
+    for width in NICE_WIDTHS:
+        if width >= secs:
+            return width
+    return NICE_WIDTHS[-1] * ((int(secs) + NICE_WIDTHS[-1] - 1) /
+                                                             NICE_WIDTHS[-1])
+
+def merge_histograms(histogram, other):
+    """adds the counts per bucket of other into histogram"""
+    for bucket, count in other.items():
+        histogram[bucket] = histogram.get(bucket, 0) + count
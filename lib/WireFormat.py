@@ -0,0 +1,346 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import json
+import zlib
+
+# Wire formats understood by hblogd's /log/stream. The first one is the
+# fallback that every hblogd version speaks.
+WIRE_FORMATS = ['json', 'frames']
+
+# HTTP content encodings hblog and hblogd can negotiate. 'deflate' is the
+# zlib format, as in RFC 2616.
+CONTENT_ENCODINGS = ['gzip', 'deflate']
+
+# hblogd listens here, unless a host is given as host:port
+HBLOGD_PORT = 6957
+
+class WireFormatException(Exception):
+    '''Raised by the WireFormat routines'''
+    pass
+
+class JsonLinesEncoder():
+    """ One json package per log line, e.g.
+            {"pkg-cls": "log-accessor-line", "pkg-obj": {"ts": ...}}
+        Repeats key names, the fingerprint and the norm_text in every line,
+        but any hblog client can read it."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.num_records = 0
+        self.bytes_written = 0
+        self.encode_cpu_secs = 0.0
+
+    def add(self, rec):
+        """returns the string to write out, or None"""
+        t0 = time.clock()
+        out = "%s\n" % json.dumps({'pkg-cls': 'log-accessor-line',
+                                   'pkg-obj': rec})
+        self.encode_cpu_secs += time.clock() - t0
+
+        self.num_records += 1
+        self.bytes_written += len(out)
+        return out
+
+    def flush(self):
+        return None
+
+    def get_stats(self):
+        return get_stats(self.num_records, self.bytes_written,
+                         self.encode_cpu_secs)
+
+class FrameEncoder():
+    """ Columnar batches of log lines, e.g.
+            {"pkg-cls": "log-accessor-frame",
+             "pkg-obj": {"dict": [["<fp>", "<norm_text>"], ...],
+                         "ts": [...], "level": [...], "text": [...],
+                         "fp": [<dict index>, ...],
+                         "unrecognized_line": [<row>, ...]}}
+        Each fingerprint and its norm_text go out once per response, in the
+        "dict" of the first frame that needs them. Later frames refer to them
+        by index. Lines relayed from other hosts also have a "host" column."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+        self.num_records = 0
+        self.bytes_written = 0
+        self.encode_cpu_secs = 0.0
+
+        self.fp_to_index = {}
+        self.new_fps = []
+        self.reset_frame()
+
+    def add(self, rec):
+        """returns the string to write out, or None while batching"""
+        t0 = time.clock()
+
+        fp = rec['fp']
+        if fp not in self.fp_to_index:
+            self.fp_to_index[fp] = len(self.fp_to_index)
+            self.new_fps.append([fp, rec['norm_text']])
+
+        if rec.get('unrecognized_line'):
+            self.frame['unrecognized_line'].append(len(self.frame['ts']))
+        if 'host' in rec or 'host' in self.frame:
+            self.frame.setdefault('host', [None] * len(self.frame['ts']))
+            self.frame['host'].append(rec.get('host'))
+        self.frame['ts'].append(rec['ts'])
+        self.frame['level'].append(rec['level'])
+        self.frame['text'].append(rec['text'])
+        self.frame['fp'].append(self.fp_to_index[fp])
+
+        self.encode_cpu_secs += time.clock() - t0
+
+        self.num_records += 1
+        if len(self.frame['ts']) >= self.batch_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """returns the pending frame as a string, or None if there is none"""
+        if len(self.frame['ts']) == 0:
+            return None
+
+        t0 = time.clock()
+        self.frame['dict'] = self.new_fps
+        out = "%s\n" % json.dumps({'pkg-cls': 'log-accessor-frame',
+                                   'pkg-obj': self.frame},
+                                  separators=(',', ':'))
+        self.new_fps = []
+        self.reset_frame()
+        self.encode_cpu_secs += time.clock() - t0
+
+        self.bytes_written += len(out)
+        return out
+
+    def get_stats(self):
+        return get_stats(self.num_records, self.bytes_written,
+                         self.encode_cpu_secs)
+
+    # --------------------------------------------------------------------------
+    # Private
+    # --------------------------------------------------------------------------
+    def reset_frame(self):
+        self.frame = {'ts': [], 'level': [], 'text': [], 'fp': [],
+                      'unrecognized_line': []}
+
+class FrameDecoder():
+    """ Turns the frames of one response back into log line dicts, the same
+        as those of the json format. The fingerprint dictionary is kept for
+        the whole response, so use one FrameDecoder per response."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.dictionary = []
+
+    def decode(self, frame):
+        for fp, norm_text in frame['dict']:
+            self.dictionary.append((fp, norm_text))
+
+        unrecognized = set(frame['unrecognized_line'])
+        hosts = frame.get('host')
+        recs = []
+        try:
+            for row in range(len(frame['ts'])):
+                fp, norm_text = self.dictionary[frame['fp'][row]]
+                rec = {'ts': frame['ts'][row],
+                       'level': frame['level'][row],
+                       'text': frame['text'][row],
+                       'fp': fp,
+                       'norm_text': norm_text}
+                if row in unrecognized:
+                    rec['unrecognized_line'] = True
+                if hosts and hosts[row] is not None:
+                    rec['host'] = hosts[row]
+                recs.append(rec)
+        except IndexError:
+            raise WireFormatException("Frame refers to a fingerprint that "
+                                      "was never sent")
+
+        return recs
+
+class ContentEncoder():
+    """ Incremental gzip/zlib compression of a response body. Every chunk
+        but the last is sync-flushed, so a reader can decode each chunk as
+        soon as it arrives."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self, encoding, level):
+        if encoding not in CONTENT_ENCODINGS:
+            raise WireFormatException("Unknown content encoding %s" % encoding)
+
+        self.encoding = encoding
+        self.compressobj = zlib.compressobj(level, zlib.DEFLATED,
+                                            zlib_wbits(encoding))
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_secs = 0.0
+
+    def compress(self, chunk, finishing):
+        t0 = time.clock()
+        if finishing:
+            flush_mode = zlib.Z_FINISH
+        else:
+            flush_mode = zlib.Z_SYNC_FLUSH
+        out = self.compressobj.compress(chunk) + \
+                                           self.compressobj.flush(flush_mode)
+        self.cpu_secs += time.clock() - t0
+
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(out)
+        return out
+
+    def get_stats(self):
+        return get_compression_stats(self.encoding, self.bytes_in,
+                                     self.bytes_out, self.cpu_secs)
+
+class ContentDecoder():
+    """ Incremental decoding of a response body as chunks come off the
+        wire. Feed it the response header lines first, so it can see the
+        Content-Encoding; without one the body is passed through."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.encoding = None
+        self.decompressobj = None
+        self.body_chunks = []
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_secs = 0.0
+
+    def header_line(self, line):
+        if line.lower().startswith('content-encoding:'):
+            encoding = line.split(':', 1)[1].strip().lower()
+            if encoding in CONTENT_ENCODINGS:
+                self.encoding = encoding
+                self.decompressobj = zlib.decompressobj(zlib_wbits(encoding))
+
+    def decompress(self, chunk):
+        t0 = time.clock()
+        if self.decompressobj:
+            data = self.decompressobj.decompress(chunk)
+        else:
+            data = chunk
+        self.cpu_secs += time.clock() - t0
+
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(data)
+        return data
+
+    def append(self, chunk):
+        """streaming_callback that keeps the decoded body around"""
+        self.body_chunks.append(self.decompress(chunk))
+
+    def get_body(self):
+        return "".join(self.body_chunks)
+
+    def get_stats(self):
+        return get_compression_stats(self.encoding, self.bytes_out,
+                                     self.bytes_in, self.cpu_secs)
+
+class PackageReader():
+    """ Splits a response body into json packages as it arrives, keeping
+        any partial line for the next chunk."""
+
+    # --------------------------------------------------------------------------
+    # Public
+    # --------------------------------------------------------------------------
+    def __init__(self):
+        self.partial_line = ''
+
+    def feed(self, data):
+        lines = (self.partial_line + data).split("\n")
+        self.partial_line = lines.pop()
+        return [json.loads(line) for line in lines if line]
+
+def universal_offset_to_token(universal_offset):
+    """the universal-offset url arg, e.g. a follower's next request. Offsets
+       from older hblogd's only have a filename and byte offset."""
+    if universal_offset.get('ino') is None:
+        return "%s:%s" % (universal_offset['filename'],
+                          universal_offset['byte_offset'])
+
+    return "%s:%d:%d:%d:%s" % (universal_offset['filename'],
+                               universal_offset['byte_offset'],
+                               universal_offset['dev'],
+                               universal_offset['ino'],
+                               universal_offset['head'])
+
+def token_to_universal_offset(token):
+    parts = token.rsplit(':', 4)
+    if len(parts) == 5 and parts[4].startswith('md5-'):
+        filename, byte_offset, dev, ino, head = parts
+        return {'filename': filename,
+                'byte_offset': int(byte_offset),
+                'dev': int(dev),
+                'ino': int(ino),
+                'head': head}
+
+    filename, byte_offset = token.rsplit(':', 1)
+    return {'filename': filename,
+            'byte_offset': int(byte_offset)}
+
+def host_port(host):
+    """where the hblogd of host listens, as host:port"""
+    if ':' in host:
+        return host
+    return "%s:%d" % (host, HBLOGD_PORT)
+
+def zlib_wbits(encoding):
+    if encoding == 'gzip':
+        return 16 + zlib.MAX_WBITS  # gzip header and trailer
+    else:
+        return zlib.MAX_WBITS
+
+def get_compression_stats(encoding, raw_bytes, wire_bytes, cpu_secs):
+    if wire_bytes:
+        ratio = float(raw_bytes) / wire_bytes
+    else:
+        ratio = 1.0
+
+    return {'encoding': encoding or 'identity',
+            'raw-bytes': raw_bytes,
+            'wire-bytes': wire_bytes,
+            'ratio': round(ratio, 2),
+            'cpu-secs': round(cpu_secs, 6)}
+
+def get_stats(num_records, num_bytes, cpu_secs):
+    if num_records:
+        bytes_per_record = float(num_bytes) / num_records
+        usecs_per_record = 1000000 * cpu_secs / num_records
+    else:
+        bytes_per_record = 0.0
+        usecs_per_record = 0.0
+
+    return {'records': num_records,
+            'bytes': num_bytes,
+            'bytes-per-record': round(bytes_per_record, 1),
+            'cpu-secs': round(cpu_secs, 6),
+            'cpu-usecs-per-record': round(usecs_per_record, 2)}
@@ -20,49 +20,242 @@ import os
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 
 import re
+import glob
 
 import sys
+import urllib
 import urlparse
 import pprint
 from datetime import datetime, timedelta
 import json
+import time
+import functools
+import subprocess
+import shutil
 
 sys.path.insert(0, SCRIPT_PATH + '/../tornado')
 import tornado.ioloop
 import tornado.web
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+import tornado.httpclient
 
 sys.path.insert(0, SCRIPT_PATH + '/../lib')
 from LogAccessor import LogAccessor, LogAccessorException
+from SingleFileLogAccessor import SingleFileLogAccessorException
+from SummaryCache import SummaryCache, SharedSummaryCache
+from AdmissionControl import AdmissionControl
+from Stats import Stats, stage_timers
+import SpaceSaving
+from TimeBuckets import TimeBuckets, merge_histograms, MAX_TIME_BUCKETS
+from LogRollup import LogRollup, RollupStore
+from WireFormat import WIRE_FORMATS, JsonLinesEncoder, FrameEncoder, \
+    FrameDecoder, CONTENT_ENCODINGS, ContentEncoder, ContentDecoder, \
+    PackageReader, token_to_universal_offset, universal_offset_to_token, \
+    HBLOGD_PORT, host_port
+from StreamMerger import StreamMerger
 
 ALL_LEVELS = ["INFO", "DEBUG", "WARN", "ERROR", "FATAL"]
 
+# Gaps in the logs longer than this are rescanned rather than cached
+MAX_CACHED_EMPTY_MINUTES = 24 * 60
+
+SCAN_SLICE_SECS = 0.05  # how long a scan runs before giving way
+ROLLUP_LINES_PER_SLICE = 2000  # and a rollup poll, at most
+
+# What makes two scans the same, for coalescing: the url args the scans
+# depend on, with start and end to the second. A scan stops at its client's
+# deadline, so only clients with the same deadline share one.
+COALESCING_ARGS = ['glob', 'data_type', 'start', 'end', 'universal-offset',
+                   'resume-offset', 'levels-list', 'fp', 'fp-exclude', 're',
+                   're-exclude', 'sampling-rate', 'wire-format', 'limit',
+                   'bucket', 'mode', 'deadline-secs']
+MAX_COALESCING_REPLAY_BYTES = 16 * 1024 * 1024
+
+# A relay gives the hosts it asks a little less time than it was given, so
+# that it can still answer with what it has
+RELAY_DEADLINE_MARGIN_SECS = 2.0
+RELAY_REQUEST_TIMEOUT_SECS = 60.0  # when the client sent no deadline
+RELAY_CONNECT_TIMEOUT_SECS = 2.0
+RELAY_MAX_BUFFERED_LINES = 200000
+
 def err(line):
     if not isinstance(line, basestring):
         line = pprint.pformat(line)
     sys.stderr.write(line + "\n")
 
-def summarize(results):
-    fingerprint_summary = {}
-    level_summary = {}
-    regex_summary = {}
-    level_summary = dict(zip(ALL_LEVELS, (0, 0, 0, 0, 0)))
+def new_summary():
+    return {'level': dict(zip(ALL_LEVELS, (0, 0, 0, 0, 0))),
+            'fp': {},
+            'regex': {}}
+
+def add_to_summary(summary, logline, count=1, bucket=None):
+    """bucket is the name of the time bucket to count the line in, when
+       the summary has per fingerprint histograms"""
+    fingerprint_summary = summary['fp']
+
+    summary['level'][logline[r'level']] += count
+
+    if logline[r'fp'] not in fingerprint_summary:
+        fingerprint_summary[logline[r'fp']] = \
+            {'fp': logline[r'fp'], 'count': 0,
+             'level': logline[r'level'],
+             'norm_text': logline[r'norm_text']}
+    fingerprint_summary[logline[r'fp']]['count'] += count
+
+    if bucket:
+        add_to_histogram(fingerprint_summary[logline[r'fp']], bucket, count)
+
+def add_to_histogram(entry, bucket, count):
+    histogram = entry.setdefault('histogram', {})
+    histogram[bucket] = histogram.get(bucket, 0) + count
+
+def merge_summary(summary, other, bucket=None):
+    """adds other into summary, leaves other untouched. With a bucket, all
+       of other is counted in that time bucket."""
+    for level, count in other['level'].items():
+        summary['level'][level] += count
+
+    for fp, value in other['fp'].items():
+        if fp in summary['fp']:
+            summary['fp'][fp]['count'] += value['count']
+            if 'histogram' in value:
+                merge_histograms(summary['fp'][fp].setdefault('histogram', {}),
+                                 value['histogram'])
+        else:
+            summary['fp'][fp] = dict(value)
+            if 'histogram' in value:
+                summary['fp'][fp]['histogram'] = dict(value['histogram'])
+
+        if bucket:
+            add_to_histogram(summary['fp'][fp], bucket, value['count'])
+
+def summarize(results, time_buckets=None):
+    summary = new_summary()
 
     for logline in results:
-        level_summary[logline[r'level']] += 1
+        if time_buckets:
+            add_to_summary(summary, logline,
+                           bucket=time_buckets.bucket_of(logline['ts']))
+        else:
+            add_to_summary(summary, logline)
 
-        if logline[r'fp'] not in fingerprint_summary:
-            fingerprint_summary[logline[r'fp']] = \
-                {'fp': logline[r'fp'], 'count': 0,
-                 'level': logline[r'level'],
-                 'norm_text': logline[r'norm_text']}
-        fingerprint_summary[logline[r'fp']]['count'] += 1
+    return summary
 
-    summary = {'level': level_summary,
-               'fp': fingerprint_summary,
-               'regex': regex_summary}
+def poll_rollup(rollup, admission, poll=None):
+    """runs a poll of rollup a slice at a time, like the scans, for the
+       requests to get their turn in between, and within the same budgets:
+       a poll takes one of the concurrent scans, or waits for the next
+       interval, and its reads are throttled with theirs. A poll still
+       running when the next one is due is left to finish."""
+    if poll is None:
+        if rollup.is_polling() or admission.admit():
+            return
+        poll = rollup.poll()
 
+    bytes_read = rollup.get_bytes_read()
+    slice_end = time.time() + SCAN_SLICE_SECS
+    try:
+        for _ in xrange(ROLLUP_LINES_PER_SLICE):
+            poll.next()
+            if time.time() >= slice_end:
+                break
+    except StopIteration:
+        admission.charge(rollup.get_bytes_read() - bytes_read)
+        admission.release()
+        return
+    except Exception:
+        admission.release()
+        raise
+
+    delay = admission.charge(rollup.get_bytes_read() - bytes_read)
+    tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
+                    functools.partial(poll_rollup, rollup, admission, poll))
+
+def bound_summary(summary, limit):
+    """leaves only the top limit fingerprints in summary"""
+    space_saving = SpaceSaving.from_summary(summary, limit)
+    summary['fp'] = space_saving.get_entries()
+    summary['sketch'] = space_saving.get_sketch()
     return summary
 
+def minute_of(ts):
+    return ts[:16] + ":00"
+
+def next_minute(minute):
+    return str(datetime.strptime(minute, "%Y-%m-%d %H:%M:%S") +
+               timedelta(minutes=1))
+
+def first_full_minute(ts):
+    minute = minute_of(ts)
+    if minute < ts.split('.')[0]:
+        minute = next_minute(minute)
+    return minute
+
+def file_identity(logs_glob):
+    """changes when files come and go, e.g. on log rotation, but not when
+       they grow"""
+    identity = []
+    for filename in sorted(glob.glob(logs_glob)):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        identity.append((filename, st.st_dev, st.st_ino))
+    return tuple(identity)
+
+def lower_priority(nice, ionice):
+    """hblogd shares the box with the regionserver or datanode, which come
+       first"""
+    if nice:
+        os.nice(nice)
+
+    if ionice != 'none':
+        ionice_args = {'best-effort': ['-c', '2', '-n', '7'],
+                       'idle': ['-c', '3']}[ionice]
+        try:
+            subprocess.check_call(['ionice'] + ionice_args +
+                                  ['-p', str(os.getpid())])
+        except (OSError, subprocess.CalledProcessError) as e:
+            err("WARNING: could not ionice hblogd: %s" % e)
+
+class CompressionTransform(tornado.web.OutputTransform):
+    """gzip or zlib content encoding, whichever the client accepts first"""
+
+    def __init__(self, request, level, verbose):
+        self.encoder = None
+        self.uri = request.uri
+
+        if level > 0 and request.supports_http_1_1():
+            accepted = [e.split(';')[0].strip() for e in
+                            request.headers.get("Accept-Encoding", "").split(',')]
+            for encoding in accepted:
+                if encoding in CONTENT_ENCODINGS:
+                    self.encoder = ContentEncoder(encoding, level)
+                    break
+
+        self.verbose = verbose
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if self.encoder and "Content-Encoding" not in headers:
+            headers["Content-Encoding"] = self.encoder.encoding
+            chunk = self.transform_chunk(chunk, finishing)
+            if "Content-Length" in headers:
+                headers["Content-Length"] = str(len(chunk))
+        else:
+            self.encoder = None
+
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self.encoder:
+            chunk = self.encoder.compress(chunk, finishing)
+            if finishing and self.verbose:
+                err("compression %s: %s" % (self.uri.split('?')[0],
+                                            self.encoder.get_stats()))
+        return chunk
+
 class HBLogHandlersParent(tornado.web.RequestHandler):
     def parse_url_args(self):
         url_args = urlparse.parse_qs(self.request.query)
@@ -91,28 +284,269 @@ class HBLogHandlersParent(tornado.web.RequestHandler):
 
         self.url_args = url_args
 
-    def fetch_and_filter(self, log_accessor):
-        if self.url_args.has_key("universal-offset"):
-            filename, byte_offset = \
-                                 self.url_args["universal-offset"][0].split(':')
-            universal_offset = {'byte_offset': int(byte_offset),
-                                'filename': filename}
+    def get_encoder(self):
+        # The client asks for a wire format; old clients don't, and get json
+        wire_format = self.url_args.get('wire-format', ['json'])[0]
+        if wire_format not in WIRE_FORMATS:
+            wire_format = WIRE_FORMATS[0]
+        self.wire_format = wire_format
+        self.set_header("X-Hblog-Wire-Format", wire_format)
+
+        if wire_format == 'frames':
+            return wire_format, FrameEncoder()
+        else:
+            return wire_format, JsonLinesEncoder()
+
+    def start_scan(self, scan, max_klines):
+        """Runs scan(log_accessor), a generator that yields once per line
+           it reads, a slice at a time, so that scans take turns with each
+           other and with the other requests. Within the budgets of the
+           daemon's AdmissionControl; over them, the client is told to come
+           back later, or the scan sets scan_stop_reason and should wrap up
+           with what it has. So it does at the client's deadline, if the
+           client sent one, in seconds from now."""
+        self.scan_stop_reason = None
+        if self.url_args.has_key('deadline-secs'):
+            self.scan_deadline = time.time() + \
+                                         float(self.url_args['deadline-secs'][0])
+        else:
+            self.scan_deadline = None
+
+        leader = self.settings['scans_in_flight'].get(self.get_scan_key())
+        if leader:
+            leader.add_follower(self)
+            return
 
+        retry_after = self.settings['admission'].admit()
+        if retry_after:
             if self.settings['verbose']:
-                err("seeking to %s ..." % universal_offset)
+                err("busy, turning away %s" % self.request.uri)
+            self.set_status(503)
+            self.set_header("Retry-After", str(retry_after))
+            self.finish()
+            return
+        self.scan_admitted = True
 
-            log_accessor.seek_offset(universal_offset)
+        self.scan_key = self.get_scan_key()
+        self.scan_followers = []
+        self.scan_output = []
+        self.scan_output_bytes = 0
+        self.settings['scans_in_flight'][self.scan_key] = self
 
-        else:
-            start_time = self.url_args["start"][0]
-            end_time = self.url_args["end"][0]
+        self.scan_max_klines = max_klines
+        self.scan_log_accessor = None
+        self.scan = scan(self.open_scan_log_accessor())
+        self.scan_cpu_secs = 0.0
+
+        self.run_scan()
+
+    def open_scan_log_accessor(self):
+        """for self.logs_glob, in place of the scan's previous one if any"""
+        self.close_scan_log_accessor()
+
+        following = self.url_args.get('mode') == ['follow']  # --follow --poll
+        self.scan_log_accessor = LogAccessor(self.logs_glob,
+                                             max_klines=self.scan_max_klines,
+                                             sampling_rate=self.sampling_rate,
+                                             verbose=self.settings['verbose'],
+                                             debug=self.settings['debug'],
+                                             hold_partial_line=following)
+        self.scan_bytes_read = 0
+        return self.scan_log_accessor
 
-            seek_time_str = str(start_time).split('.')[0]
+    def close_scan_log_accessor(self):
+        if not getattr(self, 'scan_log_accessor', None):
+            return
+
+        bytes_read = self.scan_log_accessor.get_bytes_read()
+        self.settings['admission'].charge(bytes_read - self.scan_bytes_read)
+        self.settings['stats'].add_scan(self.scan_log_accessor.get_lines_read(),
+                                        bytes_read)
+        self.scan_log_accessor.close_all_files()
+        self.scan_log_accessor = None
+
+    def get_scan_key(self):
+        """the same for requests that can share one scan"""
+        key = [self.request.path]
+        for arg in COALESCING_ARGS:
+            val = self.url_args.get(arg, [])
+            if arg in ['start', 'end']:
+                val = [v.split('.')[0] for v in val]
+            key.append((arg, tuple(val)))
+        return tuple(key)
+
+    def add_follower(self, follower):
+        """Coalescing: follower gets what this scan wrote so far, and then
+           the rest of it as it comes, instead of scanning the same again"""
+        if self.settings['verbose']:
+            err("coalescing %s into %s" % (follower.request.uri,
+                                           self.request.uri))
+        self.settings['stats'].coalesced += 1
 
+        follower.scan_leader = self
+        if getattr(self, 'wire_format', None):
+            follower.set_header("X-Hblog-Wire-Format", self.wire_format)
+        for chunk in self.scan_output:
+            tornado.web.RequestHandler.write(follower, chunk)
+        self.scan_followers.append(follower)
+
+    def remove_follower(self, follower):
+        if follower in self.scan_followers:
+            self.scan_followers.remove(follower)
+
+    def has_open_followers(self):
+        """whether the scan still has clients other than its own: it goes
+           on for them when its own goes away"""
+        return any([not follower.request.connection.stream.closed()
+                                        for follower in self.scan_followers])
+
+    def write(self, chunk):
+        tornado.web.RequestHandler.write(self, chunk)
+
+        if getattr(self, 'scan_key', None):
+            for follower in self.scan_followers:
+                tornado.web.RequestHandler.write(follower, chunk)
+
+            self.scan_output.append(chunk)
+            self.scan_output_bytes += len(chunk)
+            if self.scan_output_bytes > MAX_COALESCING_REPLAY_BYTES:
+                # too much to replay, later requests scan for themselves
+                self.stop_coalescing()
+
+    def stop_coalescing(self):
+        if self.settings['scans_in_flight'].get(self.scan_key) is self:
+            del self.settings['scans_in_flight'][self.scan_key]
+        self.scan_output = []
+
+    def finish_followers(self, reason=None):
+        for follower in self.scan_followers:
+            if reason:
+                line_pkg = {'pkg-cls': 'exit-status',
+                            'pkg-obj': {'status': 'truncated',
+                                        'reason': reason}}
+                tornado.web.RequestHandler.write(follower,
+                                                 "%s\n" % json.dumps(line_pkg))
+            if not follower.request.connection.stream.closed():
+                follower.finish()
+        self.scan_followers = []
+
+    def on_connection_close(self):
+        if getattr(self, 'scan_leader', None):
+            self.scan_leader.remove_follower(self)
+
+    def run_scan(self):
+        if self.request.connection.stream.closed() and \
+                                             not self.has_open_followers():
             if self.settings['verbose']:
-                err("seeking to %s ..." % seek_time_str)
+                err("client went away, cancelling %s" % self.request.uri)
+            self.end_scan()
+            return
+
+        admission = self.settings['admission']
+        t0 = time.clock()
+        slice_end = time.time() + SCAN_SLICE_SECS
+        try:
+            while time.time() < slice_end:
+                self.scan.next()
+        except StopIteration:
+            self.stop_coalescing()
+            self.finish_followers()
+            if self.request.connection.stream.closed():
+                self.end_scan()  # ran on for the followers alone
+            else:
+                self.finish()
+            return
+        finally:
+            self.scan_cpu_secs += time.clock() - t0
+
+        if not self.scan_stop_reason and \
+                         admission.is_over_cpu_budget(self.scan_cpu_secs):
+            self.scan_stop_reason = "over the budget of %s CPU seconds" % \
+                                           admission.max_cpu_secs_per_request
+
+        if not self.scan_stop_reason and self.scan_deadline and \
+                                             time.time() > self.scan_deadline:
+            self.scan_stop_reason = "reached the client's deadline of %ss" % \
+                                           self.url_args['deadline-secs'][0]
+
+        bytes_read = self.scan_log_accessor.get_bytes_read()
+        delay = admission.charge(bytes_read - self.scan_bytes_read)
+        self.scan_bytes_read = bytes_read
+
+        self.flush()
+        for follower in self.scan_followers:
+            follower.flush()
+        if delay:
+            tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
+                                                         self.run_scan)
+        else:
+            tornado.ioloop.IOLoop.instance().add_callback(self.run_scan)
 
-            log_accessor.seek_time(seek_time_str)
+    def end_scan(self):
+        if getattr(self, 'scan_admitted', False):
+            self.scan_admitted = False
+            self.close_scan_log_accessor()
+            self.settings['admission'].release()
+
+            # the scan did not get to the end, e.g. the client went away
+            self.stop_coalescing()
+            self.finish_followers("the scan it shared stopped early")
+
+    def end_encoding(self, wire_format, encoder):
+        encoder_stats = encoder.get_stats()
+        stage_timers.add_total('json-encode', encoder_stats['records'],
+                                              encoder_stats['cpu-secs'])
+
+        if self.settings['verbose']:
+            err("wire-format %s: %s" % (wire_format, encoder_stats))
+
+    def on_finish(self):
+        self.end_scan()
+        self.settings['stats'].add_request(self.request.path,
+                                           self.get_status(),
+                                           self.request.request_time())
+
+    def seek_universal_offset(self, log_accessor, arg="universal-offset"):
+        universal_offset = token_to_universal_offset(self.url_args[arg][0])
+
+        if self.settings['verbose']:
+            err("seeking to %s ..." % universal_offset)
+
+        log_accessor.seek_offset(universal_offset)
+
+    def fetch_and_filter(self, log_accessor):
+        end_time = self.seek(log_accessor)
+
+        for line in self.fetch(log_accessor, end_time):
+            if self.take_line(line):
+                yield line
+
+    def seek(self, log_accessor):
+        """to the universal offset or the start time, returns the end time.
+           A resume-offset, from a truncated stream, is where to pick up the
+           rest of the same time window."""
+        if self.url_args.has_key("universal-offset"):
+            self.seek_universal_offset(log_accessor)
+            return None
+
+        if self.url_args.has_key("resume-offset"):
+            self.seek_universal_offset(log_accessor, "resume-offset")
+            return self.url_args["end"][0]
+
+        self.seek_time(log_accessor, self.url_args["start"][0])
+        return self.url_args["end"][0]
+
+    def seek_time(self, log_accessor, start_time):
+        seek_time_str = str(start_time).split('.')[0]
+
+        if self.settings['verbose']:
+            err("seeking to %s ..." % seek_time_str)
+
+        log_accessor.seek_time(seek_time_str)
+
+    def fetch(self, log_accessor, end_time=None, end_inclusive=True):
+        """all lines up to end_time, unfiltered. No end_time means read to
+           the end of the logs."""
 
         if self.settings['verbose']:
             err("--------------- seeked to --------------")
@@ -130,8 +564,8 @@ class HBLogHandlersParent(tornado.web.RequestHandler):
                                             "before any recognized line in %s" %
                                             log_accessor.get_universal_offset())
 
-            elif not self.url_args.has_key("universal-offset") and \
-                                                          line['ts'] > end_time:
+            elif end_time is not None and (line['ts'] > end_time or
+                              (not end_inclusive and line['ts'] >= end_time)):
                 if self.settings['verbose']:
                     err("----- reached end-time at --------------")
                     err(line)
@@ -140,39 +574,90 @@ class HBLogHandlersParent(tornado.web.RequestHandler):
                 raise StopIteration
                 # for unrecognized lines don't StopIteration
 
-            if line['level'] in self.url_args['levels-list']:
-                if self.url_args['fp'] == []:
-                    if not any([True for fpex in self.url_args['fp-exclude'] if
-                                                  line['fp'].startswith(fpex)]):
-                        take_it = False
-                        if self.url_args['re'] == []:
-                            take_it = True
-                        for r in self.url_args['re']:
-                            if re.search(r, line['text'], re.IGNORECASE):
-                                take_it = True
-                        for r in self.url_args['re-exclude']:
-                            if re.search(r, line['text'], re.IGNORECASE):
-                                take_it = False
-                        if take_it:
-                            yield line
-                elif any([True for fp in self.url_args['fp'] if
-                                                    line['fp'].startswith(fp)]):
-                    yield line
+            yield line
 
             previous_line = line
 
+    def take_line(self, line, check_re=True):
+        if stage_timers.tick('filter'):
+            t0 = time.time()
+            take_it = self.filter_line(line, check_re)
+            stage_timers.add_sample('filter', time.time() - t0)
+            return take_it
+
+        return self.filter_line(line, check_re)
+
+    def filter_line(self, line, check_re):
+        if line['level'] in self.url_args['levels-list']:
+            if self.url_args['fp'] == []:
+                if not any([True for fpex in self.url_args['fp-exclude'] if
+                                              line['fp'].startswith(fpex)]):
+                    if not check_re:
+                        return True
+
+                    take_it = False
+                    if self.url_args['re'] == []:
+                        take_it = True
+                    for r in self.url_args['re']:
+                        if re.search(r, line['text'], re.IGNORECASE):
+                            take_it = True
+                    for r in self.url_args['re-exclude']:
+                        if re.search(r, line['text'], re.IGNORECASE):
+                            take_it = False
+                    return take_it
+            elif any([True for fp in self.url_args['fp'] if
+                                                line['fp'].startswith(fp)]):
+                return True
+
+        return False
+
 class MainHandler(HBLogHandlersParent):
     def get(self):
         self.set_header("Content-Type", "text/html")
         href_example_list = ["/log/stream",
-                             "/log/summary"]
+                             "/log/summary",
+                             "/log/subscribe",
+                             "/log/batch",
+                             "/log/relay",
+                             "/stats"]
         self.write("<pre>\n")
         self.write("Examples:\n")
         for href in href_example_list:
             self.write("<a href=\"%s\">%s</a>\n" % (href, href))
         self.write("</pre>\n")
 
+class StatsHandler(HBLogHandlersParent):
+    """Where hblogd spends its time, as json"""
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain")
+
+        # of the worker that happened to get the request
+        stats = self.settings['stats'].get_stats()
+        stats['worker'] = {'id': self.settings['worker'],
+                           'pid': os.getpid(),
+                           'workers': self.settings['workers']}
+        stats['admission'] = self.settings['admission'].get_stats()
+
+        if self.settings['summary_cache']:
+            stats['summary-cache'] = self.settings['summary_cache'].get_stats()
+        else:
+            stats['summary-cache'] = None
+
+        stats['rollups'] = {}
+        for rollup_glob, rollup in self.settings['rollups'].items():
+            if self.settings['worker'] == 0:
+                last_closed_minute = rollup.get_store().get_last_closed_minute()
+            else:
+                last_closed_minute = \
+                                 rollup.get_store().read_last_closed_minute()
+            stats['rollups'][rollup_glob] = {'last-closed-minute':
+                                                           last_closed_minute}
+
+        self.write("%s\n" % json.dumps(stats, indent=2, sort_keys=True))
+
 class LogStream(HBLogHandlersParent):
+    @tornado.web.asynchronous
     def get(self):
         self.set_header("Content-Type", "text/plain")
         self.parse_url_args()
@@ -186,54 +671,665 @@ class LogStream(HBLogHandlersParent):
         else:
             max_klines = 20000
 
-        log_accessor = LogAccessor(self.logs_glob, max_klines=max_klines,
-                                   sampling_rate=self.sampling_rate,
-                                   verbose=self.settings['verbose'],
-                                   debug=self.settings['debug'],
-                                  )
+        self.start_scan(self.stream, max_klines)
 
-        for line in self.fetch_and_filter(log_accessor):
-            line_pkg = {'pkg-cls': 'log-accessor-line', 'pkg-obj': line}
-            self.write("%s\n" % json.dumps(line_pkg))
+    def stream(self, log_accessor, encoding=None):
+        """encoding is a (wire_format, encoder) shared by several streams
+           of one response, which then ends the encoding itself"""
+        if encoding:
+            wire_format, encoder = encoding
+        else:
+            wire_format, encoder = self.get_encoder()
+
+        last_ts = None
+        end_time = self.seek(log_accessor)
+        for line in self.fetch(log_accessor, end_time):
+            if self.take_line(line):
+                out = encoder.add(line)
+                if out:
+                    self.write(out)
+            last_ts = line['ts']
+
+            yield
+            if self.scan_stop_reason:
+                break
+
+        out = encoder.flush()
+        if out:
+            self.write(out)
 
         log_accessor.close_all_files()
+        if not encoding:
+            self.end_encoding(wire_format, encoder)
 
         line_pkg = {'pkg-cls': 'exit-status',
                     'pkg-obj':
                       {'status': 'success',
                        'universal-offset': log_accessor.get_universal_offset()}
                     }
+        if self.scan_stop_reason:
+            # everything up to last_ts is there, the rest can be had by
+            # asking again with resume-offset=<resume-offset>
+            line_pkg['pkg-obj']['status'] = 'truncated'
+            line_pkg['pkg-obj']['reason'] = self.scan_stop_reason
+            line_pkg['pkg-obj']['scanned-until'] = last_ts
+            line_pkg['pkg-obj']['resume-offset'] = universal_offset_to_token(
+                                          log_accessor.get_universal_offset())
+
+        self.write("%s\n" % json.dumps(line_pkg))
+
+class LogSubscribe(HBLogHandlersParent):
+    """Like /log/stream in follow mode, but the response stays open. The
+       LogAccessor is kept as a cursor over the open files, which are
+       stat-polled for growth; new lines are pushed as they come in."""
+
+    HEARTBEAT_SECS = 5.0
+    MAX_LINES_PER_PUSH = 20000
+    REGLOB_SECS = 10.0  # look for new files this often, rotations of the
+                        # file being read are noticed on the next poll
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.set_header("Content-Type", "text/plain")
+        self.parse_url_args()
+
+        self.wire_format, self.encoder = self.get_encoder()
+        self.log_accessor = None
+        self.poller = None
+        self.poll_after = 0  # over the read budget, polls wait until then
+        self.last_write = time.time()
+        self.last_reglob = time.time()
+        self.last_ts = self.url_args["start"][0]
+
+        self.open_log_accessor()
+        self.settings['stats'].subscriptions += 1
+        if self.url_args.has_key("universal-offset"):
+            try:
+                self.seek_universal_offset(self.log_accessor)
+            except LogAccessorException as e:
+                # e.g. rotated out of the glob while the subscriber was away
+                err("WARNING: %s caught: %s" % (self.request.uri, e))
+                self.seek_time(self.log_accessor, self.last_ts)
+        else:
+            self.seek_time(self.log_accessor, self.last_ts)
+
+        self.push_new_lines()
+
+        self.poller = tornado.ioloop.PeriodicCallback(self.poll,
+                               self.settings['follow_poll_interval'] * 1000)
+        self.poller.start()
+
+    def on_connection_close(self):
+        if self.settings['verbose']:
+            err("subscriber went away: %s" % self.request.uri)
+        self.stop()
+
+    def poll(self):
+        if self.request.connection.stream.closed():
+            self.stop()
+            return
+        if time.time() < self.poll_after:
+            return
+
+        try:
+            reopen = self.log_accessor.is_stale()
+            now = time.time()
+            if not reopen and now - self.last_reglob > self.REGLOB_SECS:
+                self.last_reglob = now
+                reopen = file_identity(self.logs_glob) != self.logfile_identity
+
+            if reopen:
+                # files came, went or got rotated, build a new cursor where
+                # we were. The universal offset follows the file it was in.
+                universal_offset = self.log_accessor.get_universal_offset()
+                self.open_log_accessor()
+                try:
+                    self.log_accessor.seek_offset(universal_offset)
+                except LogAccessorException as e:
+                    err("WARNING: %s lost its offset (%s), seeking to %s" %
+                                           (self.request.uri, e, self.last_ts))
+                    self.seek_time(self.log_accessor, self.last_ts)
+                self.push_new_lines()
+                return
+
+            if self.log_accessor.has_new_data():
+                self.log_accessor.seek_offset(
+                                    self.log_accessor.get_universal_offset())
+                self.push_new_lines()
+
+            elif time.time() - self.last_write > self.HEARTBEAT_SECS:
+                self.write_cursor('heartbeat')
+
+        except (LogAccessorException, SingleFileLogAccessorException) as e:
+            err("WARNING: %s caught: %s" % (self.request.uri, e))
+            self.stop()
+
+    def push_new_lines(self):
+        num_lines = 0
+        for line in self.fetch(self.log_accessor):
+            if self.take_line(line):
+                out = self.encoder.add(line)
+                if out:
+                    self.write(out)
+            self.last_ts = line['ts']
+
+            num_lines += 1
+            if num_lines >= self.MAX_LINES_PER_PUSH:
+                break  # the rest goes out on the next poll
+
+        out = self.encoder.flush()
+        if out:
+            self.write(out)
+
+        self.write_cursor('cursor')
+        self.charge_reads()
+
+    def charge_reads(self):
+        """to the daemon's read budget, as for scans: over it, the next
+           poll waits its turn"""
+        bytes_read = self.log_accessor.get_bytes_read()
+        delay = self.settings['admission'].charge(bytes_read -
+                                                  self.bytes_charged)
+        self.bytes_charged = bytes_read
+        self.poll_after = time.time() + delay
+
+    def write_cursor(self, pkg_cls):
+        """where to resubscribe from, should the connection drop"""
+        line_pkg = {'pkg-cls': pkg_cls,
+                    'pkg-obj':
+                      {'universal-offset':
+                                     self.log_accessor.get_universal_offset()}
+                   }
         self.write("%s\n" % json.dumps(line_pkg))
+        self.flush()
+        self.last_write = time.time()
+
+    def open_log_accessor(self):
+        if self.log_accessor:
+            self.charge_reads()
+            self.log_accessor.close_all_files()
+
+        self.logfile_identity = file_identity(self.logs_glob)
+        self.bytes_charged = 0
+        self.log_accessor = LogAccessor(self.logs_glob, max_klines=20000,
+                                        sampling_rate=self.sampling_rate,
+                                        verbose=self.settings['verbose'],
+                                        debug=self.settings['debug'],
+                                        hold_partial_line=True)
+
+    def stop(self):
+        if self.poller:
+            self.poller.stop()
+            self.poller = None
+
+        if self.log_accessor:
+            self.log_accessor.close_all_files()
+            self.log_accessor = None
+            self.settings['stats'].subscriptions -= 1
+            self.end_encoding(self.wire_format, self.encoder)
+
+        if not self.request.connection.stream.closed():
+            self.finish()
 
 class LogSummary(HBLogHandlersParent):
+    @tornado.web.asynchronous
     def get(self):
         self.set_header("Content-Type", "text/plain")
         self.parse_url_args()
+        self.parse_time_buckets()
 
-        log_accessor = LogAccessor(self.logs_glob, max_klines=20000,
-                                   sampling_rate=self.sampling_rate,
-                                   verbose=self.settings['verbose'],
-                                   debug=self.settings['debug'],
-                                  )
+        self.start_scan(self.summary, 20000)
 
-        results = []
-        for line in self.fetch_and_filter(log_accessor):
-            results.append(line)
+    def parse_time_buckets(self):
+        """per fingerprint counts per time bucket of this many seconds"""
+        self.time_buckets = None
+        if self.url_args.has_key('bucket'):
+            self.time_buckets = TimeBuckets(self.get_bucket_width())
+
+    def get_bucket_width(self):
+        """the bucket url arg, a whole number of seconds, that cuts the time
+           window into at most MAX_TIME_BUCKETS"""
+        try:
+            width = int(self.url_args['bucket'][0])
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if width <= 0:
+            raise tornado.web.HTTPError(400)
+
+        if self.url_args.has_key('start') and self.url_args.has_key('end'):
+            try:
+                start, end = [datetime.strptime(self.url_args[arg][0][:19],
+                                                "%Y-%m-%d %H:%M:%S")
+                              for arg in ['start', 'end']]
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            if (end - start).total_seconds() / width > MAX_TIME_BUCKETS:
+                raise tornado.web.HTTPError(400)
+
+        return width
+
+    def summary(self, log_accessor):
+        summary_cache = self.settings['summary_cache']
+        rollup = self.settings['rollups'].get(self.logs_glob)
+        if rollup and not rollup.can_answer(self.url_args['re'],
+                                            self.url_args['re-exclude']):
+            rollup = None
+
+        # cached and rolled up minutes only fit in buckets of whole minutes
+        by_minute = self.time_buckets is None or \
+                                            self.time_buckets.width % 60 == 0
+
+        if (summary_cache or rollup) and by_minute and \
+                   (self.sampling_rate is None or self.sampling_rate >= 1):
+            summary = new_summary()
+            for _ in self.summarize_by_minute(log_accessor, summary,
+                                              summary_cache, rollup):
+                yield
+
+            if self.settings['verbose'] and summary_cache:
+                err("summary-cache: %s" % summary_cache.get_stats())
+        else:
+            # sampled summaries differ from run to run, don't cache them
+            results = []
+            end_time = self.seek(log_accessor)
+            for line in self.fetch(log_accessor, end_time):
+                if self.take_line(line):
+                    results.append(line)
+
+                yield
+                if self.scan_stop_reason:
+                    break
+
+            summary = summarize(results, self.time_buckets)
 
         log_accessor.close_all_files()
 
-        summary = summarize(results)
+        if self.time_buckets:
+            summary['bucket'] = self.time_buckets.width
+
+        if self.url_args.has_key('limit'):
+            summary = bound_summary(summary, int(self.url_args['limit'][0]))
+
         line_pkg = {'pkg-cls': 'log-accessor-line', 'pkg-obj': summary}
         self.write("%s\n" % json.dumps(line_pkg))
 
         line_pkg = {'pkg-cls': 'exit-status',
                     'pkg-obj': {'status': 'success'}
                    }
+        if self.scan_stop_reason:
+            line_pkg['pkg-obj']['status'] = 'truncated'
+            line_pkg['pkg-obj']['reason'] = self.scan_stop_reason
 
         self.write("%s\n" % json.dumps(line_pkg))
 
+    def summarize_by_minute(self, log_accessor, summary, summary_cache,
+                                  rollup):
+        """Merge the summaries of the closed minutes at the start of the
+           window we already have, first from the rollups, then from the
+           summary cache, and only scan the rest: the partial minute before
+           them and everything after them. Summaries of the minutes that get
+           closed during the scan are cached for the next request.
 
-if __name__ == "__main__":
+           Adds up into summary, and yields as it scans."""
+
+        start_time = self.url_args["start"][0]
+        end_time = self.url_args["end"][0]
+
+        key_prefix = (self.logs_glob,
+                      file_identity(self.logs_glob),
+                      tuple(self.url_args['levels-list']),
+                      tuple(self.url_args['fp']),
+                      tuple(self.url_args['fp-exclude']),
+                      tuple(self.url_args['re']),
+                      tuple(self.url_args['re-exclude']))
+
+        first_minute = first_full_minute(start_time)
+        minute = first_minute
+
+        if rollup:
+            for rolled_minute, counts in \
+                     rollup.get_store().read_minutes(first_minute, end_time):
+                for fp, norm_text, level, count in counts:
+                    line = {'fp': fp, 'norm_text': norm_text, 'level': level}
+                    if self.take_line(line, check_re=False):
+                        add_to_summary(summary, line, count,
+                                       self.bucket_of(rolled_minute))
+                minute = next_minute(rolled_minute)
+
+            if self.settings['verbose']:
+                err("rollups: rolled up minutes from %s up to %s" %
+                                                        (first_minute, minute))
+
+        if summary_cache:
+            cached_from = minute
+            while next_minute(minute) <= end_time:
+                cached = summary_cache.get(key_prefix + (minute,))
+                if cached is None:
+                    break
+                merge_summary(summary, cached, self.bucket_of(minute))
+                minute = next_minute(minute)
+
+            if self.settings['verbose']:
+                err("summary-cache: cached minutes from %s up to %s" %
+                                                        (cached_from, minute))
+
+        if minute > first_minute:
+            # the partial minute before the rolled up or cached ones
+            self.seek_time(log_accessor, start_time)
+            for line in self.fetch(log_accessor, first_minute,
+                                                          end_inclusive=False):
+                if self.take_line(line):
+                    add_to_summary(summary, line,
+                                   bucket=self.bucket_of(line['ts']))
+
+                yield
+                if self.scan_stop_reason:
+                    return
+
+            scan_start = minute
+        else:
+            scan_start = start_time
+
+        def cacheable(minute):
+            return summary_cache and minute >= first_minute and \
+                                              next_minute(minute) <= end_time
+
+        bucket_minute = minute_of(scan_start)
+        bucket_summary = new_summary()
+
+        self.seek_time(log_accessor, scan_start)
+        for line in self.fetch(log_accessor):
+            line_minute = minute_of(line['ts'])
+            reached_end_time = line['ts'] > end_time and \
+                                    not line.get('unrecognized_line', False)
+
+            if line_minute > bucket_minute:
+                # the logs moved on to a later minute: bucket_minute and
+                # any empty minutes up to line_minute are closed
+                merge_summary(summary, bucket_summary,
+                              self.bucket_of(bucket_minute))
+                if cacheable(bucket_minute):
+                    summary_cache.put(key_prefix + (bucket_minute,),
+                                      bucket_summary)
+
+                empty_minute = next_minute(bucket_minute)
+                for _ in range(MAX_CACHED_EMPTY_MINUTES):
+                    if empty_minute >= line_minute or \
+                                                  not cacheable(empty_minute):
+                        break
+                    summary_cache.put(key_prefix + (empty_minute,),
+                                      new_summary())
+                    empty_minute = next_minute(empty_minute)
+
+                bucket_minute = line_minute
+                bucket_summary = new_summary()
+
+            if reached_end_time:
+                break
+
+            if self.take_line(line):
+                add_to_summary(bucket_summary, line)
+
+            yield
+            if self.scan_stop_reason:
+                break
+
+        # still open, so just count it
+        merge_summary(summary, bucket_summary, self.bucket_of(bucket_minute))
+
+    def bucket_of(self, ts):
+        """the time bucket of ts, or None without histograms"""
+        if self.time_buckets:
+            return self.time_buckets.bucket_of(ts)
+        return None
+
+class LogBatch(LogStream, LogSummary):
+    """/log/stream or /log/summary, per data_type, of each of the comma
+       separated globs in turn, with the same filters, in one request and
+       one admitted scan. The packages of each glob follow a batch-glob
+       package naming it, and end with its exit-status."""
+
+    DATA_TYPES = ['stream', 'summary']
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.set_header("Content-Type", "text/plain")
+        self.parse_url_args()
+
+        self.data_type = self.url_args.get('data_type', [None])[0]
+        if self.data_type not in self.DATA_TYPES or \
+                                    self.url_args.has_key("universal-offset"):
+            # offsets are per glob, follow the globs one at a time
+            raise tornado.web.HTTPError(400)
+        self.parse_time_buckets()
+
+        self.start_scan(self.batch, 20000)
+
+    def batch(self, log_accessor):
+        if self.data_type == 'stream':
+            # one fingerprint dictionary for the whole response
+            encoding = self.get_encoder()
+            scan = functools.partial(self.stream, encoding=encoding)
+        else:
+            encoding = None
+            scan = self.summary
+
+        for i, logs_glob in enumerate(self.url_args['glob']):
+            if i > 0:
+                self.logs_glob = logs_glob
+                log_accessor = self.open_scan_log_accessor()
+
+            line_pkg = {'pkg-cls': 'batch-glob', 'pkg-obj': {'glob': logs_glob}}
+            self.write("%s\n" % json.dumps(line_pkg))
+
+            for _ in scan(log_accessor):
+                yield
+
+        if encoding:
+            self.end_encoding(*encoding)
+
+class LogRelay(HBLogHandlersParent):
+    """/log/summary or /log/stream, per relay-endpoint, of each of the
+       comma separated relay-hosts, asked by this hblogd on the client's
+       behalf and merged into one response, so that a client of many hosts
+       talks to one relay per group of them. Summaries are merged into one
+       summary; the lines of the hosts are merged in order of time as they
+       come in, each with the host it came from. The exit-status is that of
+       all the hosts together, truncated if any of them was or did not
+       answer, with the exit-status of each host under relay-hosts."""
+
+    ENDPOINTS = ['stream', 'summary']
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.set_header("Content-Type", "text/plain")
+        self.parse_url_args()
+
+        self.relay_endpoint = self.url_args.get('relay-endpoint', [None])[0]
+        self.relay_hosts = [h for h in self.url_args.get('relay-hosts', [])
+                                                                          if h]
+        if self.relay_endpoint not in self.ENDPOINTS or \
+                                    not self.relay_hosts or \
+                                    self.url_args.has_key("universal-offset"):
+            # --follow asks the hosts itself, its offsets are per host
+            raise tornado.web.HTTPError(400)
+
+        # The same request, less what is for the relay
+        query = [(key, val) for key, val in
+                              urlparse.parse_qsl(self.request.query)
+                              if not key.startswith('relay-') and
+                                                      key != 'deadline-secs']
+        request_timeout = RELAY_REQUEST_TIMEOUT_SECS
+        if self.url_args.has_key('deadline-secs'):
+            request_timeout = float(self.url_args['deadline-secs'][0])
+            query.append(('deadline-secs',
+                          max(request_timeout - RELAY_DEADLINE_MARGIN_SECS,
+                              request_timeout / 2)))
+        connect_timeout = float(self.url_args.get('relay-connect-timeout',
+                                          [RELAY_CONNECT_TIMEOUT_SECS])[0])
+
+        self.relay_exit_states = {}
+        self.relay_pending = len(self.relay_hosts)
+        if self.relay_endpoint == 'stream':
+            # one fingerprint dictionary for the whole response
+            self.relay_encoding = self.get_encoder()
+            self.relay_merger = StreamMerger(RELAY_MAX_BUFFERED_LINES)
+            for host in self.relay_hosts:
+                self.relay_merger.open(host)
+        else:
+            self.relay_summary = new_summary()
+            if self.url_args.has_key('limit'):
+                limit = int(self.url_args['limit'][0])
+                self.relay_space_saving = SpaceSaving.SpaceSaving(limit)
+            else:
+                self.relay_space_saving = None
+
+        # The hosts are asked a few at a time rather than all queued up in
+        # the http client at once, so that those not asked yet are not asked
+        # at all when the client goes away
+        self.relay_closed = False
+        self.relay_queue = list(self.relay_hosts)
+        self.relay_query = query
+        self.relay_timeouts = (connect_timeout, request_timeout)
+        for _ in range(min(len(self.relay_hosts),
+                           self.settings['relay_max_clients'])):
+            self.relay_next()
+
+    def relay_next(self):
+        host = self.relay_queue.pop(0)
+        reader = {'content-decoder': ContentDecoder(),
+                  'package-reader': PackageReader(),
+                  'frame-decoder': FrameDecoder()}
+        url = "http://%s/log/%s?%s" % (host_port(host),
+                                       self.relay_endpoint,
+                                       urllib.urlencode(self.relay_query))
+        if self.settings['verbose']:
+            err("relaying to %s" % url)
+
+        connect_timeout, request_timeout = self.relay_timeouts
+        http_client = tornado.httpclient.AsyncHTTPClient()
+        http_client.fetch(url,
+             functools.partial(self.relay_finished, host),
+             connect_timeout=connect_timeout,
+             request_timeout=request_timeout,
+             use_gzip=False,
+             headers={'Accept-Encoding': CONTENT_ENCODINGS[0]},
+             header_callback=reader['content-decoder'].header_line,
+             streaming_callback=functools.partial(self.relay_data,
+                                                  host, reader))
+
+    def on_connection_close(self):
+        if self.settings['verbose']:
+            err("relay client went away, not asking %d more hosts: %s" %
+                (len(self.relay_queue), self.request.uri))
+        # What the hosts already asked still send is dropped as it comes
+        self.relay_closed = True
+        self.relay_queue = []
+        self.relay_merger = None
+        self.relay_summary = None
+
+    def relay_data(self, host, reader, chunk):
+        if self.relay_closed:
+            return
+        data = reader['content-decoder'].decompress(chunk)
+
+        records = []
+        for line_pkg in reader['package-reader'].feed(data):
+            if line_pkg['pkg-cls'] == 'exit-status':
+                self.relay_exit_states[host] = line_pkg['pkg-obj']
+            elif line_pkg['pkg-cls'] == 'log-accessor-frame':
+                records.extend(
+                           reader['frame-decoder'].decode(line_pkg['pkg-obj']))
+            elif line_pkg['pkg-cls'] == 'log-accessor-line':
+                if self.relay_endpoint == 'summary':
+                    self.merge_relayed_summary(line_pkg['pkg-obj'])
+                else:
+                    records.append(line_pkg['pkg-obj'])
+
+        if records:
+            for rec in records:
+                rec.setdefault('host', host)
+            self.relay_merger.push(host, records)
+            self.write_relayed_lines()
+
+    def merge_relayed_summary(self, summary):
+        if self.relay_space_saving:
+            self.relay_space_saving.merge(SpaceSaving.from_summary(summary,
+                                                 self.relay_space_saving.limit))
+            merge_summary(self.relay_summary, {'level': summary['level'],
+                                               'fp': {}})
+        else:
+            merge_summary(self.relay_summary, summary)
+
+        if 'bucket' in summary:
+            self.relay_summary['bucket'] = summary['bucket']
+
+    def relay_finished(self, host, response):
+        if self.relay_closed:
+            return
+
+        if response.error:
+            self.relay_exit_states[host] = {'status': 'failed',
+                                            'reason': str(response.error)}
+        elif host not in self.relay_exit_states:
+            self.relay_exit_states[host] = {'status': 'failed',
+                                            'reason': "no exit-status"}
+
+        if self.relay_endpoint == 'stream':
+            self.relay_merger.close(host)
+            self.write_relayed_lines()
+
+        self.relay_pending -= 1
+        if self.relay_queue:
+            self.relay_next()
+        elif self.relay_pending == 0:
+            self.finish_relay()
+
+    def write_relayed_lines(self):
+        wire_format, encoder = self.relay_encoding
+        for rec in self.relay_merger.pop_ready():
+            out = encoder.add(rec)
+            if out:
+                self.write(out)
+        self.flush()
+
+    def finish_relay(self):
+        if self.request.connection.stream.closed():
+            return
+
+        if self.relay_endpoint == 'stream':
+            out = self.relay_encoding[1].flush()
+            if out:
+                self.write(out)
+            self.end_encoding(*self.relay_encoding)
+        else:
+            if self.relay_space_saving:
+                self.relay_summary['fp'] = self.relay_space_saving.get_entries()
+                self.relay_summary['sketch'] = \
+                                       self.relay_space_saving.get_sketch()
+            line_pkg = {'pkg-cls': 'log-accessor-line',
+                        'pkg-obj': self.relay_summary}
+            self.write("%s\n" % json.dumps(line_pkg))
+
+        line_pkg = {'pkg-cls': 'exit-status',
+                    'pkg-obj': {'status': 'success',
+                                'relay-hosts': self.relay_exit_states}
+                   }
+        incomplete = sorted(host for host, exit_state in
+                                        self.relay_exit_states.items()
+                                        if exit_state['status'] != 'success')
+        if incomplete:
+            line_pkg['pkg-obj']['status'] = 'truncated'
+            line_pkg['pkg-obj']['reason'] = \
+                         "%d of %d hosts did not answer in full: %s" % \
+                         (len(incomplete), len(self.relay_hosts),
+                          ", ".join(incomplete))
+
+        self.write("%s\n" % json.dumps(line_pkg))
+        self.finish()
+
+
+def get_option_parser():
     usage = "%prog: [options]"
     parser = OptionParser(usage=usage)
     parser.add_option("--basedir", default="/tmp/hblog/test_logs",
@@ -242,19 +1338,152 @@ if __name__ == "__main__":
         help="Verbose logging")
     parser.add_option("--debug", "-d", action="store_true", default=False,
         help="Very verbose logging")
+    parser.add_option("--summary-cache-mb", type="int", default=64,
+        help="memory for summaries of closed minutes, 0 turns the "
+             "summary cache off (def: %default)")
+    parser.add_option("--summary-cache-dir",
+        default="/dev/shm/hblog/summary-cache",
+        help="where --workers share the summary cache, emptied on start "
+             "(def: %default)")
+    parser.add_option("--workers", type="int", default=1,
+        help="pre-forked processes that share the port, each with its own "
+             "--max-concurrent-scans, 0 for one per CPU core (def: %default)")
+    parser.add_option("--follow-poll-interval", type="float", default=0.2,
+        help="seconds between checks for new lines for /log/subscribe "
+             "(def: %default)")
+    parser.add_option("--rollup-glob", action="append", default=[],
+        help="follow this glob in the background and keep per-minute "
+             "fingerprint counts of it for /log/summary, can be repeated")
+    parser.add_option("--rollup-dir", default="/tmp/hblog/rollups",
+        help="where the per-minute counts are kept (def: %default)")
+    parser.add_option("--rollup-retention-hours", type="int", default=168,
+        help="how long per-minute counts are kept (def: %default)")
+    parser.add_option("--rollup-re-exclude", default="^\t",
+        help="comma-separated list of regex to leave out of the per-minute "
+             "counts, only summaries with the same re-exclude use them "
+             "(def: %default)")
+    parser.add_option("--rollup-backfill-minutes", type="int", default=60,
+        help="how far back to start rolling up a new glob (def: %default)")
+    parser.add_option("--rollup-interval", type="float", default=10.0,
+        help="seconds between reads of the rolled up logs (def: %default)")
+    parser.add_option("--compress-level", type="int", default=1,
+        help="gzip/zlib level for clients that accept it, 0 turns "
+             "compression off (def: %default)")
+    parser.add_option("--max-concurrent-scans", type="int", default=4,
+        help="scans run at a time, more get a 503 with a Retry-After, "
+             "0 for no limit (def: %default)")
+    parser.add_option("--max-read-mb-per-sec", type="float", default=50.0,
+        help="log reads of all scans together are throttled to this, "
+             "0 for no limit (def: %default)")
+    parser.add_option("--max-cpu-secs-per-request", type="float", default=30.0,
+        help="scans stop after this and return what they have, "
+             "0 for no limit (def: %default)")
+    parser.add_option("--nice", type="int", default=10,
+        help="run at this lower CPU priority, 0 to leave it be "
+             "(def: %default)")
+    parser.add_option("--ionice", default="best-effort",
+        choices=["none", "best-effort", "idle"],
+        help="disk priority: lowest 'best-effort', 'idle' to only read when "
+             "nothing else does, or 'none' to leave it be (def: %default)")
+    parser.add_option("--port", type="int", default=HBLOGD_PORT,
+        help="listen on this port; hblog reaches hblogds on other ports "
+             "when their hosts are given as host:port (def: %default)")
+    parser.add_option("--relay-max-clients", type="int", default=64,
+        help="connections at a time to the hosts of /log/relay requests, "
+             "more wait for their turn (def: %default)")
 
-    options, _ = parser.parse_args()
-    options = vars(options)  # convert object to dict
+    return parser
 
-    if options['debug']:
-        options['verbose'] = True
+def make_application(options, shared=False):
+    """hblogd's handlers, with what they share set up in options; shared
+       when the --workers share the summary cache"""
+    options['stats'] = Stats()
+    tornado.httpclient.AsyncHTTPClient.configure(None,
+                                  max_clients=options['relay_max_clients'])
+    options['scans_in_flight'] = {}  # scan key -> the handler running it
+
+    # The disk is shared by all the workers, and so is its budget
+    options['admission'] = AdmissionControl(
+               options['max_concurrent_scans'],
+               int(options['max_read_mb_per_sec'] * 1024 * 1024 /
+                                                         options['workers']),
+               options['max_cpu_secs_per_request'])
+
+    if options['summary_cache_mb'] <= 0:
+        options['summary_cache'] = None
+    elif shared:
+        options['summary_cache'] = \
+                   SharedSummaryCache(options['summary_cache_mb'] * 1024 * 1024,
+                                      options['summary_cache_dir'])
+    else:
+        options['summary_cache'] = \
+                         SummaryCache(options['summary_cache_mb'] * 1024 * 1024)
+
+    options['rollups'] = {}
+    rollup_re_exclude = [r for r in options['rollup_re_exclude'].split(',')
+                                                                         if r]
+    for rollup_glob in options['rollup_glob']:
+        rollup = LogRollup(RollupStore(options['rollup_dir'], rollup_glob,
+                                       options['rollup_retention_hours']),
+                           rollup_re_exclude,
+                           backfill_minutes=options['rollup_backfill_minutes'],
+                           verbose=options['verbose'],
+                           debug=options['debug'])
+        options['rollups'][rollup_glob] = rollup
+
+        if options['worker'] != 0:
+            continue  # the first worker rolls up, the others read the store
+        tornado.ioloop.IOLoop.instance().add_callback(
+              functools.partial(poll_rollup, rollup, options['admission']))
+        tornado.ioloop.PeriodicCallback(
+              functools.partial(poll_rollup, rollup, options['admission']),
+              options['rollup_interval'] * 1000).start()
 
     application = tornado.web.Application([
                    (r"/", MainHandler),
                    (r"/log/stream", LogStream),
-                   (r"/log/summary", LogSummary)
+                   (r"/log/summary", LogSummary),
+                   (r"/log/batch", LogBatch),
+                   (r"/log/subscribe", LogSubscribe),
+                   (r"/log/relay", LogRelay),
+                   (r"/stats", StatsHandler)
                ],
+               transforms=[functools.partial(CompressionTransform,
+                                             level=options['compress_level'],
+                                             verbose=options['verbose']),
+                           tornado.web.ChunkedTransferEncoding],
                **options)
+    return application
+
+
+if __name__ == "__main__":
+    options, _ = get_option_parser().parse_args()
+    options = vars(options)  # convert object to dict
+
+    if options['debug']:
+        options['verbose'] = True
+
+    lower_priority(options['nice'], options['ionice'])
+
+    if options['workers'] != 1:
+        # The workers share the listening socket; the kernel hands each
+        # connection to one of them. Nothing must touch the IOLoop before
+        # the fork.
+        sockets = tornado.netutil.bind_sockets(options['port'], '0.0.0.0')
+        if options['summary_cache_mb'] > 0:
+            shutil.rmtree(options['summary_cache_dir'], ignore_errors=True)
+        if options['workers'] == 0:
+            options['workers'] = tornado.process.cpu_count()
+        options['worker'] = tornado.process.fork_processes(options['workers'])
+    else:
+        sockets = None
+        options['worker'] = 0
+
+    application = make_application(options, shared=bool(sockets))
 
-    application.listen(6957, '0.0.0.0')
+    if sockets:
+        server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
+    else:
+        application.listen(options['port'], '0.0.0.0')
     tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import unittest
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_PATH + '/../lib')
+from AdmissionControl import AdmissionControl
+
+MB = 1024 * 1024
+
+class ThrottledSecsTest(unittest.TestCase):
+
+    def test_overlapping_delays_count_once(self):
+        admission = AdmissionControl(0, MB, 0)
+        # the burst, then two seconds' worth over it
+        first = admission.charge(2 * MB)
+        second = admission.charge(MB)
+        self.assertAlmostEqual(first, 1.0, places=1)
+        self.assertAlmostEqual(second, 2.0, places=1)
+
+        # two readers waited, the first within the second's wait
+        self.assertAlmostEqual(admission.throttled_secs, 2.0, places=1)
+
+    def test_no_budget(self):
+        admission = AdmissionControl(0, 0, 0)
+        self.assertEqual(admission.charge(100 * MB), 0.0)
+        self.assertEqual(admission.throttled_secs, 0.0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import unittest
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_PATH + '/../lib')
+from ResultCache import covers, take_line
+
+ALL_LEVELS = ["INFO", "DEBUG", "WARN", "ERROR", "FATAL"]
+
+def make_filter(**kwargs):
+    wanted = {'levels-list': ALL_LEVELS, 'fp': [], 'fp-exclude': [],
+              're': [], 're-exclude': []}
+    wanted.update(kwargs)
+    return wanted
+
+def make_line(text, level="INFO", fp="abc1234"):
+    return {'text': text, 'level': level, 'fp': fp}
+
+class CoversTest(unittest.TestCase):
+
+    def test_same_filter(self):
+        asked = make_filter(re=['foo'])
+        self.assertTrue(covers(asked, make_filter(re=['foo']), 'stream'))
+        self.assertTrue(covers(asked, make_filter(re=['foo']), 'summary'))
+
+    def test_unfiltered_after_filtered(self):
+        self.assertFalse(covers(make_filter(re=['foo']), make_filter(),
+                                'stream'))
+        self.assertFalse(covers(make_filter(re=['foo']), make_filter(),
+                                'summary'))
+
+    def test_re_must_be_none_or_the_same(self):
+        self.assertTrue(covers(make_filter(), make_filter(re=['foo']),
+                               'stream'))
+        self.assertFalse(covers(make_filter(re=['foo', 'bar']),
+                                make_filter(re=['foo']), 'stream'))
+        self.assertFalse(covers(make_filter(re=['foo']),
+                                make_filter(re=['foo', 'bar']), 'stream'))
+
+    def test_re_exclude(self):
+        self.assertTrue(covers(make_filter(),
+                               make_filter(**{'re-exclude': ['foo']}),
+                               'stream'))
+        self.assertFalse(covers(make_filter(**{'re-exclude': ['foo']}),
+                                make_filter(), 'stream'))
+
+    def test_levels(self):
+        warn = make_filter(**{'levels-list': ['WARN', 'ERROR', 'FATAL']})
+        error = make_filter(**{'levels-list': ['ERROR', 'FATAL']})
+        self.assertTrue(covers(warn, error, 'stream'))
+        self.assertFalse(covers(error, warn, 'stream'))
+        self.assertFalse(covers(warn, error, 'summary'))
+
+    def test_fp(self):
+        self.assertTrue(covers(make_filter(fp=['ab']),
+                               make_filter(fp=['abc']), 'stream'))
+        self.assertFalse(covers(make_filter(fp=['abc']),
+                                make_filter(fp=['ab']), 'stream'))
+        self.assertFalse(covers(make_filter(fp=['abc']), make_filter(),
+                                'stream'))
+        self.assertTrue(covers(make_filter(), make_filter(fp=['abc']),
+                               'stream'))
+        self.assertFalse(covers(make_filter(re=['foo']),
+                                make_filter(fp=['abc']), 'stream'))
+        self.assertFalse(covers(make_filter(), make_filter(fp=['abc']),
+                                'summary'))
+
+    def test_fp_exclude(self):
+        self.assertTrue(covers(make_filter(**{'fp-exclude': ['abc']}),
+                               make_filter(**{'fp-exclude': ['ab']}),
+                               'stream'))
+        self.assertFalse(covers(make_filter(**{'fp-exclude': ['ab']}),
+                                make_filter(**{'fp-exclude': ['abc']}),
+                                'stream'))
+
+class TakeLineTest(unittest.TestCase):
+
+    def test_levels(self):
+        wanted = make_filter(**{'levels-list': ['WARN', 'ERROR', 'FATAL']})
+        self.assertFalse(take_line(make_line("x", level="INFO"), wanted))
+        self.assertTrue(take_line(make_line("x", level="ERROR"), wanted))
+
+    def test_re(self):
+        wanted = make_filter(re=['foo', 'bar'], **{'re-exclude': ['baz']})
+        self.assertTrue(take_line(make_line("a FOO b"), wanted))
+        self.assertTrue(take_line(make_line("a bar b"), wanted))
+        self.assertFalse(take_line(make_line("a qux b"), wanted))
+        self.assertFalse(take_line(make_line("a foo baz"), wanted))
+        self.assertTrue(take_line(make_line("anything"), make_filter()))
+
+    def test_fp(self):
+        wanted = make_filter(fp=['abc'], re=['foo'])
+        # the lines of the fingerprints, whatever the re
+        self.assertTrue(take_line(make_line("qux", fp="abc1234"), wanted))
+        self.assertFalse(take_line(make_line("foo", fp="def5678"), wanted))
+
+        wanted = make_filter(**{'fp-exclude': ['abc']})
+        self.assertFalse(take_line(make_line("foo", fp="abc1234"), wanted))
+        self.assertTrue(take_line(make_line("foo", fp="def5678"), wanted))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_PATH + '/../lib')
+from LogAccessor import LogAccessor
+
+LINES = ["2011-03-27 13:48:17,701 INFO a.B: first\n",
+         "2011-03-27 13:49:17,701 WARN a.B: second\n",
+         "2011-03-27 13:50:17,701 ERROR a.B: last, with no newline"]
+
+class UnterminatedLastLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'app.log')
+        with open(self.path, 'w') as f:
+            f.write("".join(LINES))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_window(self, start, end, hold_partial_line=False):
+        log_accessor = LogAccessor(self.path, max_klines=10,
+                                   hold_partial_line=hold_partial_line)
+        log_accessor.seek_time(start)
+        texts = [line['text'] for line in log_accessor if line['ts'] < end]
+        log_accessor.close_all_files()
+        return texts
+
+    def test_scan_returns_unterminated_last_line(self):
+        texts = self.read_window("2011-03-27 13:49:00", "2011-03-27 14:00:00")
+        self.assertEqual(texts, ["a.B: second", "a.B: last, with no newline"])
+
+    def test_follower_holds_unterminated_last_line(self):
+        texts = self.read_window("2011-03-27 13:49:00", "2011-03-27 14:00:00",
+                                 hold_partial_line=True)
+        self.assertEqual(texts, ["a.B: second"])
+
+        with open(self.path, 'a') as f:
+            f.write("\n")
+        texts = self.read_window("2011-03-27 13:49:00", "2011-03-27 14:00:00",
+                                 hold_partial_line=True)
+        self.assertEqual(texts, ["a.B: second", "a.B: last, with no newline"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import time
+import unittest
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_PATH + '/../lib')
+from TimeBuckets import TimeBuckets
+
+class LocalMidnightTest(unittest.TestCase):
+    """ Buckets start at local clock boundaries, whatever the time zone"""
+
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/Los_Angeles'
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def test_day(self):
+        buckets = TimeBuckets(86400)
+        self.assertEqual(buckets.bucket_of("2011-03-27 13:48:07,123"),
+                         "2011-03-27 00:00:00")
+        self.assertEqual(buckets.bucket_of("2011-03-27 23:59:59"),
+                         "2011-03-27 00:00:00")
+        self.assertEqual(buckets.bucket_of("2011-03-28 00:00:00"),
+                         "2011-03-28 00:00:00")
+
+    def test_hours(self):
+        buckets = TimeBuckets(3 * 3600)
+        self.assertEqual(buckets.bucket_of("2011-03-27 13:48:07"),
+                         "2011-03-27 12:00:00")
+
+    def test_range(self):
+        buckets = TimeBuckets(86400)
+        self.assertEqual(buckets.get_range("2011-03-26 17:00:00",
+                                           "2011-03-28 16:59:59"),
+                         ["2011-03-26 00:00:00", "2011-03-27 00:00:00",
+                          "2011-03-28 00:00:00"])
+
+    def test_across_daylight_savings(self):
+        # 2011-03-13 had 23 hours in PDT
+        buckets = TimeBuckets(86400)
+        self.assertEqual(buckets.get_range("2011-03-12 12:00:00",
+                                           "2011-03-14 12:00:00"),
+                         ["2011-03-12 00:00:00", "2011-03-13 00:00:00",
+                          "2011-03-14 00:00:00"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python2.7
+
+# Copyright 2013 Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import socket
+import urllib
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, SCRIPT_PATH + '/../tornado')
+import tornado.ioloop
+import tornado.testing
+
+hblogd = imp.load_source('hblogd', SCRIPT_PATH + '/../sbin/hblogd.py')
+
+NUM_LINES = 100000  # enough for a scan to take many slices
+START = datetime(2011, 3, 27)
+
+class LeaderGoesAwayTest(tornado.testing.AsyncHTTPTestCase):
+    """ A scan shared by several clients goes on for the others when the
+        client that started it goes away"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'app.log')
+        with open(self.path, 'w') as f:
+            for i in xrange(NUM_LINES):
+                ts = START + timedelta(seconds=i / 10.0)
+                f.write("%s,%03d WARN a.B: line %d of many\n" %
+                        (ts.strftime("%Y-%m-%d %H:%M:%S"),
+                         ts.microsecond / 1000, i))
+        super(LeaderGoesAwayTest, self).setUp()
+
+    def tearDown(self):
+        super(LeaderGoesAwayTest, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def get_new_ioloop(self):
+        return tornado.ioloop.IOLoop.instance()  # hblogd's scans run on it
+
+    def get_app(self):
+        options = vars(hblogd.get_option_parser().parse_args(
+                                              ['--summary-cache-mb', '0'])[0])
+        options['worker'] = 0
+        self.app = hblogd.make_application(options)
+        return self.app
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        def check():
+            if condition() or time.time() > deadline:
+                self.stop()
+            else:
+                self.io_loop.add_timeout(time.time() + 0.01, check)
+        check()
+        self.wait(timeout=timeout + 1)
+        self.assertTrue(condition())
+
+    def test_follower_gets_complete_result(self):
+        path = "/log/stream?" + urllib.urlencode({
+                   'glob': self.path,
+                   'levels-list': "INFO,DEBUG,WARN,ERROR,FATAL",
+                   'start': str(START),
+                   'end': str(START + timedelta(days=1))})
+
+        leader = socket.create_connection(('127.0.0.1', self.get_http_port()))
+        leader.sendall("GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path)
+        self.wait_for(lambda: self.app.settings['scans_in_flight'])
+
+        self.http_client.fetch(self.get_url(path), self.stop,
+                               request_timeout=60)
+        self.wait_for(lambda: self.app.settings['stats'].coalesced == 1)
+        leader.close()
+
+        response = self.wait(timeout=60)
+        self.assertEqual(response.code, 200)
+        lines = response.body.rstrip("\n").split("\n")
+        exit_status = json.loads(lines[-1])
+        self.assertEqual(exit_status['pkg-cls'], 'exit-status')
+        self.assertEqual(exit_status['pkg-obj']['status'], 'success')
+        self.assertEqual(len([line for line in lines
+                                    if 'log-accessor-line' in line]),
+                         NUM_LINES)
+
+        # the scan ran on for the follower alone, and still let go of its
+        # budgets when done
+        self.wait_for(lambda: not self.app.settings['scans_in_flight'])
+        self.assertEqual(self.app.settings['admission'].scans_in_flight, 0)
+
+if __name__ == "__main__":
+    unittest.main()